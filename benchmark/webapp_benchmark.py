@@ -0,0 +1,244 @@
+# -*- coding: iso-8859-15 -*-
+
+__doc__ = '''Benchmarks of the webapp dispatch pipeline
+
+The WSGI function of an Application is called in-process with synthetic Site trees, so the numbers
+only contain the work done by web.py and webapp (routing, query parsing, headers, compression...).
+
+    python benchmark/webapp_benchmark.py --output before.json
+    python benchmark/webapp_benchmark.py --output after.json --compare before.json
+
+Results of different machines or Python versions are not comparable.
+'''
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from io import BytesIO
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, rootDir)
+
+from webapp import Application, Site, expose, ResponseCompression, web
+
+
+def buildSiteTree(depth, width):
+    '''Returns a Site tree where every node has width handlers and width child sites up to depth'''
+    def handler(name):
+        @expose(contentType='text/html; charset=utf-8', enableCORS='*')
+        def nodeHandler(self):
+            return name
+        return nodeHandler
+
+    def buildNode(level, name):
+        attributes = dict(('h%d' % i, handler('%s.h%d' % (name, i))) for i in range(width))
+        node = type('Level%dSite' % level, (Site,), attributes)()
+        if level < depth:
+            for i in range(width):
+                setattr(node, 's%d' % i, buildNode(level + 1, '%s.s%d' % (name, i)))
+        return node
+
+    root = buildNode(1, 'root')
+
+    @expose(contentType='text/html; charset=utf-8')
+    def search(self, term: str='', page: int=1, **filters):
+        return '%s %d %d' % (term, page, len(filters))
+
+    @expose(contentType='text/html; charset=utf-8')
+    def payload(self, size: int=1024):
+        return PAYLOAD[:size]
+
+    root.__class__.search = search
+    root.__class__.payload = payload
+    return root
+
+
+#Compressible but not trivially repetitive content
+PAYLOAD = ''.join('<tr><td>%d</td><td>row %x</td><td>%s</td></tr>\n' % (i, i * 7919, 'abcdefgh'[i % 8] * (i % 13))
+                  for i in range(40000))
+
+
+def scenarios(depth, width):
+    deepPath = '/' + '/'.join(['s0'] * (depth - 1) + ['h%d' % (width - 1)])
+    longQuery = 'term=webapp&page=3&' + '&'.join('filter%d=value%%20%d' % (i, i) for i in range(200))
+    result = [
+        ('root index', 'GET', '/h0', '', {}),
+        ('deep route', 'GET', deepPath, '', {}),
+        ('default fallback', 'GET', deepPath + '/missing/page', '', {}),
+        ('missing root path', 'GET', '/missing', '', {}),
+        ('long query', 'GET', '/search', longQuery, {}),
+        ('cors preflight', 'OPTIONS', deepPath, '', {'HTTP_ORIGIN': 'http://example.com',
+                                                      'HTTP_ACCESS_CONTROL_REQUEST_METHOD': 'GET'}),
+    ]
+    for size in (1024, 64 * 1024, 1024 * 1024):
+        result.append(('gzip %dKB' % (size // 1024), 'GET', '/payload', 'size=%d' % size,
+                       {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}))
+    return result
+
+
+def makeEnviron(method, path, query, headers):
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost:8080',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    environ.update(headers)
+    return environ
+
+
+def request(wsgi, environ):
+    environ = dict(environ)
+    environ['wsgi.input'] = BytesIO()
+    status = []
+    result = wsgi(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        size = sum(len(chunk) for chunk in result)
+    finally:
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+    return status[0], size
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def measure(wsgi, environ, requests, warmup):
+    for _ in range(warmup):
+        request(wsgi, environ)
+
+    latencies = []
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(requests):
+        begin = time.perf_counter()
+        status, size = request(wsgi, environ)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    #Allocations are measured separately since tracemalloc slows down the requests
+    allocationRequests = max(1, min(requests, 200))
+    tracemalloc.start()
+    peaks = 0
+    for _ in range(allocationRequests):
+        #Forgets the earlier blocks and resets the peak, tracemalloc.reset_peak needs Python 3.9
+        tracemalloc.clear_traces()
+        request(wsgi, environ)
+        peaks += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'status': status,
+            'responseBytes': size,
+            'requestsPerSecond': requests / elapsed,
+            'p50Microseconds': percentile(latencies, 0.5) * 1e6,
+            'p99Microseconds': percentile(latencies, 0.99) * 1e6,
+            'peakAllocatedBytesPerRequest': peaks / allocationRequests}
+
+
+def run(depth=4, width=5, requests=2000, warmup=200, modes=('webpy', 'native'), only=None):
+    #web.py reloads the modules of the application in debug mode, it is not the production setup
+    web.config.debug = False
+    root = buildSiteTree(depth, width)
+    app = Application(root=root, urls=None, compression=ResponseCompression())
+    applications = {'webpy': app.wsgifunc(), 'native': app.wsgifunc(native=True)}
+
+    results = []
+    for name, method, path, query, headers in scenarios(depth, width):
+        if only and not any(pattern in name for pattern in only):
+            continue
+        environ = makeEnviron(method, path, query, headers)
+        for mode in modes:
+            result = measure(applications[mode], environ, requests, warmup)
+            result.update({'scenario': name, 'mode': mode})
+            results.append(result)
+            report(result)
+    return results
+
+
+def report(result, baseline=None):
+    line = '%-20s %-7s %10.0f req/s  p50 %9.1f us  p99 %9.1f us  %9.0f B/req  %s' % (
+        result['scenario'], result['mode'], result['requestsPerSecond'], result['p50Microseconds'],
+        result['p99Microseconds'], result['peakAllocatedBytesPerRequest'], result['status'])
+    if baseline is not None:
+        line += '  %+6.1f%% req/s' % ((result['requestsPerSecond'] / baseline['requestsPerSecond'] - 1) * 100)
+    print(line)
+    sys.stdout.flush()
+
+
+def compare(results, baselineResults):
+    baseline = dict(((result['scenario'], result['mode']), result) for result in baselineResults)
+    print('\nCompared to the baseline:')
+    for result in results:
+        report(result, baseline.get((result['scenario'], result['mode'])))
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=rootDir,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def counter(minimum):
+    '''argparse type of the counts which can not be below minimum'''
+    def count(value):
+        value = int(value)
+        if value < minimum:
+            raise argparse.ArgumentTypeError('%d is less than %d' % (value, minimum))
+        return value
+    return count
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the WSGI dispatch pipeline of webapp')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the synthetic Site tree')
+    parser.add_argument('--width', type=int, default=5, help='handlers and child sites of every node')
+    parser.add_argument('--requests', type=counter(1), default=2000, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=counter(0), default=200, help='requests before measuring')
+    parser.add_argument('--mode', choices=('webpy', 'native'), action='append',
+                        help='WSGI function to measure, both by default')
+    parser.add_argument('--only', action='append', help='runs the scenarios containing this text')
+    parser.add_argument('--output', help='JSON file to store the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    options = parser.parse_args(args)
+
+    results = run(options.depth, options.width, options.requests, options.warmup,
+                  tuple(options.mode or ('webpy', 'native')), options.only)
+
+    if options.output:
+        with open(options.output, 'w') as outFile:
+            json.dump({'commit': gitCommit(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'options': vars(options),
+                       'results': results}, outFile, indent=1)
+
+    if options.compare:
+        with open(options.compare) as inFile:
+            compare(results, json.load(inFile)['results'])
+    return results
+
+
+if __name__ == '__main__':
+    main()
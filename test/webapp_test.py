@@ -1,9 +1,29 @@
 import sys 
 sys.path.append('./')
 
+import io
+import asyncio
+import os
 import json 
+import hashlib
+import marshal
+import mimetypes
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.request
+import warnings
+import zlib
 
 import unittest 
+from datetime import datetime, timezone
+from enum import Enum
+from typing import List, Optional
 from paste.fixture import TestApp
 from oktest import ok as expect, test, todo, skip, run as runTests   
 
@@ -258,6 +278,68 @@ class CustomSiteTest (unittest.TestCase):
 
 
 
+class CompiledRoutesTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=SiteRoot(), urls=None, globals=globals(), compileRoutes=True)
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    @test("compiled routes return the same handlers as walking the site tree")
+    def _(_):
+        root = SiteRoot()
+        paths = ['/', '/index', '/page', '/missingpage', '/withDefault', '/withDefault/',
+                 '/withDefault/missingpage', '/withDefault/notexposed', '/withDefault/missingpage/third',
+                 '/withDefault/third', '/withDefault/third/index', '/withDefault/third/missing',
+                 '/withoutDefault', '/withoutDefault/missingpage', '/noIndexWithDefault',
+                 '/noIndexWithDefault/missing', '/page/missing', '/a//b']
+        routes = webapp.RouteTable(root)
+        index = Application(root=root, urls=None, globals=globals()).index
+        for path in paths:
+            segments = path.split('/')[1:]
+            expect(routes.resolve(segments)) == index.getNodeHandler(segments)
+
+    @test("compiled routes are used to handle the requests")
+    def _(_):
+        expect(testApp.get('/').body) == b'SiteRoot.index'
+        expect(testApp.get('/withDefault/third').body) == b'ThirdLevel.index'
+        expect(testApp.get('/withoutDefault/missingpage').body) == b'SiteRoot.default'
+        expect(testApp.get('/noIndexWithDefault').body) == b'SecondLevelNoIndexWithDefault.default'
+
+    @test("shared and cyclic sub sites can be compiled")
+    def _(_):
+        root = SiteRoot()
+        root.withDefault.third.up = root.withDefault
+        root.shared = root.withDefault.third
+        routes = webapp.RouteTable(root)
+        expect(routes.resolve(['withDefault', 'third', 'up', 'third', 'index'])().encode()) == b'ThirdLevel.index'
+        expect(routes.resolve(['shared', 'missing'])().encode()) == b'SiteRoot.default'
+        expect(routes.resolve(['withDefault', 'third', 'missing'])().encode()) == b'SecondLevelWithDefault.default'
+
+    @test("compiled routes are rebuilt after they are invalidated")
+    def _(_):
+        @expose(contentType='text/html; charset=utf-8')
+        def added():
+            return 'added'
+
+        app.root.added = added
+        try:
+            expect(testApp.get('/added').body) == b'SiteRoot.default'
+            app.invalidateRoutes()
+            expect(testApp.get('/added').body) == b'added'
+        finally:
+            del app.root.added
+            app.invalidateRoutes()
+
+
 class ContenTypeSiteRoot(Site):
     def __init__(self):
         pass 
@@ -358,6 +440,1847 @@ class ContentTypeTest:
 
     
 
+class NativeSiteRoot(ContenTypeSiteRoot):
+    @expose(contentType='application/json; charset=utf-8', enableCORS='*', methods=['GET'])
+    def get_only(self):
+        return json.dumps('GET')
+
+    @expose(contentType='text/html; charset=utf-8')
+    def failing(self):
+        raise ValueError('failing page')
+
+
+class NativeWSGITest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=NativeSiteRoot(), urls=None, globals=globals())
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware, native=True))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    @test("native WSGI function returns the same content as web.py")
+    def _(_):
+        res = testApp.get('/html')
+        expect(res.header('Content-Type')).should.startswith('text/html')
+        expect(res.status) == 200
+        expect(res.body) == b'HTML'
+
+        res = testApp.get('/zipped_json')
+        expect(res.header('Content-Encoding')) == 'gzip'
+        expect(json.loads(unzipIt(res.body))) == 'JSON Zipped'
+
+    @test("native WSGI function keeps the headers set by the handlers")
+    def _(_):
+        res = testApp.get('/text_as_downloadable_file')
+        expect(res.header('content-disposition')) == 'attachment;filename=myfile.csv'
+        expect(res.body) == b'text file content'
+
+    @test("native WSGI function adds CORS headers and rejects unsupported methods")
+    def _(_):
+        res = testApp.get('/get_only')
+        expect(res.header('Access-Control-Allow-Origin')) == '*'
+        expect(json.loads(res.body)) == 'GET'
+
+        res = testApp.post('/get_only', status=405)
+        expect(res.status) == 405
+
+    @test("native WSGI function uses the default handlers and web.ctx")
+    def _(_):
+        expect(testApp.get('/missing/page').body) == b'Missing Page: /missing/page'
+
+    @test("native WSGI function returns internal error if the handler fails")
+    def _(_):
+        res = testApp.get('/failing', status=500, extra_environ={'wsgi.errors': io.StringIO()})
+        expect(res.status) == 500
+
+
+class CompressionSiteRoot(ContenTypeSiteRoot):
+    @expose(contentType='text/html; charset=utf-8')
+    def large_html(self):
+        return 'HTML ' * 100
+
+    @expose(contentType='image/png')
+    def image(self):
+        return b'PNG ' * 100
+
+    @expose(contentType='text/html; charset=utf-8', compressLevel=0)
+    def uncompressed_html(self):
+        return 'HTML ' * 100
+
+
+class CompressionTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=CompressionSiteRoot(), urls=None, globals=globals(), 
+                          compression=webapp.ResponseCompression(minSize=100))
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    @test("responses are compressed if the client accepts gzip")
+    def _(_):
+        res = testApp.get('/large_html', headers={'Accept-Encoding': 'gzip, deflate'})
+        expect(res.header('Content-Encoding')) == 'gzip'
+        expect(res.header('Vary')) == 'Accept-Encoding'
+        expect(unzipIt(res.body)) == b'HTML ' * 100
+
+    @test("deflate is used if it is preferred by the client")
+    def _(_):
+        res = testApp.get('/large_html', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        expect(res.header('Content-Encoding')) == 'deflate'
+        expect(zlib.decompress(res.body)) == b'HTML ' * 100
+
+    @test("responses are not compressed if the client does not accept compression")
+    def _(_):
+        res = testApp.get('/large_html')
+        expect(res.body) == b'HTML ' * 100
+        res = testApp.get('/large_html', headers={'Accept-Encoding': 'gzip;q=0, br'})
+        expect(res.body) == b'HTML ' * 100
+
+    @test("small, incompressible and disabled responses are not compressed")
+    def _(_):
+        headers = {'Accept-Encoding': 'gzip'}
+        expect(testApp.get('/html', headers=headers).body) == b'HTML'
+        expect(testApp.get('/image', headers=headers).body) == b'PNG ' * 100
+        expect(testApp.get('/uncompressed_html', headers=headers).body) == b'HTML ' * 100
+
+    @test("responses zipped by the handlers are not compressed again")
+    def _(_):
+        res = testApp.get('/zipped_html', headers={'Accept-Encoding': 'gzip'})
+        expect(res.header('Content-Encoding')) == 'gzip'
+        expect(unzipIt(res.body)) == b'HTML Zipped'
+
+    @test("compression chunks can be decompressed as a single body")
+    def _(_):
+        chunks = list(webapp.compressChunks(['a' * 10, b'b' * 10, 'c'], 'gzip'))
+        expect(unzipIt(b''.join(chunks))) == b'a' * 10 + b'b' * 10 + b'c'
+
+
+class SharedSection(Site):
+    @expose(contentType='text/html; charset=utf-8')
+    def page(self):
+        '''Shared page'''
+        return 'shared'
+
+
+class SitemapSiteRoot(Site):
+    def __init__(self):
+        self.first = SharedSection()
+        self.second = self.first
+        self.first.up = self
+
+    @expose(contentType='text/html; charset=utf-8')
+    def index(self):
+        '''Root page'''
+        return 'index'
+
+
+class SitemapTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=SitemapSiteRoot(), urls=None, globals=globals(), serveSitemap=True)
+        testApp = TestApp(app.wsgifunc())
+
+    @test("shared subtrees are listed under each path and cycles are not followed")
+    def _(_):
+        expect([entry['url'] for entry in app.sitemap]) == ['/', '/first/page', '/index', '/second/page']
+        expect(app.sitemap[1]['description']) == 'Shared page'
+
+    @test("sitemap is cached until it is invalidated")
+    def _(_):
+        app.invalidateSitemap()
+        expect(isinstance(app.iterSitemap(), types.GeneratorType)) == True
+        first = app.sitemap
+        expect(isinstance(app.iterSitemap(), types.GeneratorType)) == False
+
+        root = app.root
+        root.third = SharedSection()
+        try:
+            expect(app.sitemap) == first
+            app.invalidateRoutes()
+            expect(len(app.sitemap)) == len(first) + 1
+        finally:
+            del root.third
+            app.invalidateSitemap()
+
+    @test("sitemap is served as JSON lines and sitemap.xml")
+    def _(_):
+        res = testApp.get('/sitemap.jsonl')
+        expect(res.header('Content-Type')) == 'application/jsonl; charset=utf-8'
+        expect([json.loads(line) for line in res.body.decode('utf-8').splitlines()]) == app.sitemap
+
+        res = testApp.get('/sitemap.xml')
+        expect(res.header('Content-Type')) == 'application/xml; charset=utf-8'
+        body = res.body.decode('utf-8')
+        expect(body.startswith('<?xml')) == True
+        expect(body.count('<loc>')) == 4
+        expect('<loc>http://localhost/second/page</loc>' in body) == True
+
+    @test("sitemap endpoints are not served if they are not enabled")
+    def _(_):
+        otherApp = Application(root=SitemapSiteRoot(), urls=None, globals=globals())
+        expect(TestApp(otherApp.wsgifunc()).get('/sitemap.xml').body) == b'Missing Page: /sitemap.xml'
+
+
+class StreamingSiteRoot(Site):
+    def __init__(self):
+        self.closed = False
+
+    @expose(contentType='application/text; charset=utf-8')
+    def streamed_file(self, rows: int = 3):
+        web.header('content-disposition', 'attachment;filename=myfile.csv')
+        try:
+            for row in range(rows):
+                yield 'row %d\n' % row
+        finally:
+            self.closed = True
+
+    @expose(contentType='application/text; charset=utf-8')
+    def streamed_bytes(self):
+        yield b'first '
+        yield b'second'
+
+
+class StreamingTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=StreamingSiteRoot(), urls=None, globals=globals(), 
+                          compression=webapp.ResponseCompression(minSize=0))
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    @test("handlers can yield the content in chunks")
+    def _(_):
+        res = testApp.get('/streamed_file')
+        expect(res.header('content-disposition')) == 'attachment;filename=myfile.csv'
+        expect(res.body) == b'row 0\nrow 1\nrow 2\n'
+        expect(testApp.get('/streamed_bytes').body) == b'first second'
+
+    @test("streamed chunks are compressed incrementally")
+    def _(_):
+        res = testApp.get('/streamed_file?rows=1000', headers={'Accept-Encoding': 'gzip'})
+        expect(res.header('Content-Encoding')) == 'gzip'
+        expect(unzipIt(res.body)) == ''.join('row %d\n' % i for i in range(1000)).encode('utf-8')
+
+    @test("native WSGI function streams the chunks without a content length")
+    def _(_):
+        nativeApp = TestApp(app.wsgifunc(native=True))
+        res = nativeApp.get('/streamed_file')
+        expect(res.header('content-disposition')) == 'attachment;filename=myfile.csv'
+        expect(res.header('Content-Length', None)) == None
+        expect(res.body) == b'row 0\nrow 1\nrow 2\n'
+
+    @test("HEAD requests of streamed responses have no body and close the handler")
+    def _(_):
+        root = app.root
+        root.closed = False
+        environ = {'REQUEST_METHOD': 'HEAD', 'PATH_INFO': '/streamed_file', 'QUERY_STRING': ''}
+        response = []
+        body = b''.join(app.nativeWSGI(environ, lambda status, headers: response.extend((status, headers))))
+        expect(response[0]) == '200 OK'
+        expect(dict(response[1])['content-disposition']) == 'attachment;filename=myfile.csv'
+        expect(body) == b''
+        expect(root.closed) == True
+        status, _, body = callASGI(app.asgifunc(), '/streamed_file', method='HEAD')
+        expect((status, body)) == (200, b'')
+
+    @test("closing a streamed response closes the handler")
+    def _(_):
+        root = app.root
+        root.closed = False
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/streamed_file', 'QUERY_STRING': 'rows=100',
+                   'HTTP_ACCEPT_ENCODING': 'gzip'}
+        response = app.nativeWSGI(environ, lambda status, headers: None)
+        next(iter(response))
+        response.close()
+        expect(root.closed) == True
+
+
+class AsyncSiteRoot(Site):
+    @expose(contentType='application/text; charset=utf-8', enableCORS='*')
+    async def slow(self, delay: float = 0, name: str = ''):
+        web.header('X-Name', name)
+        await asyncio.sleep(delay)
+        await asyncio.sleep(0)
+        return '%s %s' % (name, web.ctx.path)
+
+    @expose(contentType='application/text; charset=utf-8')
+    async def posted(self, _post=False):
+        return 'posted %s' % web.data().decode('utf-8')
+
+    @expose(contentType='application/text; charset=utf-8')
+    async def failing(self):
+        raise ValueError('failing')
+
+    @expose(contentType='application/text; charset=utf-8')
+    def sync(self, name: str = ''):
+        return 'sync %s' % name
+
+    @expose(contentType='application/text; charset=utf-8')
+    def streamed(self):
+        for row in range(3):
+            yield 'row %d\n' % row
+
+
+def runAsync(coroutine):
+    '''asyncio.run() is not available on Python 3.6, the coroutine is run on a new event loop'''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def callASGI(asgi, path, method='GET', query=b'', body=b'', headers=()):
+    '''Runs a single request through the ASGI callable and returns (status, headers, body)'''
+    async def request():
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': [(name.encode('latin1'), value.encode('latin1')) for name, value in headers]}
+        await asgi(scope, receive, send)
+        return messages
+    return readASGIMessages(runAsync(request()))
+
+
+def readASGIMessages(messages):
+    start = messages[0]
+    headers = dict((name.decode('latin1'), value.decode('latin1')) for name, value in start['headers'])
+    return start['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class AsyncHandlerTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=AsyncSiteRoot(), urls=None, globals=globals())
+        testApp = TestApp(app.wsgifunc())
+
+    @test("async handlers can be called through WSGI")
+    def _(_):
+        expect(testApp.get('/slow?name=wsgi').body) == b'wsgi /slow'
+        expect(TestApp(app.wsgifunc(native=True)).get('/slow?name=native').body) == b'native /slow'
+
+    @test("ASGI callable awaits async handlers")
+    def _(_):
+        status, headers, body = callASGI(app.asgifunc(), '/slow', query=b'name=asgi')
+        expect(status) == 200
+        expect(headers['content-type']) == 'application/text; charset=utf-8'
+        expect(headers['x-name']) == 'asgi'
+        expect(headers['access-control-allow-origin']) == '*'
+        expect(body) == b'asgi /slow'
+
+    @test("ASGI callable passes the posted values with _post")
+    def _(_):
+        status, _, body = callASGI(app.asgifunc(), '/posted', method='POST', body=b'a=1',
+                                   headers=[('Content-Type', 'application/x-www-form-urlencoded')])
+        expect(status) == 200
+        expect(body) == b'posted a=1'
+
+    @test("ASGI callable returns the CORS headers for OPTIONS")
+    def _(_):
+        status, headers, body = callASGI(app.asgifunc(), '/slow', method='OPTIONS')
+        expect(status) == 200
+        expect(set(headers['access-control-allow-methods'].split(', '))) == {'GET', 'POST', 'OPTIONS'}
+        expect(body) == b''
+
+    @test("ASGI callable runs sync handlers on the thread pool")
+    def _(_):
+        asgi = app.asgifunc(threads=2)
+        expect(callASGI(asgi, '/sync', query=b'name=pool')[2]) == b'sync pool'
+        expect(callASGI(asgi, '/streamed')[2]) == b'row 0\nrow 1\nrow 2\n'
+        expect(callASGI(asgi, '/missing')[2]) == b'Missing Page: /missing'
+
+    @test("ASGI callable reports handler errors with 500")
+    def _(_):
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            status, _, _ = callASGI(app.asgifunc(), '/failing')
+        finally:
+            sys.stderr = stderr
+        expect(status) == 500
+
+    @test("concurrent async requests share the event loop with their own web.ctx")
+    def _(_):
+        asgi = app.asgifunc(threads=1)
+
+        async def request(name):
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                messages.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/slow', 
+                     'query_string': ('delay=0.2&name=%s' % name).encode('latin1')}
+            await asgi(scope, receive, send)
+            return readASGIMessages(messages)
+
+        async def requests():
+            return await asyncio.gather(*[request('r%d' % i) for i in range(50)])
+
+        start = time.monotonic()
+        responses = runAsync(requests())
+        expect(time.monotonic() - start) < 2
+        for i, (status, headers, body) in enumerate(responses):
+            expect(status) == 200
+            expect(headers['x-name']) == 'r%d' % i
+            expect(body) == ('r%d /slow' % i).encode('latin1')
+
+
+class LazyReports(Site):
+    created = 0
+
+    def __init__(self, title='reports'):
+        LazyReports.created += 1
+        self.title = title
+
+    @expose(contentType='text/html; charset=utf-8')
+    def index(self):
+        return '%s index' % self.title
+
+    @expose(contentType='text/html; charset=utf-8')
+    def summary(self):
+        return '%s summary' % self.title
+
+
+class LazySiteRoot(Site):
+    def __init__(self):
+        self.reports = webapp.LazySite(LazyReports, title='imported')
+        self.archive = webapp.LazySite(lambda: LazyReports('factory'))
+
+    @expose(contentType='text/html; charset=utf-8')
+    def index(self):
+        return 'root'
+
+    @expose(contentType='text/html; charset=utf-8')
+    def default(self):
+        return 'root default'
+
+
+class LazySiteTest:
+    @test("lazy subtrees are loaded on the first request routed through them")
+    def _(_):
+        for compileRoutes in (False, True):
+            LazyReports.created = 0
+            root = LazySiteRoot()
+            lazyApp = TestApp(Application(root=root, urls=None, globals=globals(), 
+                                          compileRoutes=compileRoutes).wsgifunc())
+            expect(lazyApp.get('/').body) == b'root'
+            expect(LazyReports.created) == 0
+            expect(root.reports.loaded) == False
+
+            expect(lazyApp.get('/reports/summary').body) == b'imported summary'
+            expect(lazyApp.get('/reports').body) == b'imported index'
+            expect(lazyApp.get('/reports/missing').body) == b'root default'
+            expect(LazyReports.created) == 1
+            expect(root.archive.loaded) == False
+
+            expect(lazyApp.get('/archive/summary').body) == b'factory summary'
+            expect(LazyReports.created) == 2
+
+    @test("sitemap lists the lazy subtrees")
+    def _(_):
+        lazyApp = Application(root=LazySiteRoot(), urls=None, globals=globals())
+        expect([entry['url'] for entry in lazyApp.sitemap]) == ['/', '/archive', '/archive/index', 
+            '/archive/summary', '/default', '/index', '/reports', '/reports/index', '/reports/summary']
+
+    @test("lazy subtrees can be loaded in the background")
+    def _(_):
+        root = LazySiteRoot()
+        lazyApp = Application(root=root, urls=None, globals=globals(), compileRoutes=True)
+        lazyApp.warmUp(['/reports']).join()
+        expect((root.reports.loaded, root.archive.loaded)) == (True, False)
+        lazyApp.warmUp(background=False)
+        expect(root.archive.loaded) == True
+
+    @test("lazy references can be given as import paths")
+    def _(_):
+        expect(webapp.LazySite('webapp:Site').resolve().__class__) == Site
+        expect(webapp.LazySite('webapp.Site').resolve().__class__) == Site
+
+    @test("lazy references which do not give a Site are reported")
+    def _(_):
+        def _():
+            webapp.LazySite(lambda: 'not a site').resolve()
+        expect(_).raises(TypeError)
+
+
+class CountedSiteRoot(Site):
+    created = 0
+    release = threading.Event()
+
+    def __init__(self):
+        CountedSiteRoot.created += 1
+        self.instance = CountedSiteRoot.created
+
+    @expose(contentType='application/text; charset=utf-8')
+    def index(self):
+        return str(self.instance)
+
+    @expose(contentType='application/text; charset=utf-8')
+    def blocking(self):
+        CountedSiteRoot.release.wait(5)
+        return str(self.instance)
+
+    @expose(contentType='application/text; charset=utf-8')
+    async def waiting(self):
+        await asyncio.sleep(0.1)
+        return str(self.instance)
+
+
+class RootPolicyTest:
+    def instances(self, application, count):
+        '''Returns the bodies of the root index requested from count different threads'''
+        testApp = TestApp(application.wsgifunc())
+        bodies = []
+        for _ in range(count):
+            thread = threading.Thread(target=lambda: bodies.append(testApp.get('/').body))
+            thread.start()
+            thread.join()
+        return bodies
+
+    @test("callable roots are created once instead of for every request")
+    def _(self):
+        CountedSiteRoot.created = 0
+        countedApp = Application(root=CountedSiteRoot, urls=None, globals=globals())
+        expect(self.instances(countedApp, 3)) == [b'1', b'1', b'1']
+        expect(CountedSiteRoot.created) == 1
+        expect(countedApp.root.instance) == 1
+
+    @test("thread policy creates a root instance per thread")
+    def _(self):
+        CountedSiteRoot.created = 0
+        countedApp = Application(root=CountedSiteRoot, urls=None, globals=globals(), rootPolicy='thread',
+                                 compileRoutes=True)
+        expect(CountedSiteRoot.created) == 0
+        expect(sorted(self.instances(countedApp, 3))) == [b'1', b'2', b'3']
+        expect(CountedSiteRoot.created) == 3
+
+    @test("pooled roots are bounded and requests wait for an idle instance until the timeout")
+    def _(self):
+        CountedSiteRoot.created = 0
+        countedApp = Application(root=CountedSiteRoot, urls=None, globals=globals(), rootPolicy='pool',
+                                 rootPoolSize=1, rootPoolTimeout=0.2)
+        testApp = TestApp(countedApp.wsgifunc())
+        policy = countedApp.rootPolicy
+        CountedSiteRoot.release.clear()
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(testApp.get('/blocking')))
+        thread.start()
+        try:
+            waitFor(lambda: policy.stats()['idle'] == 0)
+            res = testApp.get('/', status=503)
+            expect(res.header('Retry-After')) == '1'
+            #Preflight requests do not wait for an instance
+            environ = {'REQUEST_METHOD': 'OPTIONS', 'PATH_INFO': '/', 'QUERY_STRING': ''}
+            response = []
+            countedApp.nativeWSGI(environ, lambda status, headers: response.append(status))
+            expect(response) == ['200 OK']
+        finally:
+            CountedSiteRoot.release.set()
+            thread.join()
+        expect(responses[0].body) == b'1'
+        expect(testApp.get('/').body) == b'1'
+        expect(policy.stats()) == {'size': 1, 'created': 1, 'idle': 1, 'rejected': 1}
+
+    @test("async requests served through ASGI take their own pooled instance")
+    def _(self):
+        CountedSiteRoot.created = 0
+        countedApp = Application(root=CountedSiteRoot, urls=None, globals=globals(), rootPolicy='pool',
+                                 rootPoolSize=4)
+        asgi = countedApp.asgifunc()
+
+        async def request():
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                messages.append(message)
+            await asgi({'type': 'http', 'method': 'GET', 'path': '/waiting'}, receive, send)
+            return readASGIMessages(messages)
+
+        async def requests():
+            return await asyncio.gather(*[request() for _ in range(3)])
+
+        responses = runAsync(requests())
+        expect(len(set(body for _, _, body in responses))) == 3
+        policy = countedApp.rootPolicy
+        expect(policy.stats()['created']) == 3
+        expect(policy.stats()['idle']) == 3
+
+    @test("applications keep their own roots and settings side by side")
+    def _(self):
+        first = Application(root=CountedSiteRoot(), urls=None, globals=globals())
+        second = Application(root=CountedSiteRoot(), urls=None, globals=globals(), metrics=True)
+        firstApp, secondApp = TestApp(first.wsgifunc()), TestApp(second.wsgifunc())
+        expect(firstApp.get('/').body) == str(first.root.instance).encode()
+        expect(secondApp.get('/').body) == str(second.root.instance).encode()
+        expect(first.root.instance) != second.root.instance
+        expect(b'webapp_requests_total' in secondApp.get('/_metrics').body) == True
+        expect(first.Index.metrics) == None
+
+    @test("root policies have to provide the current instance")
+    def _(self):
+        class IncompletePolicy(webapp.RootPolicy):
+            pass
+        expect(lambda: IncompletePolicy(CountedSiteRoot)).raises(TypeError)
+
+    @test("unknown root policies are rejected")
+    def _(self):
+        def _():
+            Application(root=CountedSiteRoot, urls=None, globals=globals(), rootPolicy='request')
+        expect(_).raises(ValueError)
+
+
+class StaticSiteRoot(Site):
+    def __init__(self, directory):
+        self.assets = webapp.StaticDirectory(directory, maxAge=60)
+
+    @expose(contentType='text/html; charset=utf-8')
+    def index(self):
+        return 'root'
+
+
+class StaticDirectoryTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp
+        global app
+
+        cls.directory = tempfile.mkdtemp()
+        cls.data = os.urandom(300 * 1024)
+        files = {'app.js': b'console.log(1)', 'data.bin': cls.data, 'style.css': b'body {}' * 100,
+                 'docs/index.html': b'<h1>docs</h1>', '.secret': b'secret'}
+        for name, content in files.items():
+            path = os.path.join(cls.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as outFile:
+                outFile.write(content)
+        with open(os.path.join(cls.directory, 'style.css.gz'), 'wb') as outFile:
+            outFile.write(zipIt(files['style.css']))
+
+        app = Application(root=StaticSiteRoot(cls.directory), urls=None, globals=globals())
+        testApp = TestApp(app.wsgifunc())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @test("files below the mounted directory are served with their metadata")
+    def _(self):
+        res = testApp.get('/assets/app.js')
+        expect(res.body) == b'console.log(1)'
+        expect(res.header('Content-Type')) == mimetypes.guess_type('app.js')[0] + '; charset=utf-8'
+        expect(res.header('Content-Length')) == '14'
+        expect(res.header('Cache-Control')) == 'public, max-age=60'
+        expect(res.header('Accept-Ranges')) == 'bytes'
+        expect(res.header('ETag').startswith('"')) == True
+        expect(testApp.get('/assets/data.bin').body == self.data) == True
+        expect(testApp.get('/assets/docs/').body) == b'<h1>docs</h1>'
+        expect(testApp.get('/').body) == b'root'
+
+    @test("missing, hidden and outside files are not found")
+    def _(self):
+        testApp.get('/assets/missing.js', status=404)
+        testApp.get('/assets/.secret', status=404)
+        testApp.get('/assets/../webapp_test.py', status=404)
+        testApp.get('/assets/docs/../../app.js', status=404)
+        testApp.post('/assets/app.js', status=405)
+        compiledApp = TestApp(Application(root=StaticSiteRoot(self.directory), urls=None, globals=globals(),
+                                          compileRoutes=True).wsgifunc())
+        expect(compiledApp.get('/assets/docs/index.html').body) == b'<h1>docs</h1>'
+        compiledApp.get('/assets/directory', status=404)
+
+    @test("symbolic links and absolute segments do not lead out of the directory")
+    @skip.when(not hasattr(os, 'symlink'), 'Symbolic links are not supported')
+    def _(self):
+        outside = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(outside, 'private.txt'), 'wb') as outFile:
+                outFile.write(b'private')
+            os.symlink(os.path.join(outside, 'private.txt'), os.path.join(self.directory, 'linked.txt'))
+            os.symlink(outside, os.path.join(self.directory, 'linked'))
+            os.symlink(os.path.join(self.directory, 'app.js'), os.path.join(self.directory, 'alias.js'))
+            testApp.get('/assets/linked.txt', status=404)
+            testApp.get('/assets/linked/private.txt', status=404)
+            expect(testApp.get('/assets/alias.js').body) == b'console.log(1)'
+            directory = app.root.assets
+            #Absolute paths are joined below the directory
+            expect(directory.filePath(outside + '/private.txt').startswith(directory.directory + os.sep)) == True
+            expect(directory.contains(os.path.join(outside, 'private.txt'))) == False
+            expect(directory.contains(os.path.join(directory.directory, 'app.js'))) == True
+        finally:
+            for name in ('linked.txt', 'linked', 'alias.js'):
+                if os.path.lexists(os.path.join(self.directory, name)):
+                    os.unlink(os.path.join(self.directory, name))
+            shutil.rmtree(outside)
+
+    @test("single byte ranges are answered with partial content")
+    def _(self):
+        res = testApp.get('/assets/data.bin', headers={'Range': 'bytes=100-199'}, status=206)
+        expect(res.body == self.data[100:200]) == True
+        expect(res.header('Content-Range')) == 'bytes 100-199/%d' % len(self.data)
+        res = testApp.get('/assets/data.bin', headers={'Range': 'bytes=-10'}, status=206)
+        expect(res.body == self.data[-10:]) == True
+        res = testApp.get('/assets/data.bin', headers={'Range': 'bytes=300000-'}, status=206)
+        expect(res.body == self.data[300000:]) == True
+
+        res = testApp.get('/assets/data.bin', headers={'Range': 'bytes=%d-' % len(self.data)}, status=416)
+        expect(res.header('Content-Range')) == 'bytes */%d' % len(self.data)
+        res = testApp.get('/assets/data.bin', headers={'Range': 'bytes=0-9', 'If-Range': '"old"'}, status=200)
+        expect(len(res.body)) == len(self.data)
+
+    @test("gzip siblings are sent to the clients accepting gzip")
+    def _(_):
+        res = testApp.get('/assets/style.css', headers={'Accept-Encoding': 'gzip'})
+        expect(res.header('Content-Encoding')) == 'gzip'
+        expect(res.header('Vary')) == 'Accept-Encoding'
+        expect(unzipIt(res.body)) == b'body {}' * 100
+        res = testApp.get('/assets/style.css')
+        expect(res.body) == b'body {}' * 100
+        expect(res.header('Content-Type')) == 'text/css; charset=utf-8'
+
+    @test("conditional requests are answered from the cached metadata and changes are revalidated")
+    def _(self):
+        etag = testApp.get('/assets/app.js').header('ETag')
+        testApp.get('/assets/app.js', headers={'If-None-Match': etag}, status=304)
+
+        directory = app.root.assets
+        path = os.path.join(self.directory, 'app.js')
+        with open(path, 'wb') as outFile:
+            outFile.write(b'console.log(2)')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        directory._files['app.js'].checked -= directory.revalidate
+        res = testApp.get('/assets/app.js', headers={'If-None-Match': etag})
+        expect(res.body) == b'console.log(2)'
+        expect(res.header('ETag')) != etag
+
+    @test("native WSGI function passes whole files to the file wrapper of the server")
+    def _(self):
+        wrapped = []
+        def fileWrapper(file, blockSize):
+            wrapped.append(file)
+            return iter(lambda: file.read(blockSize), b'')
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/assets/data.bin', 'QUERY_STRING': '', 
+                   'wsgi.file_wrapper': fileWrapper}
+        response = []
+        body = b''.join(app.nativeWSGI(environ, lambda status, headers: response.extend((status, headers))))
+        expect(len(wrapped)) == 1
+        expect(body == self.data) == True
+        wrapped[0].close()
+
+        status, headers, body = callNative('/assets/data.bin', Range='bytes=0-3')
+        expect(status) == '206 Partial Content'
+        expect(body) == self.data[:4]
+
+
+class BatchSiteRoot(Site):
+    def __init__(self):
+        self.threads = set()
+
+    @expose(contentType='text/plain; charset=utf-8')
+    def echo(self, text: str='', count: int=1):
+        self.threads.add(threading.current_thread().name)
+        return text * count
+
+    @expose(contentType='application/json', methods=['GET'], enableCORS=['http://example.com'])
+    def report(self):
+        return json.dumps({'rows': 3})
+
+    @expose(contentType='application/octet-stream')
+    def binary(self):
+        return b'\xff\x00'
+
+
+class BatchTest:
+    def batch(self, testApp, entries, **options):
+        res = testApp.post('/_batch', json.dumps(entries), **options)
+        expect(res.header('Content-Type')) == 'application/json'
+        return json.loads(res.body)
+
+    @test("entries are routed and handled as requests of their own")
+    def _(self):
+        batchApp = TestApp(Application(root=BatchSiteRoot(), urls=None, globals=globals(), batch=True).wsgifunc())
+        results = self.batch(batchApp, [{'path': '/echo', 'query': 'text=ab&count=2'}, 
+                                        {'path': '/echo', 'query': {'text': 'c'}},
+                                        {'path': '/missing'},
+                                        {'path': '/echo', 'query': 'count=x'},
+                                        {'path': '/binary'},
+                                        {'path': '/_batch'}])
+        expect([result['status'] for result in results]) == [200, 200, 200, 400, 200, 400]
+        expect([result['body'] for result in results[:3]]) == ['abab', 'c', 'Missing Page: /missing']
+        expect(results[0]['headers']['Content-Type']) == 'text/plain; charset=utf-8'
+        expect((results[4]['body'], results[4]['bodyEncoding'])) == ('/wA=', 'base64')
+
+    @test("supported methods and CORS of the handlers apply to each entry")
+    def _(self):
+        batchApp = TestApp(Application(root=BatchSiteRoot(), urls=None, globals=globals(), batch=True).wsgifunc())
+        results = self.batch(batchApp, [{'path': '/report'}, {'path': '/report', 'method': 'POST'}],
+                             headers={'Origin': 'http://example.com'})
+        expect(results[0]['status']) == 200
+        expect(json.loads(results[0]['body'])) == {'rows': 3}
+        expect(results[0]['headers']['Access-Control-Allow-Origin']) == 'http://example.com'
+        expect(results[1]['status']) == 405
+
+    @test("batch requests and their preflights carry the CORS headers of the endpoint")
+    def _(self):
+        batchApp = Application(root=BatchSiteRoot(), urls=None, globals=globals(), 
+                               batch=webapp.BatchEndpoint(enableCORS=['http://example.com'], corsMaxAge=600))
+        environ = {'REQUEST_METHOD': 'OPTIONS', 'PATH_INFO': '/_batch', 'QUERY_STRING': '', 
+                   'HTTP_ORIGIN': 'http://example.com'}
+        response = []
+        body = b''.join(batchApp.nativeWSGI(environ, lambda status, headers: response.extend((status, headers))))
+        status, headers = response[0], dict(response[1])
+        expect(status) == '200 OK'
+        expect(body) == b''
+        expect(headers['Access-Control-Allow-Origin']) == 'http://example.com'
+        expect(headers['Access-Control-Allow-Methods']) == 'POST, OPTIONS'
+        expect(headers['Access-Control-Max-Age']) == '600'
+        expect(headers['Allow']) == 'POST, OPTIONS'
+
+        res = TestApp(batchApp.wsgifunc()).post('/_batch', json.dumps([{'path': '/echo'}]), 
+                                                headers={'Origin': 'http://example.com'})
+        expect(res.header('Access-Control-Allow-Origin')) == 'http://example.com'
+        expect(res.header('Vary')) == 'Origin'
+
+    @test("entries can not target the built-in endpoints")
+    def _(self):
+        batchApp = TestApp(Application(root=BatchSiteRoot(), urls=None, globals=globals(), batch=True, 
+                                       metrics=True, serveSitemap=True).wsgifunc())
+        results = self.batch(batchApp, [{'path': '/_metrics'}, {'path': webapp.SITEMAP_XML_PATH}, 
+                                        {'path': '/_batch', 'method': 'POST'}, {'path': '/echo'}])
+        expect([result['status'] for result in results]) == [400, 400, 400, 200]
+
+    @test("entries can run in parallel on a thread pool")
+    def _(self):
+        root = BatchSiteRoot()
+        batchApp = TestApp(Application(root=root, urls=None, globals=globals(), 
+                                       batch=webapp.BatchEndpoint(threads=4)).wsgifunc())
+        entries = [{'path': '/echo', 'query': {'text': str(i)}} for i in range(20)]
+        results = self.batch(batchApp, entries)
+        expect([result['body'] for result in results]) == [str(i) for i in range(20)]
+        expect(all(name.startswith('webapp-batch') for name in root.threads)) == True
+
+    @test("invalid batch requests are rejected")
+    def _(_):
+        batchApp = TestApp(Application(root=BatchSiteRoot(), urls=None, globals=globals(), 
+                                       batch=webapp.BatchEndpoint(maxEntries=2)).wsgifunc())
+        batchApp.post('/_batch', 'not json', status=400)
+        batchApp.post('/_batch', b'\xff[]', status=400)
+        batchApp.post('/_batch', json.dumps([{'query': 'a=1'}]), status=400)
+        batchApp.post('/_batch', json.dumps([{'path': '/echo'}] * 3), status=400)
+        batchApp.get('/_batch', status=405)
+        plainApp = TestApp(Application(root=BatchSiteRoot(), urls=None, globals=globals()).wsgifunc())
+        expect(plainApp.get('/_batch').body) == b'Missing Page: /_batch'
+
+
+class CoalescingSiteRoot(Site):
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    @expose(contentType='text/html; charset=utf-8', coalesce=True)
+    def popular(self, page: int=1, size: int=1):
+        self.calls += 1
+        self.release.wait(5)
+        return ('page %d ' % page) * size
+
+    @expose(contentType='text/html; charset=utf-8', coalesce=True)
+    def ordered(self, sort=None):
+        self.calls += 1
+        self.release.wait(5)
+        return ','.join(sort)
+
+    @expose(contentType='text/html; charset=utf-8', coalesce=True)
+    def session(self):
+        self.calls += 1
+        self.release.wait(5)
+        web.setcookie('session', 'secret%d' % self.calls)
+        return 'session'
+
+    @expose(contentType='text/html; charset=utf-8', coalesce=webapp.RequestCoalescing(timeout=0.1))
+    def impatient(self):
+        self.calls += 1
+        self.release.wait(5)
+        return 'impatient'
+
+
+class CoalescingTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=CoalescingSiteRoot(), urls=None, globals=globals(), compression=True)
+        testApp = TestApp(app.wsgifunc())
+
+    def concurrent(self, urls, **options):
+        root = app.root
+        root.calls = 0
+        root.release.clear()
+        responses = []
+        threads = [threading.Thread(target=lambda url=url: responses.append(testApp.get(url, **options))) 
+                   for url in urls]
+        for thread in threads:
+            thread.start()
+        waitFor(lambda: root.calls > 0)
+        #Lets the other requests reach the handler
+        time.sleep(0.3)
+        root.release.set()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    @test("identical concurrent requests share one handler call")
+    def _(self):
+        flights = CoalescingSiteRoot.popular.coalescing.flights
+        shared = flights.shared
+        urls = ['/popular?page=2&size=3', '/popular?size=3&page=2'] * 3
+        responses = self.concurrent(urls)
+        expect(app.root.calls) == 1
+        expect(flights.shared - shared) == 5
+        expect(set(res.body for res in responses)) == {b'page 2 page 2 page 2 '}
+        expect(set(res.header('Content-Type') for res in responses)) == {'text/html; charset=utf-8'}
+
+    @test("compressed results are shared and different queries are not coalesced")
+    def _(self):
+        urls = ['/popular?page=1&size=400'] * 3 + ['/popular?page=2&size=400']
+        responses = self.concurrent(urls, headers={'Accept-Encoding': 'gzip'})
+        expect(app.root.calls) == 2
+        expect(all(res.header('Content-Encoding') == 'gzip' for res in responses)) == True
+        expect(sorted(unzipIt(res.body)[:7] for res in responses)) == [b'page 1 '] * 3 + [b'page 2 ']
+
+    @test("requests differing in the order of repeated keys are not coalesced")
+    def _(self):
+        responses = self.concurrent(['/ordered?sort=name&sort=date', '/ordered?sort=date&sort=name'] * 2)
+        expect(app.root.calls) == 2
+        expect(sorted(res.body for res in responses)) == [b'date,name'] * 2 + [b'name,date'] * 2
+
+    @test("responses setting cookies are not shared")
+    def _(self):
+        responses = self.concurrent(['/session'] * 3)
+        expect(app.root.calls) == 3
+        expect(len(set(res.header('Set-Cookie') for res in responses))) == 3
+
+    @test("waiting requests call the handler themselves after the timeout")
+    def _(self):
+        responses = self.concurrent(['/impatient'] * 2)
+        expect(app.root.calls) == 2
+        expect([res.body for res in responses]) == [b'impatient'] * 2
+
+
+class LimitedSection(Site):
+    concurrency = webapp.ConcurrencyLimit(1, queueDepth=1, timeout=0.3, retryAfter=5)
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    @expose(contentType='application/text; charset=utf-8')
+    def blocking(self):
+        self.release.wait(5)
+        return 'section'
+
+    @expose(contentType='application/text; charset=utf-8')
+    def streamed(self):
+        yield 'first'
+        self.release.wait(5)
+        yield 'second'
+
+
+class ConcurrencySiteRoot(Site):
+    def __init__(self):
+        self.release = threading.Event()
+        self.section = LimitedSection()
+
+    @expose(contentType='application/text; charset=utf-8', concurrency=1)
+    def slow(self):
+        self.release.wait(5)
+        return 'slow'
+
+    @expose(contentType='application/text; charset=utf-8')
+    def health(self):
+        return 'ok'
+
+    @expose(contentType='application/text; charset=utf-8', concurrency=1, queueDepth=10)
+    async def serialized(self):
+        await asyncio.sleep(0.05)
+        return 'serialized'
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition is not met in %s seconds' % timeout)
+        time.sleep(0.01)
+
+
+class ConcurrencyLimitTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=ConcurrencySiteRoot(), urls=None, globals=globals())
+        testApp = TestApp(app.wsgifunc())
+
+    def background(self, path):
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(testApp.get(path, status='*')))
+        thread.start()
+        return thread, responses
+
+    @test("requests over the limit are rejected with 503 and Retry-After")
+    def _(self):
+        root = app.root
+        limit = root.slow.concurrency
+        root.release.clear()
+        thread, responses = self.background('/slow')
+        waitFor(lambda: limit.active == 1)
+
+        res = testApp.get('/slow', status=503)
+        expect(res.header('Retry-After')) == '1'
+        expect(testApp.get('/health').body) == b'ok'
+
+        root.release.set()
+        thread.join()
+        expect(responses[0].body) == b'slow'
+        expect(limit.stats()) == {'limit': 1, 'active': 0, 'queued': 0, 'accepted': 1, 'rejected': 1, 
+                                  'timedOut': 0}
+
+    @test("limit of a site applies to its subtree and queued requests wait until the deadline")
+    def _(self):
+        section = app.root.section
+        limit = LimitedSection.concurrency
+        section.release.clear()
+        thread, responses = self.background('/section/blocking')
+        waitFor(lambda: limit.active == 1)
+
+        start = time.monotonic()
+        res = testApp.get('/section/streamed', status=503)
+        expect(time.monotonic() - start) >= 0.3
+        expect(res.header('Retry-After')) == '5'
+        expect(limit.timedOut) == 1
+
+        queued, queuedResponses = self.background('/section/blocking')
+        waitFor(lambda: limit.stats()['queued'] == 1)
+        testApp.get('/section/blocking', status=503)
+        section.release.set()
+        for t in (thread, queued):
+            t.join()
+        expect([r.body for r in responses + queuedResponses]) == [b'section', b'section']
+        expect(limit.active) == 0
+
+    @test("streamed responses keep their slot until they are closed")
+    def _(self):
+        section = app.root.section
+        limit = LimitedSection.concurrency
+        section.release.set()
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/section/streamed', 'QUERY_STRING': ''}
+        response = app.nativeWSGI(environ, lambda status, headers: None)
+        expect(limit.active) == 1
+        expect(b''.join(response)) == b'firstsecond'
+        response.close()
+        expect(limit.active) == 0
+
+    @test("queued async requests wait without blocking the event loop")
+    def _(self):
+        asgi = app.asgifunc()
+
+        async def requests():
+            return await asyncio.gather(*[request() for _ in range(5)])
+
+        async def request():
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                messages.append(message)
+            await asgi({'type': 'http', 'method': 'GET', 'path': '/serialized'}, receive, send)
+            return readASGIMessages(messages)
+
+        start = time.monotonic()
+        responses = runAsync(requests())
+        expect(time.monotonic() - start) >= 0.25
+        expect([body for _, _, body in responses]) == [b'serialized'] * 5
+        expect(app.root.serialized.concurrency.stats()['accepted']) == 5
+
+
+class MetricsSiteRoot(CompressionSiteRoot):
+    @expose(contentType='text/html; charset=utf-8', methods=['GET'])
+    def get_only(self):
+        return 'GET'
+
+    @expose(contentType='text/html; charset=utf-8')
+    async def async_html(self):
+        return 'async'
+
+
+def metricValue(exposition, name, **labels):
+    prefix = name + '{' + ','.join('%s="%s"' % label for label in labels.items())
+    for line in exposition.splitlines():
+        if line.startswith(prefix):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class MetricsTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=MetricsSiteRoot(), urls=None, globals=globals(), 
+                          compression=webapp.ResponseCompression(minSize=0), metrics=True)
+        testApp = TestApp(app.wsgifunc())
+
+    def exposition(self):
+        res = testApp.get('/_metrics')
+        expect(res.header('Content-Type')) == 'text/plain; version=0.0.4; charset=utf-8'
+        return res.body.decode('utf-8')
+
+    @test("requests are counted per handler, method and status")
+    def _(self):
+        testApp.get('/html')
+        testApp.get('/html')
+        testApp.post('/get_only', status=405)
+        exposition = self.exposition()
+        expect(metricValue(exposition, 'webapp_requests_total', 
+                           handler='ContenTypeSiteRoot.html', method='GET', status='200')) == 2
+        expect(metricValue(exposition, 'webapp_requests_total', 
+                           handler='MetricsSiteRoot.get_only', method='POST', status='405')) == 1
+        expect(metricValue(exposition, 'webapp_requests_total', handler='unknown')) == None
+
+    @test("latencies are recorded per phase in histograms")
+    def _(self):
+        testApp.get('/json')
+        exposition = self.exposition()
+        for phase in ('routing', 'query', 'handler', 'compression', 'total'):
+            labels = {'handler': 'ContenTypeSiteRoot.json', 'phase': phase}
+            count = metricValue(exposition, 'webapp_request_duration_seconds_count', **labels)
+            expect(count) >= 1
+            expect('webapp_request_duration_seconds_bucket{handler="ContenTypeSiteRoot.json",phase="%s",'
+                   'le="+Inf"} %d' % (phase, count) in exposition) == True
+
+    @test("response sizes are recorded before and after compression")
+    def _(self):
+        testApp.get('/large_html', headers={'Accept-Encoding': 'gzip'})
+        exposition = self.exposition()
+        raw = metricValue(exposition, 'webapp_response_bytes_total', handler='CompressionSiteRoot.large_html', 
+                          stage='raw')
+        sent = metricValue(exposition, 'webapp_response_bytes_total', handler='CompressionSiteRoot.large_html', 
+                           stage='sent')
+        expect(raw) == 500
+        expect(sent) < raw
+
+    @test("requests handled on many threads are all counted")
+    def _(self):
+        wsgi = app.wsgifunc(native=True)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/image', 'QUERY_STRING': ''}
+        def requests():
+            for _ in range(50):
+                wsgi(dict(environ), lambda status, headers: None)
+        threads = [threading.Thread(target=requests) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(metricValue(self.exposition(), 'webapp_requests_total', 
+                           handler='CompressionSiteRoot.image', method='GET', status='200')) == 400
+
+    @test("async handlers served through ASGI are measured")
+    def _(self):
+        expect(callASGI(app.asgifunc(), '/async_html')[2]) == b'async'
+        expect(metricValue(self.exposition(), 'webapp_requests_total', 
+                           handler='MetricsSiteRoot.async_html', method='GET', status='200')) == 1
+
+    @test("metrics are not served if they are not enabled")
+    def _(self):
+        app = Application(root=MetricsSiteRoot(), urls=None, globals=globals())
+        expect(TestApp(app.wsgifunc()).get('/_metrics').body) == b'Missing Page: /_metrics'
+
+
+class CORSSiteRoot(Site):
+    def __init__(self):
+        self.calls = 0
+
+    @expose(contentType='text/html; charset=utf-8', enableCORS='*', corsMaxAge=600)
+    def public(self):
+        self.calls += 1
+        return 'public'
+
+    @expose(contentType='text/html; charset=utf-8', enableCORS=['https://a.example', 'https://b.example'],
+            methods=['GET'])
+    def partners(self):
+        self.calls += 1
+        return 'partners'
+
+    @expose(contentType='text/html; charset=utf-8', enableCORS=None)
+    def private(self):
+        self.calls += 1
+        return 'private'
+
+
+def callNative(path, method='GET', **headers):
+    '''Calls the native WSGI function of the application directly, OPTIONS responses have no content type
+    so they do not pass the checks of TestApp'''
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': ''}
+    environ.update(('HTTP_' + name.upper(), value) for name, value in headers.items())
+    response = []
+    body = b''.join(app.nativeWSGI(environ, lambda status, headers: response.extend((status, headers))))
+    return response[0], dict(response[1]), body
+
+
+class CORSTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=CORSSiteRoot(), urls=None, globals=globals())
+        testApp = TestApp(app.wsgifunc())
+
+    @test("preflights are answered with max age without calling the handler")
+    def _(_):
+        status, headers, body = callNative('/public', 'OPTIONS', origin='https://x.example',
+                                           access_control_request_method='GET')
+        expect(status) == '200 OK'
+        expect(headers['Access-Control-Allow-Origin']) == '*'
+        expect(headers['Access-Control-Max-Age']) == '600'
+        expect(set(headers['Allow'].split(', '))) == {'GET', 'POST', 'OPTIONS'}
+        expect(body) == b''
+        expect(app.root.calls) == 0
+
+        res = testApp.get('/public')
+        expect(res.header('Access-Control-Allow-Origin')) == '*'
+        expect(res.header('Access-Control-Max-Age', None)) == None
+
+    @test("origins in the allow list are echoed back")
+    def _(_):
+        for origin in ('https://a.example', 'https://b.example'):
+            res = testApp.get('/partners', headers={'Origin': origin})
+            expect(res.header('Access-Control-Allow-Origin')) == origin
+            expect(res.header('Vary')) == 'Origin'
+            expect(set(res.header('Access-Control-Allow-Methods').split(', '))) == {'GET', 'OPTIONS'}
+
+        res = testApp.get('/partners', headers={'Origin': 'https://c.example'})
+        expect(res.header('Access-Control-Allow-Origin', None)) == None
+        expect(res.header('Vary')) == 'Origin'
+
+    @test("handlers without CORS only send the Allow header")
+    def _(_):
+        _, headers, _ = callNative('/private', 'OPTIONS')
+        expect('Access-Control-Allow-Origin' in headers) == False
+        expect(set(headers['Allow'].split(', '))) == {'GET', 'POST', 'OPTIONS'}
+
+    @test("CORS headers are built once when the handler is exposed")
+    def _(_):
+        policy = CORSSiteRoot.public.cors
+        expect(policy.headers(None, preflight=True)) == policy.headers('https://x.example', preflight=True)
+        expect(policy.headers(None) is policy.headers(None)) == True
+
+
+    @test("invalid default max age is ignored with a warning")
+    def _(_):
+        previous = os.environ.get('WEBAPP_DEFAULT_CORS_MAX_AGE')
+        os.environ['WEBAPP_DEFAULT_CORS_MAX_AGE'] = '10m'
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                expect(webapp.defaultCORSMaxAge()) == None
+            expect(len(caught)) == 1
+            expect('WEBAPP_DEFAULT_CORS_MAX_AGE' in str(caught[0].message)) == True
+            os.environ['WEBAPP_DEFAULT_CORS_MAX_AGE'] = '60'
+            expect(webapp.defaultCORSMaxAge()) == 60
+        finally:
+            if previous is None:
+                del os.environ['WEBAPP_DEFAULT_CORS_MAX_AGE']
+            else:
+                os.environ['WEBAPP_DEFAULT_CORS_MAX_AGE'] = previous
+
+class CachingSiteRoot(Site):
+    def __init__(self):
+        self.calls = 0
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache(ttl=60))
+    def cached(self, a=None):
+        self.calls += 1
+        web.header('X-Call', str(self.calls))
+        return 'cached %s' % a
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache(ttl=60))
+    def ordered(self, sort=None, page=None):
+        self.calls += 1
+        return ','.join(sort) if isinstance(sort, list) else str(sort)
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache(ttl=0))
+    def expired(self):
+        self.calls += 1
+        return 'expired'
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache(maxBytes=20))
+    def small_cache(self, a=None):
+        self.calls += 1
+        return 'small %s' % a
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache(headers=['Accept-Language']))
+    def localized(self):
+        self.calls += 1
+        return web.ctx.env.get('HTTP_ACCEPT_LANGUAGE', '')
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache())
+    def session(self, private: bool=False):
+        self.calls += 1
+        if private:
+            web.header('Cache-Control', 'private, max-age=60')
+        else:
+            web.setcookie('session', 'secret%d' % self.calls)
+        return 'session'
+
+    @expose(contentType='text/html; charset=utf-8', cache=webapp.ResponseCache())
+    def slow(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return 'slow'
+
+
+class CachingTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=CachingSiteRoot(), urls=None, globals=globals())
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    def calls(self, url, **params):
+        root = app.root
+        before = root.calls
+        res = testApp.get(url, **params)
+        return res, root.calls - before
+
+    @test("cached responses are returned with their headers without calling the handler")
+    def _(self):
+        res, calls = self.calls('/cached?a=1&b=2')
+        expect(calls) == 1
+        expect(res.body) == b'cached 1'
+        res, calls = self.calls('/cached?b=2&a=1')
+        expect(calls) == 0
+        expect(res.body) == b'cached 1'
+        expect(res.header('X-Call')) == str(app.root.calls)
+        res, calls = self.calls('/cached?a=2')
+        expect(calls) == 1
+        expect(res.body) == b'cached 2'
+
+    @test("values of repeated keys keep their order in the cache key")
+    def _(self):
+        res, calls = self.calls('/ordered?sort=name&sort=date')
+        expect((res.body, calls)) == (b'name,date', 1)
+        res, calls = self.calls('/ordered?sort=date&sort=name')
+        expect((res.body, calls)) == (b'date,name', 1)
+        res, calls = self.calls('/ordered?page=2&sort=name&sort=date')
+        expect((res.body, calls)) == (b'name,date', 1)
+        res, calls = self.calls('/ordered?sort=name&page=2&sort=date')
+        expect((res.body, calls)) == (b'name,date', 0)
+
+    @test("responses setting cookies or private cache control are not cached")
+    def _(self):
+        res, calls = self.calls('/session')
+        expect(res.header('Set-Cookie').startswith('session=secret%d' % app.root.calls)) == True
+        res, calls = self.calls('/session')
+        expect(calls) == 1
+        expect(res.header('Set-Cookie').startswith('session=secret%d' % app.root.calls)) == True
+        expect(self.calls('/session?private=true')[1]) == 1
+        expect(self.calls('/session?private=true')[1]) == 1
+
+    @test("expired responses are computed again")
+    def _(self):
+        expect(self.calls('/expired')[1]) == 1
+        expect(self.calls('/expired')[1]) == 1
+
+    @test("least recently used responses are evicted when the cache is full")
+    def _(self):
+        cache = CachingSiteRoot.small_cache.responseCache
+        for a in range(10):
+            expect(self.calls('/small_cache?a=%d' % a)[1]) == 1
+        expect(cache.stats()['bytes']) <= 20
+        expect(cache.evictions) > 0
+        expect(self.calls('/small_cache?a=9')[1]) == 0
+        expect(self.calls('/small_cache?a=0')[1]) == 1
+
+    @test("selected request headers are part of the cache key")
+    def _(self):
+        expect(self.calls('/localized', headers={'Accept-Language': 'en'})[1]) == 1
+        expect(self.calls('/localized', headers={'Accept-Language': 'de'})[1]) == 1
+        res, calls = self.calls('/localized', headers={'Accept-Language': 'en'})
+        expect(calls) == 0
+        expect(res.body) == b'en'
+
+    @test("concurrent misses wait for a single handler call")
+    def _(self):
+        root = app.root
+        before = root.calls
+        bodies = []
+        def request():
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/slow', 'QUERY_STRING': ''}
+            bodies.append(b''.join(app.nativeWSGI(environ, lambda status, headers: None)))
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(root.calls - before) == 1
+        expect(bodies) == [b'slow'] * 5
+        expect(CachingSiteRoot.slow.responseCache.stats()['shared']) == 4
+
+
+def documentVersion(self, id=None):
+    return 'v%s' % id, datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+class ETagSiteRoot(Site):
+    def __init__(self):
+        self.calls = 0
+
+    @expose(contentType='text/html; charset=utf-8', etag=True)
+    def hashed(self):
+        self.calls += 1
+        return 'HTML ' * 100
+
+    @expose(contentType='text/html; charset=utf-8', version=documentVersion)
+    def versioned(self, id=None):
+        self.calls += 1
+        return 'document %s ' % id * 100
+
+    @expose(contentType='text/html; charset=utf-8', etag=True, cache=webapp.ResponseCache())
+    def cached(self):
+        self.calls += 1
+        return 'cached'
+
+
+class ETagTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=ETagSiteRoot(), urls=None, globals=globals(),
+                          compression=webapp.ResponseCompression(minSize=100))
+        middleware = []
+        
+        testApp = TestApp(app.wsgifunc(*middleware))
+
+    @classmethod
+    def tearDownClass(cls):
+        pass 
+
+    @test("ETag is computed from the body and matching requests return not modified")
+    def _(_):
+        res = testApp.get('/hashed')
+        etag = res.header('ETag')
+        expect(etag).should.startswith('"')
+        res = testApp.get('/hashed', headers={'If-None-Match': etag}, status=304)
+        expect(res.status) == 304
+        expect(res.body) == b''
+        res = testApp.get('/hashed', headers={'If-None-Match': '"other"'})
+        expect(res.status) == 200
+
+    @test("ETag is different for each content encoding")
+    def _(_):
+        plain = testApp.get('/hashed').header('ETag')
+        zipped = testApp.get('/hashed', headers={'Accept-Encoding': 'gzip'}).header('ETag')
+        expect(plain) != zipped
+        versioned = testApp.get('/versioned?id=1', headers={'Accept-Encoding': 'gzip'})
+        expect(versioned.header('ETag')) == '"v1-gzip"'
+
+    @test("version token answers not modified without calling the handler")
+    def _(_):
+        root = app.root
+        res = testApp.get('/versioned?id=1')
+        expect(res.header('ETag')) == '"v1"'
+        expect(res.header('Last-Modified')) == 'Wed, 01 Jan 2020 00:00:00 GMT'
+        before = root.calls
+        res = testApp.get('/versioned?id=1', headers={'If-None-Match': '"v1"'}, status=304)
+        expect(res.status) == 304
+        res = testApp.get('/versioned?id=1', headers={'If-Modified-Since': 'Thu, 02 Jan 2020 00:00:00 GMT'}, 
+                          status=304)
+        expect(res.status) == 304
+        expect(root.calls) == before
+        res = testApp.get('/versioned?id=2', headers={'If-None-Match': '"v1"'})
+        expect(res.status) == 200
+        expect(root.calls) == before + 1
+
+    @test("cached responses keep their ETag")
+    def _(_):
+        etag = testApp.get('/cached').header('ETag')
+        res = testApp.get('/cached', headers={'If-None-Match': etag}, status=304)
+        expect(res.status) == 304
+
+    @test("native WSGI function returns not modified without content")
+    def _(_):
+        nativeApp = TestApp(app.wsgifunc(native=True))
+        etag = nativeApp.get('/hashed').header('ETag')
+        res = nativeApp.get('/hashed', headers={'If-None-Match': etag}, status=304)
+        expect(res.body) == b''
+
+
+class BenchmarkTest:
+    @test("benchmark suite runs all the scenarios and stores the results")
+    def _(_):
+        rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+        subprocess.check_output([sys.executable, os.path.join(rootDir, 'benchmark', 'webapp_benchmark.py'),
+                                 '--requests', '3', '--warmup', '0', '--output', output])
+        with open(output) as inFile:
+            results = json.load(inFile)['results']
+        expect(len(results)) == 18
+        expect(set(result['status'] for result in results)) == {'200 OK'}
+        expect(min(result['requestsPerSecond'] for result in results)) > 0
+
+
+PREFORK_SCRIPT = '''
+import os, sys, time
+sys.path.insert(0, '.')
+from webapp import Application, Site, expose
+
+class PidSiteRoot(Site):
+    @expose(contentType='text/plain; charset=utf-8')
+    def pid(self):
+        return str(os.getpid())
+
+    @expose(contentType='text/plain; charset=utf-8')
+    def slow(self, delay: float=0):
+        time.sleep(delay)
+        return str(os.getpid())
+
+Application(root=PidSiteRoot(), urls=None, globals={}).run('127.0.0.1', 0, native=True, workers=%d, 
+                                                            threads=2, maxRequests=%d)
+'''
+
+
+class PreforkServerTest:
+    def startServer(self, workers, maxRequests=0, cwd=None, stderr=subprocess.DEVNULL):
+        rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [rootDir, os.environ.get('PYTHONPATH')])))
+        server = subprocess.Popen([sys.executable, '-c', PREFORK_SCRIPT % (workers, maxRequests)], cwd=cwd, env=env,
+                                  stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+        url = server.stdout.readline().split()[0]
+        return server, url
+
+    def stopServer(self, server):
+        server.send_signal(signal.SIGTERM)
+        return server.wait(timeout=30)
+
+    def workerPids(self, url, count):
+        return [urllib.request.urlopen(url + 'pid').read() for _ in range(count)]
+
+    def distinctPids(self, url, count, attempts=500):
+        '''Requests the pid until count different workers answered'''
+        pids = set()
+        for _ in range(attempts):
+            pids.update(self.workerPids(url, 1))
+            if len(pids) >= count:
+                break
+        return pids
+
+    def alive(self, pid):
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    @test("pre-fork server serves the requests from worker processes")
+    @skip.when(not hasattr(os, 'fork'), 'Pre-fork server requires fork')
+    def _(self):
+        server, url = self.startServer(workers=2)
+        try:
+            pids = self.distinctPids(url, 2)
+            expect(len(pids)) == 2
+            expect(str(server.pid).encode() in pids) == False
+        finally:
+            expect(self.stopServer(server)) == 0
+
+    @test("workers serve the static directory and log the requests like the single process server")
+    @skip.when(not hasattr(os, 'fork'), 'Pre-fork server requires fork')
+    def _(self):
+        directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(directory, 'static'))
+        with open(os.path.join(directory, 'static', 'hello.txt'), 'wb') as outFile:
+            outFile.write(b'hello')
+        server, url = self.startServer(workers=1, cwd=directory, stderr=subprocess.PIPE)
+        try:
+            expect(urllib.request.urlopen(url + 'static/hello.txt').read()) == b'hello'
+            self.workerPids(url, 1)
+        finally:
+            expect(self.stopServer(server)) == 0
+            shutil.rmtree(directory)
+        log = server.stderr.read()
+        expect('GET /pid' in log) == True
+        expect('GET /static/hello.txt' in log) == True
+
+    @test("workers are replaced on SIGHUP without failing requests")
+    @skip.when(not hasattr(os, 'fork'), 'Pre-fork server requires fork')
+    def _(self):
+        server, url = self.startServer(workers=2)
+        try:
+            oldPids = self.distinctPids(url, 2)
+            expect(len(oldPids)) == 2
+            server.send_signal(signal.SIGHUP)
+            failures = []
+            newPids = set()
+            deadline = time.monotonic() + 20
+            while time.monotonic() < deadline and (len(newPids) < 2 or any(map(self.alive, oldPids))):
+                try:
+                    pid = self.workerPids(url, 1)[0]
+                except OSError as err:
+                    failures.append(err)
+                    continue
+                if pid not in oldPids:
+                    newPids.add(pid)
+            expect(failures) == []
+            expect(len(newPids)) == 2
+            expect(any(map(self.alive, oldPids))) == False
+            expect(set(self.workerPids(url, 10)) & oldPids) == set()
+        finally:
+            expect(self.stopServer(server)) == 0
+
+    @test("workers finish the requests in progress on SIGTERM")
+    @skip.when(not hasattr(os, 'fork'), 'Pre-fork server requires fork')
+    def _(self):
+        server, url = self.startServer(workers=1)
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(urllib.request.urlopen(url + 'slow?delay=1').read()))
+        try:
+            pid = self.workerPids(url, 1)[0]
+            thread.start()
+            time.sleep(0.3)
+        finally:
+            expect(self.stopServer(server)) == 0
+        thread.join()
+        expect(responses) == [pid]
+        expect(self.alive(pid)) == False
+
+    @test("workers are recycled after the maximum number of requests")
+    @skip.when(not hasattr(os, 'fork'), 'Pre-fork server requires fork')
+    def _(self):
+        server, url = self.startServer(workers=1, maxRequests=2)
+        try:
+            #A stopping worker still serves the connection it accepted last, the others wait for the new one
+            pids = self.workerPids(url, 9)
+            expect(len(pids)) == 9
+            expect(len(set(pids))) >= 3
+        finally:
+            expect(self.stopServer(server)) == 0
+
+
+class SharedCacheSiteRoot(Site):
+    def __init__(self, cache):
+        self.calls = 0
+
+        @expose(contentType='text/html; charset=utf-8', cache=cache)
+        def report(year: int=2020):
+            self.calls += 1
+            web.header('X-Call', str(self.calls))
+            return 'report %d ' % year * 200
+        self.report = report
+
+
+class SharedCacheTest:
+    @test("shared cache serves the cached responses of the exposed handlers")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        cache = SharedResponseCache(ttl=60, size=64 * 1024, blockSize=1024)
+        root = SharedCacheSiteRoot(cache)
+        cacheApp = TestApp(Application(root=root, urls=None, globals=globals(), compression=True).wsgifunc())
+        first = cacheApp.get('/report?year=2021')
+        second = cacheApp.get('/report?year=2021')
+        expect(root.calls) == 1
+        expect(second.body) == first.body
+        expect(second.header('X-Call')) == '1'
+        zipped = cacheApp.get('/report?year=2021', headers={'Accept-Encoding': 'gzip'})
+        expect(unzipIt(zipped.body)) == first.body
+        expect(root.calls) == 2
+        expect(cache.stats()['entries']) == 2
+        expect(cache.stats()['hits']) == 1
+        cache.close()
+
+    @test("responses setting cookies or private cache control are not stored")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        cache = SharedResponseCache(ttl=60, size=16 * 1024, blockSize=1024)
+        cache.set('cookie', webapp.CachedResponse(b'value', [('Set-Cookie', 'session=secret')], 0))
+        cache.set('private', webapp.CachedResponse(b'value', [('Cache-Control', 'private')], 0))
+        cache.set('noStore', webapp.CachedResponse(b'value', [('cache-control', 'No-Store')], 0))
+        cache.set('public', webapp.CachedResponse(b'value', [('Cache-Control', 'public, max-age=60')], 0))
+        expect(cache.get('cookie')) == None
+        expect(cache.get('private')) == None
+        expect(cache.get('noStore')) == None
+        expect(cache.get('public').body) == b'value'
+        expect(cache.stats()['stores']) == 1
+        cache.close()
+
+    @test("entries stored by a forked process are shared")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        cache = SharedResponseCache(ttl=60, size=64 * 1024, blockSize=1024)
+        pid = os.fork()
+        if pid == 0:
+            cache.set(('/child', ''), webapp.CachedResponse(b'child' * 1000, [('X-Process', 'child')], 0))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        entry = cache.get(('/child', ''))
+        expect(entry.body) == b'child' * 1000
+        expect(entry.headers) == [('X-Process', 'child')]
+
+        #Processes opening the same file share it as well
+        path = os.path.join(tempfile.mkdtemp(), 'cache')
+        first = SharedResponseCache(size=16 * 1024, blockSize=1024, path=path)
+        first.set('key', webapp.CachedResponse(b'value', [], 0))
+        second = SharedResponseCache(size=16 * 1024, blockSize=1024, path=path)
+        expect(second.get('key').body) == b'value'
+        for sharedCache in (cache, first, second):
+            sharedCache.close()
+        shutil.rmtree(os.path.dirname(path))
+
+    @test("forked processes do not inherit the thread lock of the parent")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        cache = SharedResponseCache(ttl=60, size=16 * 1024, blockSize=1024)
+        with cache._threadLock:
+            pid = os.fork()
+            if pid == 0:
+                signal.alarm(5)
+                cache.set('child', webapp.CachedResponse(b'child', [], 0))
+                os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        expect(status) == 0
+        expect(cache.get('child').body) == b'child'
+        cache.close()
+
+    @test("least recently used entries are evicted and expired entries are not returned")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        cache = SharedResponseCache(ttl=60, size=4 * 1024, blockSize=1024, slots=16)
+        for key in 'abcd':
+            cache.set(key, webapp.CachedResponse(key.encode() * 500, [], 0))
+        expect(cache.get('a').body) == b'a' * 500
+        cache.set('e', webapp.CachedResponse(b'e' * 500, [], 0))
+        expect(cache.get('a') is not None) == True
+        expect(cache.get('e') is not None) == True
+        expect(cache.stats()['evictions']) == 1
+        #Too large for the cache
+        cache.set('large', webapp.CachedResponse(b'x' * 5000, [], 0))
+        expect(cache.get('large')) == None
+
+        cache.ttl = 0.05
+        cache.set('short', webapp.CachedResponse(b'short', [], 0))
+        time.sleep(0.1)
+        expect(cache.get('short')) == None
+        cache.close()
+
+    @test("hash table stays consistent under random updates and evictions")
+    @skip.when(not hasattr(os, 'fork'), 'Shared cache requires a Unix system')
+    def _(_):
+        from webapp.sharedcache import SharedResponseCache
+        import random
+        cache = SharedResponseCache(ttl=60, size=32 * 256, blockSize=256, slots=24)
+        generator = random.Random(7)
+        latest = {}
+        for step in range(3000):
+            key = 'key%d' % generator.randrange(60)
+            if generator.random() < 0.5:
+                value = ('%s-%d ' % (key, step)).encode() * generator.randrange(1, 60)
+                cache.set(key, webapp.CachedResponse(value, [('Step', str(step))], 0))
+                latest[key] = value
+            else:
+                entry = cache.get(key)
+                if entry is not None:
+                    expect(entry.body == latest[key]) == True
+        stats = cache.stats()
+        expect(stats['entries']) <= 18
+        expect(stats['bytes']) <= 32 * 256
+        cache.clear()
+        expect(cache.stats()['entries']) == 0
+        cache.close()
+
+
+class ZipStreamingTest:
+    @test("zipIt and unzipIt work on the whole content")
+    def _(_):
+        expect(unzipIt(zipIt('content'))) == b'content'
+        expect(unzipIt(zipIt(b'content'))) == b'content'
+
+    @test("chunks can be zipped and unzipped as streams")
+    def _(_):
+        content = [('line %d\n' % i) for i in range(1000)]
+        zipped = b''.join(webapp.zipChunks(content))
+        pieces = [zipped[i:i + 100] for i in range(0, len(zipped), 100)]
+        expect(b''.join(webapp.unzipChunks(pieces))) == ''.join(content).encode('utf-8')
+
+    @test("concatenated gzip members are unzipped together")
+    def _(_):
+        expect(unzipIt(zipIt('first ') + zipIt('second'))) == b'first second'
+
+    @test("unzipping stops when the content exceeds the maximum size")
+    def _(_):
+        zipped = zipIt('0' * 1000000)
+        expect(lambda: unzipIt(zipped, maxSize=1000)).raises(webapp.DecompressionLimitError)
+        expect(len(unzipIt(zipped, maxSize=1000000))) == 1000000
+
+    @test("truncated content raises an error")
+    def _(_):
+        expect(lambda: unzipIt(zipIt('content')[:-4])).raises(EOFError)
+
+
+class Color(Enum):
+    RED = 'red'
+    GREEN = 'green'
+
+
 class ParameterSiteRoot(Site):
     def __init__(self):
         pass 
@@ -378,6 +2301,19 @@ class ParameterSiteRoot(Site):
     def page_with_parameter_existince_check(self, a=None):
         return str(a is not None)
 
+    @expose(contentType='text/html; charset=utf-8')
+    def page_with_post_check(self, a=None, _post=False):
+        return '%s %s' % (a, _post)
+
+    @expose(contentType='text/html; charset=utf-8')
+    def page_with_typed_parameters(self, count: int = 0, ratio: float = 1.0, flag: bool = False, 
+                                   ids: List[int] = None, color: Optional[Color] = None):
+        return repr((count, ratio, flag, ids, color))
+
+    @expose(contentType='text/html; charset=utf-8')
+    def page_raising_type_error(self):
+        raise TypeError('raised by the handler')
+
 class ParameterMappingTest:
     @classmethod
     def setUpClass(cls):
@@ -442,6 +2378,59 @@ class ParameterMappingTest:
         expect(res.status) == 200
         expect(res.body) == b'False'
 
+    @test("Parameters which are not in the method signature are not passed")
+    def _(_):
+        res = testApp.get('/page_with_parameter_existince_check?b=B')
+        expect(res.status) == 200
+        expect(res.body) == b'False'
+
+    @test("_post keyword is passed only to the handlers accepting it")
+    def _(_):
+        expect(testApp.get('/page_with_post_check?a=A').body) == b'A False'
+        handler = ParameterSiteRoot().page_with_post_check
+        expect(handler.callPlan.arguments(handler, {'a': 'A'}, post=True)) == {'a': 'A', '_post': True}
+        handler = ParameterSiteRoot().page_with_parameters
+        expect(handler.callPlan.arguments(handler, {'a': 'A'}, post=True)) == {'a': 'A'}
+
+    @test("Type errors raised by the handler are not hidden")
+    def _(_):
+        res = testApp.get('/page_raising_type_error', status=500, extra_environ={'wsgi.errors': io.StringIO()})
+        expect(res.status) == 500
+
+    @test("Annotated parameters are converted to the annotated types")
+    def _(_):
+        res = testApp.get('/page_with_typed_parameters?count=3&ratio=0.5&flag&ids=1&ids=2&color=red')
+        expect(res.status) == 200
+        expect(res.body) == b"(3, 0.5, True, [1, 2], <Color.RED: 'red'>)"
+
+        res = testApp.get('/page_with_typed_parameters?flag=off&ids=7&color=GREEN')
+        expect(res.body) == b"(0, 1.0, False, [7], <Color.GREEN: 'green'>)"
+
+    @test("Invalid values for annotated parameters return bad request")
+    def _(_):
+        expect(testApp.get('/page_with_typed_parameters?count=three', status=400).status) == 400
+        expect(testApp.get('/page_with_typed_parameters?count', status=400).status) == 400
+        expect(testApp.get('/page_with_typed_parameters?flag=maybe', status=400).status) == 400
+        expect(testApp.get('/page_with_typed_parameters?ids=1&ids=x', status=400).status) == 400
+        expect(testApp.get('/page_with_typed_parameters?color=blue', status=400).status) == 400
+
+    @test("Queries exceeding the parameter limit return bad request")
+    def _(_):
+        query = '&'.join('p%d=%d' % (i, i) for i in range(webapp.QUERY_MAX_PARAMS + 1))
+        res = testApp.get('/page_without_params?' + query, status=400)
+        expect(res.status) == 400
+
+    @test("Call plan of a function knows the accepted parameters")
+    def _(_):
+        def function(a, b=None, *, c=None):
+            pass
+        plan = webapp.CallPlan(function)
+        expect(plan.names) == frozenset(['a', 'b', 'c'])
+        expect(plan.boundNames) == frozenset(['b', 'c'])
+        expect(plan.acceptsAll) == False
+        expect(plan.wantsPost) == False
+        expect(plan.arguments(function, {'a': 1, 'd': 4}, post=True)) == {'a': 1}
+
     @test("Calling a page with parameter without the parameter raises error")
     @skip.when(True, 'Did not decide how to handle the error yet')
     def _(_):
@@ -449,6 +2438,101 @@ class ParameterMappingTest:
         expect(res.status) == 200
         expect(res.body) == b'A'
 
+class ProfiledReports(Site):
+    @expose(contentType='text/html; charset=utf-8')
+    def summary(self, rows: int = 100):
+        return ','.join(buildReportRows(rows))
+
+
+def buildReportRows(rows):
+    return ['row %d' % row for row in range(rows)]
+
+
+class ProfilingSiteRoot(Site):
+    def __init__(self):
+        self.reports = ProfiledReports()
+
+    @expose(contentType='text/html; charset=utf-8')
+    def other(self):
+        return 'other'
+
+
+class ProfilingTest:
+    @classmethod
+    def setUpClass(cls):
+        global testApp 
+        global app
+
+        app = Application(root=ProfilingSiteRoot(), urls=None, globals=globals(), 
+                          profiler=webapp.Profiler(allow=webapp.loopbackOnly))
+        testApp = TestApp(app.wsgifunc(), extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+
+    def setUp(self):
+        app.Index.profiler.disable()
+        app.Index.profiler.reset()
+
+    @test("requests are not profiled until the profiler is enabled")
+    def _(self):
+        testApp.get('/reports/summary')
+        expect(app.Index.profiler.profiled) == 0
+        expect(testApp.get('/_profile').body.startswith(b'prefix: None, fraction: 0')) == True
+
+    @test("profiler can only be changed over HTTP by the allowed requests")
+    def _(self):
+        testApp.post('/_profile?prefix=/&fraction=1&memory=true', extra_environ={'REMOTE_ADDR': '10.0.0.1'}, 
+                     status=403)
+        defaultApp = TestApp(Application(root=ProfilingSiteRoot(), urls=None, globals=globals(), 
+                                         profiler=True).wsgifunc(), extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+        defaultApp.post('/_profile?prefix=/&fraction=1&memory=true', status=403)
+        expect(app.Index.profiler.prefix) == None
+        expect(tracemalloc.is_tracing()) == False
+
+    @test("sampled requests below the prefix are profiled and aggregated")
+    def _(self):
+        testApp.post('/_profile?prefix=/reports&fraction=1')
+        testApp.get('/reports/summary')
+        testApp.get('/reports/summary?rows=10')
+        testApp.get('/other')
+        testApp.get('/reportsother', status='*')
+        profiler = app.Index.profiler
+        expect(profiler.profiled) == 2
+
+        text = testApp.get('/_profile').body.decode('utf-8')
+        expect('profiled requests: 2' in text) == True
+        expect('(buildReportRows)' in text) == True
+
+        collapsed = testApp.get('/_profile?format=collapsed').body.decode('utf-8')
+        expect('(summary);webapp_test.py:' in collapsed) == True
+        expect(collapsed.splitlines()[0].rsplit(' ', 1)[1].isdigit()) == True
+
+        res = testApp.get('/_profile?format=pstats')
+        expect(res.header('Content-Type')) == 'application/octet-stream'
+        functions = [name for _, _, name in marshal.loads(res.body)]
+        expect(functions.count('buildReportRows')) == 1
+
+        testApp.post('/_profile?disable')
+        testApp.get('/reports/summary')
+        expect(profiler.profiled) == 2
+
+    @test("allocations of the sampled requests are captured with tracemalloc")
+    def _(self):
+        testApp.post('/_profile?prefix=/reports/summary&fraction=1&memory=true')
+        expect(tracemalloc.is_tracing()) == True
+        testApp.get('/reports/summary?rows=10000')
+        memory = testApp.get('/_profile?format=memory').body.decode('utf-8')
+        expect('webapp_test.py' in memory) == True
+
+        testApp.post('/_profile?disable&reset')
+        expect(tracemalloc.is_tracing()) == False
+        expect(app.Index.profiler.profiled) == 0
+
+    @test("invalid profiler parameters are rejected")
+    def _(self):
+        testApp.post('/_profile?prefix=/reports&fraction=some', status=400)
+        testApp.get('/_profile?' + '&'.join('p%d=1' % i for i in range(1001)), status=400)
+        expect(app.Index.profiler.prefix) == None
+
+
 class PostHandlingSiteRoot(Site):
     def __init__(self):
         pass 
@@ -462,6 +2546,21 @@ class PostHandlingSiteRoot(Site):
     def assert_post_request(self, **query):
         assert '_post' in query 
         assert query['_post']
+
+    @expose(contentType='text/plain; charset=utf-8', maxBodySize=64 * 1024)
+    def upload(self, _body):
+        digest = hashlib.sha1()
+        for chunk in _body:
+            digest.update(chunk)
+        #Content type of the POST responses is set by the handlers
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        return '%d %s' % (_body.size, digest.hexdigest())
+
+    @expose(contentType='text/plain; charset=utf-8')
+    def spooled(self, _body, name: str=''):
+        spooled = _body.spool()
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        return '%s %s %d' % (name, spooled.read(5).decode('utf-8'), _body.size)
         
     
 
@@ -494,6 +2593,48 @@ class PostHandlingTest:
             res = testApp.post('/assert_post_request')
         
         expect(caller).not_raise()
+
+    @test("POST handlers with a _body parameter can stream the request body")
+    def _(_):
+        content = os.urandom(50000)
+        res = testApp.post('/upload', content, headers={'Content-Type': 'application/octet-stream'})
+        expect(res.body.decode('utf-8')) == '50000 %s' % hashlib.sha1(content).hexdigest()
+
+        res = testApp.post('/spooled?name=query', b'hello world')
+        expect(res.body) == b'query hello 11'
+
+    @test("reserved parameters can not be given in the query")
+    def _(_):
+        testApp.get('/upload?_body=abc', status=400)
+        testApp.get('/spooled?_post', status=400)
+        testApp.post('/upload?_body=abc', b'body', status=400)
+        handler = PostHandlingSiteRoot().assert_get_request
+        expect(handler.callPlan.arguments(handler, {'a': 'A', '_post': True, '_body': 'abc'})) == {'a': 'A'}
+
+    @test("gzip encoded request bodies are decoded incrementally")
+    def _(_):
+        content = b'compressed body ' * 4000
+        res = testApp.post('/upload', zipIt(content), headers={'Content-Encoding': 'gzip'})
+        expect(res.body.decode('utf-8')) == '%d %s' % (len(content), hashlib.sha1(content).hexdigest())
+
+    @test("bodies over the limit of the handler are rejected with 413")
+    def _(_):
+        testApp.post('/upload', b'a' * (64 * 1024 + 1), status=413)
+        #Compressed content is small, it is rejected while it is decoded
+        testApp.post('/upload', zipIt(b'a' * 1000000), headers={'Content-Encoding': 'gzip'}, status=413)
+
+    @test("bodies which can not be decoded are rejected")
+    def _(_):
+        testApp.post('/upload', b'not gzip', headers={'Content-Encoding': 'gzip'}, status=400)
+        testApp.post('/upload', b'brotli', headers={'Content-Encoding': 'br'}, status=415)
+
+    @test("request bodies can be read in pieces")
+    def _(_):
+        body = webapp.RequestBody({'wsgi.input': io.BytesIO(b'abcdefgh'), 'CONTENT_LENGTH': '6'})
+        expect(body.read(4)) == b'abcd'
+        expect(body.read(4)) == b'ef'
+        expect(body.read()) == b''
+        expect(body.size) == 6
         
 
 class QueryParsingTest:
@@ -555,6 +2696,30 @@ class QueryParsingTest:
     def _(_):
         expect(parseQuery("?a=A &b=B "))  == web.Storage(a='A ', b='B')
 
+    @test("plus signs are decoded as white spaces")
+    def _(_):
+        expect(parseQuery("?a=A+B%2BC"))  == web.Storage(a='A B+C')
+
+    @test("keys are unquoted as well as the values")
+    def _(_):
+        expect(parseQuery("?first%20name=A&last+name=B"))  == web.Storage({'first name': 'A', 'last name': 'B'})
+
+    @test("lazy parsing returns a read only mapping with the same content")
+    def _(_):
+        query = parseQuery("?a=A%20B&a&b=B&c", lazy=True)
+        expect(query) == web.Storage(a=['A B', True], b='B', c=True)
+        expect(query.b) == 'B'
+        expect('c' in query) == True
+        def assign():
+            query['d'] = 'D'
+        expect(assign).raises(TypeError)
+
+    @test("queries exceeding the limits are rejected")
+    def _(_):
+        expect(lambda: parseQuery("?a=A&b=B&c=C", maxParams=2)).raises(webapp.QueryLimitError)
+        expect(lambda: parseQuery("?a=ABCDEF", maxLength=4)).raises(webapp.QueryLimitError)
+        expect(parseQuery("?a=A&b=B", maxParams=2)) == web.Storage(a='A', b='B')
+
 if __name__ == '__main__':
     #unittest.main()
     runTests()
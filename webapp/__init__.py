@@ -36,11 +36,40 @@ __author__ = [
 __license__ = "MIT License"
 
 import os
-from inspect import signature 
-from typing import List
-from io import BytesIO
-import gzip
-from urllib.parse import unquote
+import sys
+import stat as statModule
+import asyncio
+import threading
+import time
+import weakref
+from time import perf_counter
+from bisect import bisect_left
+import traceback
+import warnings
+import json
+import base64
+import importlib
+import mimetypes
+import random
+import marshal
+import cProfile
+import pstats
+import tracemalloc
+from inspect import signature, Parameter, iscoroutinefunction
+from typing import List, Union, Any, get_type_hints
+from enum import Enum
+from abc import ABC, abstractmethod
+import zlib
+from urllib.parse import unquote_plus, urlencode
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from tempfile import SpooledTemporaryFile
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+from xml.sax.saxutils import escape as xmlEscape
 
 import web
 
@@ -49,117 +78,2037 @@ def defaultCORSOption():
     envVar = os.environ.get("WEBAPP_DEFAULT_CORS_OPTION", "")
     return envVar if envVar != "" else None
 
+def defaultCORSMaxAge():
+    envVar = os.environ.get("WEBAPP_DEFAULT_CORS_MAX_AGE", "")
+    if envVar == "":
+        return None
+    try:
+        return int(envVar)
+    except ValueError:
+        #Evaluated as a default argument, an exception would make the module fail to import
+        warnings.warn("Ignoring WEBAPP_DEFAULT_CORS_MAX_AGE, %r is not a number of seconds" % envVar)
+        return None
+
+
+TRUE_VALUES = frozenset(('1', 'true', 'yes', 'on'))
+FALSE_VALUES = frozenset(('0', 'false', 'no', 'off', ''))
+
+
+def _singleValue(value):
+    #Repeated keys are parsed as lists, for a single value we use the last one
+    if isinstance(value, list):
+        value = value[-1]
+    if value is True:
+        raise ValueError('value is missing')
+    return value
+
+def _boolConverter(value):
+    if isinstance(value, list):
+        value = value[-1]
+    if value is True:
+        return True
+    value = value.lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError('%s is not a boolean' % value)
+
+def _enumConverter(cls):
+    def convert(value):
+        value = _singleValue(value)
+        try:
+            return cls(value)
+        except ValueError:
+            pass
+        try:
+            return cls[value]
+        except KeyError:
+            raise ValueError('%s is not a valid %s' % (value, cls.__name__))
+    return convert
+
+def _scalarConverter(cls):
+    def convert(value):
+        return cls(_singleValue(value))
+    return convert
+
+def _listConverter(itemConverter):
+    def convert(value):
+        if not isinstance(value, list):
+            value = [value]
+        if itemConverter is None:
+            return value
+        return [itemConverter(item) for item in value]
+    return convert
+
+def queryConverter(annotation):
+    '''Returns a function converting a parsed query value to the given annotation
+
+    None is returned if the value should be passed as it is parsed.
+    '''
+    if annotation is Parameter.empty or annotation is str or annotation is Any:
+        return None
+
+    origin = getattr(annotation, '__origin__', None)
+    if origin is Union:
+        args = [arg for arg in annotation.__args__ if arg is not type(None)]
+        return queryConverter(args[0]) if len(args) == 1 else None
+    if origin in (list, List) or annotation is list:
+        args = getattr(annotation, '__args__', None) or [Parameter.empty]
+        return _listConverter(queryConverter(args[0]))
+
+    if annotation is bool:
+        return _boolConverter
+    if isinstance(annotation, type):
+        if issubclass(annotation, Enum):
+            return _enumConverter(annotation)
+        return _scalarConverter(annotation)
+    return None
+
+
+#Handler parameters filled by webapp, they can not be given in the query
+RESERVED_PARAMETERS = ('_post', '_body')
+
+
+class CallPlan:
+    '''Describes which query parameters are passed to an exposed function
+
+    It is built once by expose from the signature of the function. The first positional parameter is
+    not filled from the query if the handler is a bound method since it receives the site object.
+    Parameters with type annotations are converted from the parsed query, invalid values are 
+    reported as bad request.
+    '''
+    def __init__(self, func):
+        parameters = list(signature(func).parameters.values())
+        try:
+            annotations = get_type_hints(func)
+        except Exception:
+            annotations = {}
+
+        self.acceptsAll = any(p.kind == Parameter.VAR_KEYWORD for p in parameters)
+        self.names = frozenset(p.name for p in parameters 
+                               if p.kind in (Parameter.POSITIONAL_OR_KEYWORD, Parameter.KEYWORD_ONLY))
+        self.boundNames = self.names
+        if parameters and parameters[0].kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD):
+            self.boundNames = self.names - {parameters[0].name}
+        self.wantsPost = self.acceptsAll or '_post' in self.names
+        self.wantsBody = '_body' in self.names
+
+        self.converters = {}
+        for name in self.names.difference(RESERVED_PARAMETERS):
+            converter = queryConverter(annotations.get(name, Parameter.empty))
+            if converter is not None:
+                self.converters[name] = converter
+
+    def arguments(self, nodeHandler, query, post=False, body=None):
+        if self.acceptsAll:
+            namedArgs = dict(query)
+        else:
+            names = self.boundNames if hasattr(nodeHandler, '__self__') else self.names
+            namedArgs = {name: query[name] for name in names if name in query}
+        for name in RESERVED_PARAMETERS:
+            namedArgs.pop(name, None)
+
+        for name, converter in self.converters.items():
+            if name in namedArgs:
+                try:
+                    namedArgs[name] = converter(namedArgs[name])
+                except (ValueError, TypeError, ArithmeticError):
+                    raise web.badrequest("Invalid value for parameter '%s'" % name)
+
+        if post and self.wantsPost:
+            namedArgs['_post'] = True
+        if body is not None:
+            namedArgs['_body'] = body
+        return namedArgs
+
+
+CORS_ALLOW_HEADERS = 'Authorization, Content-Type'
+
+
+class CORSPolicy:
+    '''CORS and Allow headers of an exposed handler, the header blocks are built once by expose
+
+    enableCORS is either a single origin (or *) sent with every response, or a list of allowed origins.
+    With a list, the origin of the request is echoed back if it is in the list and the responses vary
+    on the Origin header. Preflight responses carry Access-Control-Max-Age if maxAge is given.
+    '''
+    def __init__(self, enableCORS, methods, maxAge=None):
+        self.methods = ", ".join(methods)
+        self.allow = ('Allow', self.methods)
+        self.enabled = enableCORS is not None
+
+        common = [('Access-Control-Allow-Methods', self.methods),
+                  ('Access-Control-Allow-Headers', CORS_ALLOW_HEADERS)]
+        maxAgeHeaders = [('Access-Control-Max-Age', str(maxAge))] if maxAge is not None else []
+        if enableCORS is None:
+            self.origins = None
+            self.blocks = ((), ())
+        elif isinstance(enableCORS, str):
+            self.origins = None
+            headers = [('Access-Control-Allow-Origin', enableCORS)] + common
+            self.blocks = (tuple(headers), tuple(headers + maxAgeHeaders))
+        else:
+            self.origins = frozenset(enableCORS)
+            vary = [('Vary', 'Origin')]
+            self.blocks = (tuple(vary), tuple(vary))
+            self.originBlocks = {}
+            for origin in self.origins:
+                headers = [('Access-Control-Allow-Origin', origin)] + common + vary
+                self.originBlocks[origin] = (tuple(headers), tuple(headers + maxAgeHeaders))
+
+    def headers(self, origin=None, preflight=False):
+        '''Returns the CORS headers of a response to the given origin'''
+        if self.origins is None:
+            return self.blocks[preflight]
+        return self.originBlocks.get(origin, self.blocks)[preflight]
+
 
 class expose:
     def __init__(self, contentType: str, 
                  contentEncoding: str=None, 
-                 enableCORS: str=defaultCORSOption(), 
-                 methods: List[str]=["GET", "POST"]):  # OPTIONS WILL BE ADDED AUTOMATICALLY
+                 enableCORS: Union[str, List[str]]=defaultCORSOption(), 
+                 corsMaxAge: int=defaultCORSMaxAge(), 
+                 methods: List[str]=["GET", "POST"],  # OPTIONS WILL BE ADDED AUTOMATICALLY
+                 compressLevel: int=None,
+                 cache: 'ResponseCache'=None,
+                 etag: bool=False,
+                 version=None,
+                 concurrency: Union[int, 'ConcurrencyLimit']=None,
+                 queueDepth: int=0,
+                 queueTimeout: float=None,
+                 maxBodySize: int=None,
+                 coalesce: Union[bool, 'RequestCoalescing']=False,
+                 coalesceTimeout: float=10):
         self.contentType = contentType
         self.contentEncoding = contentEncoding
+        self.compressLevel = compressLevel
+        self.cache = cache
+        self.etag = etag
+        self.version = version
+        if isinstance(concurrency, int):
+            concurrency = ConcurrencyLimit(concurrency, queueDepth, queueTimeout)
+        self.concurrency = concurrency
+        self.maxBodySize = maxBodySize
+        if coalesce is True:
+            coalesce = RequestCoalescing(coalesceTimeout)
+        self.coalescing = coalesce or None
         self.enableCORS = enableCORS
         self.supportMethods = set(methods)
         self.supportMethods.add("OPTIONS")
+        self.cors = CORSPolicy(enableCORS, self.supportMethods, corsMaxAge)
+
+    def __call__(self, func):
+        def wrapped_func(*args, **namedArgs):
+            return func(*args, **namedArgs)
+
+        wrapped_func.exposed = True
+        wrapped_func.contentType = self.contentType
+        wrapped_func.contentEncoding = self.contentEncoding
+        wrapped_func.compressLevel = self.compressLevel
+        wrapped_func.responseCache = self.cache
+        wrapped_func.etag = self.etag or self.version is not None
+        wrapped_func.version = self.version
+        wrapped_func.versionPlan = CallPlan(self.version) if self.version is not None else None
+        wrapped_func.concurrency = self.concurrency
+        wrapped_func.maxBodySize = self.maxBodySize
+        wrapped_func.coalescing = self.coalescing
+        wrapped_func.enableCORS = self.enableCORS
+        wrapped_func.supportMethods = self.supportMethods
+        wrapped_func.cors = self.cors
+        wrapped_func.__doc__ = func.__doc__
+        wrapped_func.originalFunction = func 
+        wrapped_func.isAsync = iscoroutinefunction(func)
+        wrapped_func.callPlan = CallPlan(func)
+        return wrapped_func
+
+
+@expose(contentType='text/html; charset=utf-8')
+def global_default():
+    return 'Missing Page: %s' % web.ctx.path
+
+def get_default_handler(nodeHandlers):
+    for nodeHandler in reversed(nodeHandlers):
+        try:
+            return getattr(nodeHandler, 'default')
+        except AttributeError:
+            pass 
+                
+    return global_default 
+
+def get_index_handler(nodeHandlers):
+    try:
+        nodeHandler = nodeHandlers[-1]
+        return getattr(nodeHandler, 'index')
+    except AttributeError:
+        return None
+
+
+class Site:
+    pass
+
+
+def importObject(path):
+    '''Imports an object given as package.module:attribute or package.module.attribute'''
+    if ':' in path:
+        moduleName, attributes = path.split(':', 1)
+    else:
+        moduleName, attributes = path.rsplit('.', 1)
+    obj = importlib.import_module(moduleName)
+    for attr in attributes.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class LazySite:
+    '''Site subtree loaded on the first request routed through it
+
+    target is an import path (package.module:attribute) or a callable. The imported object, or the 
+    callable, is called with the given arguments to create the Site unless it is a Site already. Once 
+    loaded, the subtree stays loaded. Routing, default handling and the sitemap see it as the Site 
+    it refers to, see Application.warmUp to load the subtrees in the background.
+    '''
+    def __init__(self, target, *args, **namedArgs):
+        self.target = target
+        self.args = args
+        self.namedArgs = namedArgs
+        self._site = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._site is not None
+
+    def resolve(self):
+        site = self._site
+        if site is None:
+            with self._lock:
+                if self._site is None:
+                    target = self.target
+                    if isinstance(target, str):
+                        target = importObject(target)
+                    if not isinstance(target, Site):
+                        target = target(*self.args, **self.namedArgs)
+                    if not isinstance(target, Site):
+                        raise TypeError('%r is not a Site' % (self.target,))
+                    self._site = target
+                site = self._site
+        return site
+
+
+def siteLimit(node, inheritedLimit=None):
+    '''Returns the concurrency limit set on a Site node, or the one inherited from its parents'''
+    limit = getattr(node, 'concurrency', None)
+    return limit if isinstance(limit, ConcurrencyLimit) else inheritedLimit
+
+
+class _RouteNode:
+    __slots__ = ('children', 'index', 'default', 'limit')
+
+    def __init__(self, default, limit=None):
+        self.children = {}
+        self.index = None
+        self.default = default
+        self.limit = limit
+
+
+class _LazyRoute:
+    #Child of a compiled node which is compiled when a LazySite is routed through the first time
+    __slots__ = ('site', 'default', 'defaultOwner', 'limit')
+
+    def __init__(self, site, default, defaultOwner, limit):
+        self.site = site
+        self.default = default
+        self.defaultOwner = defaultOwner
+        self.limit = limit
+
+
+class RouteTable:
+    '''Compiled version of the Site tree used by Index.getNodeHandler
+
+    The tree is walked once and every reachable Site node is stored as a dictionary of its exposed
+    handlers and child sites, together with its index and default fallbacks. Resolving a path is then
+    a dictionary lookup per path segment. The table has to be invalidated when the tree is modified.
+    LazySite subtrees are compiled when they are routed through the first time.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self._compiled = None
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._compiled = None
+
+    def compile(self):
+        with self._lock:
+            if self._compiled is None:
+                root = self.root() if callable(self.root) else self.root
+                self._nodes = {}
+                if isinstance(root, Site):
+                    self._compiled = self._compileNode(root, None, None, self._nodes)
+                else:
+                    #Everything is mapped to the global default handler
+                    self._compiled = _RouteNode(None)
+        return self._compiled
+
+    def _compileNode(self, node, inheritedDefault, defaultOwner, compiled, inheritedLimit=None):
+        #Same node can be reached from different parents, the default handler and the concurrency limit
+        #are inherited from the parents so they are part of the key together with the node. This also
+        #stops cycles.
+        try:
+            default = getattr(node, 'default')
+            defaultOwner = node
+        except AttributeError:
+            default = inheritedDefault
+        limit = siteLimit(node, inheritedLimit)
+
+        key = (id(node), id(defaultOwner), id(limit))
+        try:
+            return compiled[key]
+        except KeyError:
+            pass
+
+        routeNode = _RouteNode(default, limit)
+        compiled[key] = routeNode
+
+        try:
+            routeNode.index = getattr(node, 'index')
+        except AttributeError:
+            pass
+        if not routeNode.index:
+            routeNode.index = default
+
+        for attr in dir(node):
+            try:
+                child = getattr(node, attr)
+            except AttributeError:
+                continue
+            if isinstance(child, Site):
+                routeNode.children[attr] = self._compileNode(child, default, defaultOwner, compiled, limit)
+            elif isinstance(child, LazySite):
+                routeNode.children[attr] = _LazyRoute(child, default, defaultOwner, limit)
+            elif callable(child) and getattr(child, 'exposed', False):
+                routeNode.children[attr] = child
+
+        return routeNode
+
+    def resolve(self, path):
+        return self.resolveRoute(path)[0]
+
+    def resolveRoute(self, path):
+        '''Returns the handler of the path and the concurrency limit of the Site subtree it is in'''
+        routeNode = self._compiled or self.compile()
+
+        nodeHandler = None
+        for node in path:
+            if not node:
+                break
+            if nodeHandler is not None:
+                #Nothing is mapped below a handler
+                return routeNode.default or global_default, routeNode.limit
+            child = routeNode.children.get(node)
+            if child is None:
+                return routeNode.default or global_default, routeNode.limit
+            if child.__class__ is _RouteNode:
+                routeNode = child
+            elif child.__class__ is _LazyRoute:
+                routeNode = self._compileLazy(routeNode, node, child)
+            else:
+                nodeHandler = child
+
+        if nodeHandler is None:
+            nodeHandler = routeNode.index
+        return nodeHandler or global_default, routeNode.limit
+
+    def _compileLazy(self, parent, attr, lazyRoute):
+        site = lazyRoute.site.resolve()
+        with self._lock:
+            child = parent.children.get(attr)
+            if child is lazyRoute:
+                child = parent.children[attr] = self._compileNode(site, lazyRoute.default, lazyRoute.defaultOwner,
+                                                                  self._nodes, lazyRoute.limit)
+        return child
+
+
+#zlib window bits selecting the container format of each content encoding
+ENCODING_WBITS = {'gzip': 31, 'deflate': 15}
+
+#Accepts both gzip and zlib headers when decompressing
+AUTO_WBITS = 47
+
+UNZIP_CHUNK_SIZE = 64 * 1024
+
+
+class DecompressionLimitError(ValueError):
+    pass
+
+
+def encodeBody(result):
+    '''Returns a result which is not streamed, or a chunk of a stream, as bytes. Strings and other values are
+    encoded as UTF-8, None is an empty body.'''
+    if isinstance(result, bytes):
+        return result
+    if result is None:
+        return b''
+    return str(result).encode('utf-8')
+
+
+def compressChunks(chunks, encoding='gzip', compresslevel=6):
+    '''Compresses an iterable of str or bytes chunks, compressed data is yielded as it is produced'''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    try:
+        for chunk in chunks:
+            data = compressor.compress(encodeBody(chunk))
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def zipChunks(chunks, compresslevel=5):
+    return compressChunks(chunks, 'gzip', compresslevel)
+
+def unzipChunks(chunks, maxSize=None):
+    '''Decompresses an iterable of gzip (or zlib) chunks, decompressed data is yielded in pieces
+
+    DecompressionLimitError is raised as soon as the output exceeds maxSize so a small compressed 
+    input can not fill the memory.
+    '''
+    decompressor = zlib.decompressobj(AUTO_WBITS)
+    started = False
+    pending = False
+    total = 0
+    for data in chunks:
+        if data:
+            started = True
+        #Output is limited per call, so there might be pending output even if all input is consumed
+        while data or pending:
+            out = decompressor.decompress(data, UNZIP_CHUNK_SIZE)
+            if decompressor.eof:
+                #Next gzip member starts after the current one, zero padding at the end is ignored
+                data = decompressor.unused_data.lstrip(b'\x00')
+                decompressor = zlib.decompressobj(AUTO_WBITS)
+                started = pending = bool(data)
+            else:
+                data = decompressor.unconsumed_tail
+                pending = len(out) == UNZIP_CHUNK_SIZE
+
+            if out:
+                total += len(out)
+                if maxSize is not None and total > maxSize:
+                    raise DecompressionLimitError('Decompressed content is larger than %d bytes' % maxSize)
+                yield out
+
+    if started:
+        raise EOFError('Compressed content ended before the end-of-stream marker was reached')
+
+def zipIt(content, compresslevel=5):
+    return b''.join(zipChunks((content,), compresslevel))
+
+def unzipIt(content, compresslevel=5, maxSize=None):
+    #compresslevel is not used, it is kept for backward compatibility
+    return b''.join(unzipChunks((content,), maxSize))
+
+
+#Request bodies are kept in memory up to this size when they are spooled, larger ones go to a temporary file
+BODY_SPOOL_SIZE = 1024 * 1024
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+#Content encodings of the request bodies decoded by RequestBody, deflate is the zlib format
+BODY_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+
+def payloadTooLarge(maxSize):
+    return web.HTTPError('413 Payload Too Large', {'Content-Type': 'text/plain'}, 
+                         'Request body is larger than %d bytes' % maxSize)
+
+
+def requestLength(environ):
+    try:
+        return int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise web.badrequest('Invalid Content-Length')
+
+
+class RequestBody:
+    '''Body of a POST request, passed to the handlers having a _body parameter
+
+    Nothing is read from wsgi.input until the handler asks for it. The body can be streamed with read(size)
+    or by iterating over its chunks, gzip and deflate encoded bodies are decoded incrementally. spool() 
+    stores the whole body in a temporary file which stays in memory up to spoolSize bytes. 413 Payload Too 
+    Large is raised as soon as the decoded body exceeds maxSize, see expose(maxBodySize=...).
+    '''
+    def __init__(self, environ, maxSize: int=None, spoolSize: int=BODY_SPOOL_SIZE):
+        self.environ = environ
+        self.maxSize = maxSize
+        self.spoolSize = spoolSize
+        self.contentType = environ.get('CONTENT_TYPE', '')
+        self.encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower() or None
+        if self.encoding == 'identity':
+            self.encoding = None
+        if self.encoding is not None and self.encoding not in BODY_ENCODINGS:
+            raise web.HTTPError('415 Unsupported Media Type', {'Content-Type': 'text/plain'}, 
+                                'Unsupported Content-Encoding: %s' % self.encoding)
+        self.size = 0
+        self._chunks = None
+        self._pending = b''
+        self._file = None
+
+    def rawChunks(self):
+        '''Yields the body as it is read from wsgi.input, without decoding'''
+        stream = self.environ['wsgi.input']
+        if self.environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+            remaining = None
+        else:
+            remaining = requestLength(self.environ)
+        while remaining is None or remaining > 0:
+            data = stream.read(BODY_CHUNK_SIZE if remaining is None else min(remaining, BODY_CHUNK_SIZE))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def decodedChunks(self):
+        chunks = self.rawChunks()
+        if self.encoding is not None:
+            chunks = unzipChunks(chunks)
+        try:
+            for chunk in chunks:
+                self.size += len(chunk)
+                if self.maxSize is not None and self.size > self.maxSize:
+                    raise payloadTooLarge(self.maxSize)
+                yield chunk
+        except (zlib.error, EOFError):
+            raise web.badrequest('Invalid %s encoded request body' % self.encoding)
+
+    def __iter__(self):
+        if self._file is not None:
+            return iter(lambda: self._file.read(BODY_CHUNK_SIZE), b'')
+        return self._iterChunks()
+
+    def _iterChunks(self):
+        if self._pending:
+            pending, self._pending = self._pending, b''
+            yield pending
+        if self._chunks is None:
+            self._chunks = self.decodedChunks()
+        yield from self._chunks
+
+    def read(self, size: int=-1):
+        '''Returns up to size bytes of the decoded body, all of the remaining body if size is negative'''
+        if self._file is not None:
+            return self._file.read(size)
+        if size is None or size < 0:
+            return b''.join(self._iterChunks())
+
+        data = []
+        for chunk in self._iterChunks():
+            data.append(chunk)
+            size -= len(chunk)
+            if size <= 0:
+                break
+        data = b''.join(data)
+        if size < 0:
+            data, self._pending = data[:size], data[size:]
+        return data
+
+    def spool(self):
+        '''Reads the remaining body into a temporary file and returns the file positioned at its start'''
+        if self._file is None:
+            spooled = SpooledTemporaryFile(max_size=self.spoolSize)
+            try:
+                for chunk in self._iterChunks():
+                    spooled.write(chunk)
+            except BaseException:
+                spooled.close()
+                raise
+            spooled.seek(0)
+            self._file = spooled
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+INCOMPRESSIBLE_TYPES = ('image/', 'audio/', 'video/', 'font/woff', 'application/zip', 'application/gzip', 
+                        'application/x-gzip', 'application/x-bzip2', 'application/x-7z-compressed', 
+                        'application/octet-stream', 'application/pdf')
+
+
+class ResponseCompression:
+    '''Compresses the handler results based on the Accept-Encoding header of the request
+
+    Bodies smaller than minSize and incompressible content types are sent as they are. Handlers can
+    change the compression level with expose(compressLevel=...), 0 disables the compression.
+    '''
+    def __init__(self, minSize: int=1024, 
+                 compresslevel: int=6,
+                 encodings: List[str]=['gzip', 'deflate'], 
+                 incompressibleTypes: List[str]=INCOMPRESSIBLE_TYPES):
+        self.minSize = minSize
+        self.compresslevel = compresslevel
+        self.encodings = [encoding for encoding in encodings if encoding in ENCODING_WBITS]
+        self.incompressibleTypes = tuple(incompressibleTypes)
+        self._negotiated = {}
+
+    def negotiate(self, acceptEncoding):
+        '''Returns the preferred encoding we support from the Accept-Encoding header or None'''
+        try:
+            return self._negotiated[acceptEncoding]
+        except KeyError:
+            pass
+
+        qualities = {}
+        for item in acceptEncoding.lower().split(','):
+            name, _, params = item.partition(';')
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            qualities[name.strip()] = quality
+
+        encoding = None
+        bestQuality = 0.0
+        for name in self.encodings:
+            quality = qualities.get(name, qualities.get('*', 0.0))
+            if quality > bestQuality:
+                encoding, bestQuality = name, quality
+
+        #Header values are repeated by the clients, cache is only cleared to keep it bounded
+        if len(self._negotiated) > 256:
+            self._negotiated.clear()
+        self._negotiated[acceptEncoding] = encoding
+        return encoding
+
+    def compressible(self, contentType):
+        return not (contentType or '').lower().startswith(self.incompressibleTypes)
+
+    def compress(self, nodeHandler, result):
+        '''Returns the result compressed if it is accepted by the client and sets the headers'''
+        compresslevel = getattr(nodeHandler, 'compressLevel', None)
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        if (not compresslevel or nodeHandler.contentEncoding or not result 
+                or not self.compressible(nodeHandler.contentType)):
+            return result
+
+        ctx = web.ctx
+        if not ctx.status.startswith('200'):
+            return result
+        for header, _ in ctx.headers:
+            if header.lower() == 'content-encoding':
+                return result
+
+        web.header('Vary', 'Accept-Encoding')
+        encoding = self.negotiate(ctx.env.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return result
+
+        if hasattr(result, '__next__'):
+            web.header('Content-Encoding', encoding)
+            return compressChunks(result, encoding, compresslevel)
+
+        result = encodeBody(result)
+        if len(result) < self.minSize:
+            return result
+        
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, ENCODING_WBITS[encoding])
+        web.header('Content-Encoding', encoding)
+        return compressor.compress(result) + compressor.flush()
+
+QUERY_MAX_PARAMS = 1000
+QUERY_MAX_LENGTH = 64 * 1024
+
+
+class QueryLimitError(ValueError):
+    pass
+
+
+def _unquote(value):
+    if value is True:
+        return value
+    if '%' in value or '+' in value:
+        return unquote_plus(value)
+    return value
+
+
+class QueryView(Mapping):
+    '''Read only result of parseQuery(lazy=True), values are unquoted when they are first accessed'''
+    __slots__ = ('_raw', '_decoded')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        value = self._raw[key]
+        if isinstance(value, list):
+            value = [_unquote(item) for item in value]
+        else:
+            value = _unquote(value)
+        self._decoded[key] = value
+        return value
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __contains__(self, key):
+        return key in self._raw
+
+    def __repr__(self):
+        return '<QueryView %r>' % dict(self)
+
+
+def parseQuery(query, lazy=False, maxParams=None, maxLength=None):
+    '''Parses the query string into a web.Storage
+
+    Keys and values are unquoted, a key without a value is mapped to True and repeated keys are 
+    collected into a list. If lazy is True, a read only QueryView is returned instead which unquotes 
+    the values only when they are used. QueryLimitError is raised if the query is longer than 
+    maxLength or has more than maxParams parameters (QUERY_MAX_LENGTH and QUERY_MAX_PARAMS by default).
+    '''
+    if maxParams is None:
+        maxParams = QUERY_MAX_PARAMS
+    if maxLength is None:
+        maxLength = QUERY_MAX_LENGTH
+
+    query = query.strip()
+    if query.startswith('?'):
+        query = query[1:]
+    if len(query) > maxLength:
+        raise QueryLimitError('Query is longer than %d characters' % maxLength)
+    if query.count('&') >= maxParams:
+        raise QueryLimitError('Query has more than %d parameters' % maxParams)
+
+    storage = {} if lazy else web.Storage()
+    for parameter in query.split('&'):
+        key, separator, val = parameter.partition('=')
+        if not key:
+            continue 
+        key = _unquote(key)
+        if not separator:
+            val = True 
+        elif not lazy:
+            val = _unquote(val)
+
+        try:
+            oldValue = storage[key]
+            if isinstance(oldValue, list):
+                oldValue.append(val)
+            else:
+                storage[key] = [oldValue, val]
+        except KeyError:
+            storage[key] = val
+        
+    return QueryView(storage) if lazy else storage
+
+def headerValue(name):
+    '''Returns the value of a response header which is already set, or None'''
+    name = name.lower()
+    for header, value in web.ctx.headers:
+        if header.lower() == name:
+            return value
+    return None
+
+def privateResponse(headers):
+    '''Returns True if the headers are specific to the client, such responses are not cached or shared'''
+    for header, value in headers:
+        header = header.lower()
+        if header == 'set-cookie':
+            return True
+        if header == 'cache-control':
+            value = value.lower()
+            if 'private' in value or 'no-store' in value:
+                return True
+    return False
+
+def bodyETag(body):
+    #hashlib.blake2b needs Python 3.6
+    return '"%s"' % sha1(body).hexdigest()
+
+def versionETag(token, encoding=None):
+    token = str(token).replace('"', '')
+    if encoding:
+        token = '%s-%s' % (token, encoding)
+    return '"%s"' % token
+
+def httpTimestamp(value):
+    '''Converts a datetime or a timestamp to whole seconds since epoch as used by the HTTP dates'''
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.timestamp()
+    return int(value)
+
+def checkConditionalRequest(etag, lastModified):
+    '''Raises 304 Not Modified if the validators of the request match the response'''
+    environ = web.ctx.env
+    ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH')
+    if ifNoneMatch is not None:
+        if etag is None:
+            return
+        if ifNoneMatch.strip() != '*':
+            tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+            if etag not in tags and 'W/' + etag not in tags:
+                return
+        raise notModified()
+
+    ifModifiedSince = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ifModifiedSince is not None and lastModified is not None:
+        try:
+            since = parsedate_to_datetime(ifModifiedSince)
+        except (TypeError, ValueError, IndexError):
+            return
+        if since is None or lastModified > httpTimestamp(since):
+            return
+        raise notModified()
+
+def notModified():
+    #304 responses do not have content
+    web.ctx.headers = [(header, value) for header, value in web.ctx.headers 
+                       if header.lower() not in ('content-type', 'content-length')]
+    return web.notmodified()
+
+
+class SingleFlight:
+    '''Runs a function only once for the concurrent calls with the same key
+
+    The first caller runs the function, the others wait for it and share its result. Waiting callers
+    run the function themselves if the first call fails or does not finish within the timeout.
+    '''
+    class _Call:
+        __slots__ = ('event', 'result', 'failed')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.failed = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def run(self, key, func, timeout=None):
+        '''Returns the result of func and whether it is shared from another caller'''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = self._Call()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            if call.event.wait(timeout) and not call.failed:
+                with self._lock:
+                    self.shared += 1
+                return call.result, True
+            return func(), False
+
+        try:
+            call.result = func()
+            return call.result, False
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class CachedResponse:
+    __slots__ = ('body', 'headers', 'expires', 'size')
+
+    def __init__(self, body, headers, expires):
+        self.body = body
+        self.headers = headers
+        self.expires = expires
+        self.size = len(body) + sum(len(header) + len(value) for header, value in headers)
+
+
+def normalizeQuery(query):
+    '''Returns the raw query string with its parameters sorted, used as a cache key without parsing
+
+    The sort is stable and only compares the names, values of a repeated key keep their order.
+    '''
+    if query.startswith('?'):
+        query = query[1:]
+    return '&'.join(sorted((parameter for parameter in query.split('&') if parameter), 
+                           key=lambda parameter: parameter.partition('=')[0]))
+
+
+def requestKey(index, environKeys=()):
+    '''Identifies a GET request by its path, normalized query, negotiated content encoding and the values of
+    the given environ keys'''
+    ctx = web.ctx
+    environ = ctx.environ
+    encoding = None
+    if index.compression is not None:
+        encoding = index.compression.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+    return (ctx.path, normalizeQuery(ctx.query), encoding) + tuple(environ.get(key) for key in environKeys)
+
+
+class RequestCoalescing:
+    '''Lets the concurrent identical GET requests of a handler share one handler call, see expose(coalesce=...)
+
+    Requests are identical if their path, query parameters in any order, negotiated content encoding and 
+    the given request headers match. The first request calls the handler, the others wait for it up to 
+    timeout seconds and receive the same encoded (and compressed) body with the same headers. Nothing is 
+    kept after the call. Streamed results, failed calls, responses other than 200 and responses specific 
+    to the client (see privateResponse) are not shared, the waiting requests call the handler themselves 
+    then. Async handlers served by the ASGI adapter are not coalesced.
+    '''
+    def __init__(self, timeout: float=10, headers: List[str]=[]):
+        self.timeout = timeout
+        self.environKeys = tuple('HTTP_' + header.upper().replace('-', '_') for header in headers)
+        self.flights = SingleFlight()
+
+    def respond(self, index, nodeHandler):
+        (result, headers), shared = self.flights.run(requestKey(index, self.environKeys), 
+                                                     lambda: self._compute(index, nodeHandler), self.timeout)
+        if not shared:
+            return result
+        if headers is None:
+            return index.callHandler(nodeHandler)
+        web.ctx.headers.extend(headers)
+        return result
+
+    def _compute(self, index, nodeHandler):
+        ctx = web.ctx
+        start = len(ctx.headers)
+        result = index.callHandler(nodeHandler)
+        headers = tuple(ctx.headers[start:])
+        if not ctx.status.startswith('200') or hasattr(result, '__next__') or privateResponse(headers):
+            return result, None
+        return encodeBody(result), headers
+
+
+class ResponseCache:
+    '''Caches the responses of an exposed handler, see expose(cache=...)
+
+    Responses are keyed on the path, the normalized query, the negotiated content encoding and the 
+    values of the given request headers. Encoded and compressed bodies are stored together with the 
+    headers set by the handler, so a hit does not parse the query or call the handler. Entries expire 
+    after ttl seconds and the least recently used ones are evicted to stay below maxBytes. With 
+    stampede protection, concurrent misses on the same key wait for a single handler call.
+    '''
+    def __init__(self, ttl: float=60, 
+                 maxBytes: int=16 * 1024 * 1024,
+                 headers: List[str]=[],
+                 stampede: bool=True,
+                 stampedeTimeout: float=10):
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.environKeys = tuple('HTTP_' + header.upper().replace('-', '_') for header in headers)
+        self.stampedeTimeout = stampedeTimeout
+        self.flights = SingleFlight() if stampede else None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, index):
+        return requestKey(index, self.environKeys)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, entry):
+        if entry.size > self.maxBytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.maxBytes:
+                _, oldEntry = self._entries.popitem(last=False)
+                self._size -= oldEntry.size
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 
+                'misses': self.misses, 
+                'evictions': self.evictions,
+                'shared': self.flights.shared if self.flights is not None else 0,
+                'entries': len(self._entries), 
+                'bytes': self._size}
+
+    def respond(self, index, nodeHandler):
+        ctx = web.ctx
+        key = self.key(index)
+        entry = self.get(key)
+        if entry is None:
+            if self.flights is None:
+                return self._compute(index, nodeHandler, key)[0]
+            (result, entry), shared = self.flights.run(key, lambda: self._compute(index, nodeHandler, key), 
+                                                       self.stampedeTimeout)
+            if not shared:
+                return result
+            if entry is None:
+                #Response of the other request could not be cached
+                return index.callHandler(nodeHandler)
+
+        ctx.headers.extend(entry.headers)
+        return entry.body
+
+    def _compute(self, index, nodeHandler, key):
+        start = len(web.ctx.headers)
+        result = index.callHandler(nodeHandler)
+        return self.store(key, web.ctx.headers[start:], result)
+
+    def store(self, key, headers, result):
+        '''Caches the result of a handler call if possible, returns the encoded result and the entry'''
+        if not web.ctx.status.startswith('200') or hasattr(result, '__next__') or privateResponse(headers):
+            return result, None
+
+        result = encodeBody(result)
+        entry = CachedResponse(result, headers, time.monotonic() + self.ttl)
+        self.set(key, entry)
+        return result, entry
+
+
+def serviceUnavailable(retryAfter):
+    return web.HTTPError('503 Service Unavailable', 
+                         {'Content-Type': 'text/plain', 'Retry-After': str(retryAfter)},
+                         'Service Unavailable')
+
+
+def callReleasing(release, func, *args):
+    '''Returns func(*args) and calls release after it, or after a streamed result is closed'''
+    try:
+        result = func(*args)
+    except BaseException:
+        release()
+        raise
+    if hasattr(result, '__next__'):
+        return releasingChunks(result, release)
+    release()
+    return result
+
+
+def releasingChunks(chunks, release):
+    try:
+        yield from chunks
+    finally:
+        release()
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class ConcurrencyLimit:
+    '''Limits the concurrent requests of the handlers sharing it, see expose(concurrency=...)
+
+    Up to limit requests are handled at the same time and up to queueDepth more requests wait for a 
+    free slot in their arrival order. Other requests, and the ones waiting longer than timeout seconds, 
+    are rejected with 503 Service Unavailable and a Retry-After header. A limit set as the concurrency 
+    attribute of a Site applies to all the handlers of its subtree which do not have their own limit.
+
+    If an executor is given, the ASGI adapter runs the sync handlers under this limit on it instead of 
+    its shared thread pool, so heavy handlers can not take all the threads of the other handlers.
+    '''
+    def __init__(self, limit: int, 
+                 queueDepth: int=0, 
+                 timeout: float=None, 
+                 retryAfter: int=1, 
+                 executor=None):
+        self.limit = limit
+        self.queueDepth = queueDepth
+        self.timeout = timeout
+        self.retryAfter = retryAfter
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timedOut = 0
+
+    def _enter(self, wake):
+        #Called with the lock. Returns True if a slot is taken and False if the request is rejected, 
+        #otherwise wake is queued and it is called when a slot is handed over to the request.
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.accepted += 1
+            return True
+        if len(self._waiters) >= self.queueDepth:
+            self.rejected += 1
+            return False
+        self._waiters.append(wake)
+        return None
+
+    def _leaveQueue(self, wake):
+        #Called with the lock when a queued request stops waiting, the slot might be handed over already
+        try:
+            self._waiters.remove(wake)
+        except ValueError:
+            return True
+        self.rejected += 1
+        self.timedOut += 1
+        return False
+
+    def acquire(self):
+        '''Waits for a slot, returns False if the request has to be rejected'''
+        event = threading.Event()
+        wake = event.set
+        with self._lock:
+            acquired = self._enter(wake)
+        if acquired is not None:
+            return acquired
+        if event.wait(self.timeout):
+            return True
+        with self._lock:
+            return self._leaveQueue(wake)
+
+    async def acquireAsync(self):
+        '''Same as acquire for the requests handled on an event loop, the loop is not blocked'''
+        loop = asyncio.get_event_loop()
+        woken = loop.create_future()
+        def wake():
+            loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(True))
+
+        with self._lock:
+            acquired = self._enter(wake)
+        if acquired is not None:
+            return acquired
+        try:
+            await asyncio.wait((woken,), timeout=self.timeout)
+        except BaseException:
+            with self._lock:
+                acquired = self._leaveQueue(wake)
+            if acquired:
+                self.release()
+            raise
+        if woken.done():
+            return True
+        with self._lock:
+            return self._leaveQueue(wake)
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            #The slot is handed over, so a new request can not overtake the queued ones
+            self.accepted += 1
+            wake = self._waiters.popleft()
+        wake()
+
+    def rejection(self):
+        return serviceUnavailable(self.retryAfter)
+
+    def call(self, func, *args):
+        '''Calls func within the limit, a streamed result keeps its slot until it is closed'''
+        if not self.acquire():
+            raise self.rejection()
+        return callReleasing(self.release, func, *args)
+
+    def stats(self):
+        return {'limit': self.limit,
+                'active': self.active,
+                'queued': len(self._waiters),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'timedOut': self.timedOut}
+
+
+#Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS_PHASES = ('routing', 'query', 'handler', 'compression', 'total')
+
+
+def handlerName(nodeHandler):
+    return getattr(nodeHandler, 'originalFunction', nodeHandler).__qualname__
+
+
+class RequestMetrics:
+    '''Timings and sizes of the request being handled, kept in web.ctx.requestMetrics'''
+    __slots__ = ('start', 'handler', 'phases', 'rawSize', 'size')
+
+    def __init__(self, handler=None):
+        self.start = perf_counter()
+        self.handler = handler
+        self.phases = {}
+        self.rawSize = None
+        self.size = None
+
+    def routed(self, nodeHandler):
+        self.handler = handlerName(nodeHandler)
+        self.phases['routing'] = perf_counter() - self.start
+
+    def add(self, phase, started):
+        self.phases[phase] = self.phases.get(phase, 0) + perf_counter() - started
+
+    def timed(self, phase, func, *args):
+        started = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.add(phase, started)
+
+    def finish(self, index, nodeHandler, result, post):
+        '''Index.finishResult with the compression time and the sizes before and after compression'''
+        if isinstance(result, str):
+            result = result.encode('utf-8')
+        if isinstance(result, bytes):
+            self.rawSize = len(result)
+        return self.timed('compression', index.finishResult, nodeHandler, result, post)
+
+
+class _MetricsShard:
+    __slots__ = ('requests', 'latencies', 'sizes')
+
+    def __init__(self):
+        self.requests = {}
+        self.latencies = {}
+        self.sizes = {}
+
+
+class Metrics:
+    '''Per handler request counts, latency histograms and response sizes, see Application(metrics=...)
+
+    Requests are counted by method and status. Latencies are split into routing, query parsing, 
+    handler and compression phases, streamed responses are measured until the handler returns the 
+    stream. Every thread records into its own shard without locking, the shards are only summed up 
+    when the metrics are collected. The metrics are served in Prometheus text format on path.
+    '''
+    def __init__(self, path: str='/_metrics', buckets=LATENCY_BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _MetricsShard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def record(self, requestMetrics, method, status):
+        shard = self._shard()
+        handler = requestMetrics.handler or 'unknown'
+        key = (handler, method, status.split(' ', 1)[0])
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+
+        phases = requestMetrics.phases
+        phases['total'] = perf_counter() - requestMetrics.start
+        for phase, seconds in phases.items():
+            key = (handler, phase)
+            histogram = shard.latencies.get(key)
+            if histogram is None:
+                #Bucket counts, the +Inf bucket and the sum
+                histogram = shard.latencies[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+        for stage, size in (('raw', requestMetrics.rawSize), ('sent', requestMetrics.size)):
+            if size is not None:
+                key = (handler, stage)
+                shard.sizes[key] = shard.sizes.get(key, 0) + size
+
+    def measure(self, method, func, *args):
+        '''Calls the Index method handling the request and records its metrics'''
+        ctx = web.ctx
+        requestMetrics = ctx.requestMetrics = RequestMetrics()
+        try:
+            result = func(*args)
+        except web.HTTPError:
+            self.record(requestMetrics, method, ctx.status)
+            raise
+        except BaseException:
+            self.record(requestMetrics, method, '500')
+            raise
+        return self._finish(requestMetrics, method, result)
+
+    async def measureAsync(self, method, nodeHandler, coroutine):
+        ctx = web.ctx
+        requestMetrics = ctx.requestMetrics = RequestMetrics(handlerName(nodeHandler))
+        try:
+            result = await coroutine
+        except web.HTTPError:
+            self.record(requestMetrics, method, ctx.status)
+            raise
+        except BaseException:
+            self.record(requestMetrics, method, '500')
+            raise
+        return self._finish(requestMetrics, method, result)
+
+    def _finish(self, requestMetrics, method, result):
+        #web.py encodes str results anyway, so they are encoded here once to get their size
+        if isinstance(result, str):
+            result = result.encode('utf-8')
+        if isinstance(result, bytes):
+            requestMetrics.size = len(result)
+        self.record(requestMetrics, method, web.ctx.status)
+        return result
+
+    def collect(self):
+        '''Returns the request counts, latency histograms and response sizes summed over the shards'''
+        requests, latencies, sizes = {}, {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, count in list(shard.requests.items()):
+                requests[key] = requests.get(key, 0) + count
+            for key, histogram in list(shard.latencies.items()):
+                total = latencies.get(key)
+                if total is None:
+                    latencies[key] = list(histogram)
+                else:
+                    latencies[key] = [a + b for a, b in zip(total, histogram)]
+            for key, size in list(shard.sizes.items()):
+                sizes[key] = sizes.get(key, 0) + size
+        return requests, latencies, sizes
+
+    def exposition(self):
+        '''Returns the metrics in Prometheus text format'''
+        requests, latencies, sizes = self.collect()
+        lines = ['# HELP webapp_requests_total Requests handled by the exposed handlers',
+                 '# TYPE webapp_requests_total counter']
+        for (handler, method, status), count in sorted(requests.items()):
+            lines.append('webapp_requests_total{handler="%s",method="%s",status="%s"} %d' % 
+                         (labelValue(handler), method, status, count))
+
+        lines += ['# HELP webapp_request_duration_seconds Time spent in the phases of the requests',
+                  '# TYPE webapp_request_duration_seconds histogram']
+        order = dict((phase, i) for i, phase in enumerate(METRICS_PHASES))
+        for (handler, phase), histogram in sorted(latencies.items(), key=lambda item: (item[0][0], order[item[0][1]])):
+            labels = 'handler="%s",phase="%s"' % (labelValue(handler), phase)
+            count = 0
+            for bound, bucketCount in zip(self.buckets + ('+Inf',), histogram):
+                count += bucketCount
+                lines.append('webapp_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+            lines.append('webapp_request_duration_seconds_sum{%s} %r' % (labels, histogram[-1]))
+            lines.append('webapp_request_duration_seconds_count{%s} %d' % (labels, count))
+
+        lines += ['# HELP webapp_response_bytes_total Response body sizes before (raw) and after (sent) compression',
+                  '# TYPE webapp_response_bytes_total counter']
+        for (handler, stage), size in sorted(sizes.items()):
+            lines.append('webapp_response_bytes_total{handler="%s",stage="%s"} %d' % (labelValue(handler), stage, size))
+        return '\n'.join(lines) + '\n'
+
+    def respond(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        return self.exposition()
+
+
+def labelValue(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Profiler:
+    '''Profiles a sampled fraction of the requests below a path prefix, see Application(profiler=...)
+
+    The profiler is off until enable() is called, or a POST request is sent to its path with the prefix,
+    fraction and memory parameters (disable and reset parameters are accepted as well). Sampled requests
+    run under cProfile and the stats are aggregated over all of them. One request is profiled at a time,
+    the other sampled requests are handled as usual while it runs. With memory=True, tracemalloc is 
+    started and the allocations of the sampled requests are aggregated from snapshots taken before and
+    after them, tracemalloc slows down all the requests of the process while it runs.
+
+    POST requests are rejected with 403 unless allow is given. It is called with the WSGI environ and 
+    returns True if the request may change the profiler, e.g. loopbackOnly.
+
+    GET requests on the path return the aggregated stats as text, or in the format given by the format
+    parameter: pstats (marshalled stats, pstats.Stats can load them), collapsed (flame graph input) or
+    memory (allocations). Requests of the async handlers served by the ASGI adapter are not profiled.
+    '''
+    def __init__(self, path: str='/_profile', maxAllocations: int=50, allow=None):
+        self.path = path
+        self.maxAllocations = maxAllocations
+        self.allow = allow
+        self.prefix = None
+        self.fraction = 0
+        self.memory = False
+        self._startedTracing = False
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self, prefix: str='/', fraction: float=0.01, memory: bool=False):
+        self.disable()
+        self.fraction = fraction
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        self.prefix = prefix.rstrip('/') + '/'
+
+    def disable(self):
+        self.prefix = None
+        if self._startedTracing:
+            #Waits for the request being profiled so its snapshot is not taken after stopping
+            with self._busy:
+                tracemalloc.stop()
+            self._startedTracing = False
+
+    def reset(self):
+        with self._lock:
+            self.stats = None
+            self.allocations = {}
+            self.profiled = 0
+
+    def sample(self, path):
+        prefix = self.prefix
+        if prefix is None or not (path + '/').startswith(prefix):
+            return False
+        return random.random() < self.fraction
+
+    def profile(self, func, *args):
+        '''Calls func under the profiler, unless another request is being profiled'''
+        if not self._busy.acquire(blocking=False):
+            return func(*args)
+        try:
+            memory = self.memory and tracemalloc.is_tracing()
+            if memory:
+                before = tracemalloc.take_snapshot()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                if memory:
+                    allocations = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+                self._aggregate(profile, allocations if memory else ())
+        finally:
+            self._busy.release()
+
+    def _aggregate(self, profile, allocations):
+        profile.create_stats()
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            for statistic in allocations:
+                if statistic.size_diff > 0:
+                    key = str(statistic.traceback)
+                    size, count = self.allocations.get(key, (0, 0))
+                    self.allocations[key] = (size + statistic.size_diff, count + max(statistic.count_diff, 0))
+            self.profiled += 1
+
+    def text(self, limit=50):
+        out = StringIO()
+        out.write('prefix: %s, fraction: %s, memory: %s, profiled requests: %d\n' % 
+                  (self.prefix, self.fraction, self.memory, self.profiled))
+        with self._lock:
+            if self.stats is not None:
+                self.stats.stream = out
+                self.stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def pstats(self):
+        with self._lock:
+            return marshal.dumps(self.stats.stats if self.stats is not None else {})
+
+    def collapsed(self):
+        '''Returns the stats as collapsed stacks with the times in microseconds
+
+        pstats only records the direct callers of the functions, so deeper stacks are estimated by 
+        splitting the time of a function between its callers.
+        '''
+        with self._lock:
+            stats = dict(self.stats.stats) if self.stats is not None else {}
+
+        children = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, (_, _, tottime, cumtime) in callers.items():
+                children.setdefault(caller, []).append((func, tottime, cumtime))
+
+        lines = {}
+        def walk(func, stack, share):
+            for child, tottime, cumtime in children.get(func, ()):
+                if child in stack or len(stack) > 64:
+                    continue
+                childStack = stack + (child,)
+                value = share * tottime * 1e6
+                if value >= 1:
+                    key = ';'.join(functionLabel(f) for f in childStack)
+                    lines[key] = lines.get(key, 0) + value
+                total = stats[child][3]
+                if total:
+                    walk(child, childStack, share * cumtime / total)
+
+        for func, (_, _, tottime, _, callers) in stats.items():
+            if not callers:
+                if tottime * 1e6 >= 1:
+                    lines[functionLabel(func)] = tottime * 1e6
+                walk(func, (func,), 1)
+        return ''.join('%s %d\n' % (stack, value) for stack, value in sorted(lines.items()))
+
+    def memoryText(self):
+        with self._lock:
+            allocations = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)
+        lines = ['%s: %d bytes in %d blocks' % (location, size, count) 
+                 for location, (size, count) in allocations[:self.maxAllocations]]
+        return '\n'.join(lines) + '\n'
+
+    def respond(self, method):
+        try:
+            query = parseQuery(web.ctx.query)
+        except QueryLimitError as err:
+            raise web.badrequest(str(err))
+        if method == 'POST':
+            if self.allow is None or not self.allow(web.ctx.env):
+                raise web.forbidden()
+            if 'reset' in query:
+                self.reset()
+            if 'disable' in query:
+                self.disable()
+            elif isinstance(query.get('prefix'), str):
+                try:
+                    fraction = float(query.get('fraction', 0.01))
+                    memory = _boolConverter(query.get('memory', 'false'))
+                except (TypeError, ValueError, AttributeError):
+                    raise web.badrequest('Invalid profiler parameters')
+                self.enable(query.prefix, fraction, memory)
+
+        format = query.get('format', 'text')
+        if format == 'pstats':
+            web.header('Content-Type', 'application/octet-stream')
+            web.header('Content-Disposition', 'attachment;filename=webapp.pstats')
+            return self.pstats()
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        if format == 'collapsed':
+            return self.collapsed()
+        if format == 'memory':
+            return self.memoryText()
+        return self.text()
+
+
+def loopbackOnly(environ):
+    '''Allows the requests coming from the local host, see Profiler(allow=...)'''
+    return environ.get('REMOTE_ADDR') in ('127.0.0.1', '::1')
+
+
+def functionLabel(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+
+def endpointResponder(respond, methods):
+    '''Wraps the function of a built-in endpoint, OPTIONS requests are answered with the Allow header'''
+    allow = ', '.join(methods + ['OPTIONS'])
+    def endpoint(method):
+        if method == 'OPTIONS':
+            web.header('Allow', allow)
+            return ''
+        return respond(method)
+    return endpoint
+
+
+#Request headers of a batch which are not passed on to its entries
+BATCH_DROPPED_HEADERS = frozenset(('CONTENT_LENGTH', 'CONTENT_TYPE', 'HTTP_CONTENT_ENCODING', 'HTTP_TRANSFER_ENCODING',
+                                   'HTTP_ACCEPT_ENCODING', 'HTTP_RANGE', 'HTTP_IF_RANGE', 'HTTP_IF_NONE_MATCH', 
+                                   'HTTP_IF_MODIFIED_SINCE'))
 
-    def __call__(self, func):
-        def wrapped_func(*args, **namedArgs):
-            return func(*args, **namedArgs)
 
-        wrapped_func.exposed = True
-        wrapped_func.contentType = self.contentType
-        wrapped_func.contentEncoding = self.contentEncoding
-        wrapped_func.enableCORS = self.enableCORS
-        wrapped_func.supportMethods = self.supportMethods
-        wrapped_func.__doc__ = func.__doc__
-        wrapped_func.originalFunction = func 
-        return wrapped_func
+class BatchEndpoint:
+    '''Runs the sub-requests sent in the body of one POST request, see Application(batch=...)
 
+    The body is a JSON list of {"path": ..., "query": ..., "method": ...} entries, query is a string or an
+    object and method is GET by default. Every entry is routed and handled as a request of its own by the 
+    native WSGI function, so the supported methods, CORS, limits and caches of its handler apply. Headers of 
+    the batch request are passed on, except the ones about its body, content encoding and validators. 
+    The response is a JSON list with the status, headers and body of every entry in the same order, bodies 
+    which are not UTF-8 are base64 encoded. With threads, the entries run in parallel on a pool of that size.
+    Entries can not target the built-in endpoints. enableCORS and corsMaxAge are the same as for expose, 
+    they apply to the batch request and its preflight.
+    '''
+    def __init__(self, path: str='/_batch', 
+                 threads: int=0, 
+                 maxEntries: int=50, 
+                 maxBodySize: int=1024 * 1024,
+                 enableCORS: Union[str, List[str]]=defaultCORSOption(), 
+                 corsMaxAge: int=defaultCORSMaxAge()):
+        self.path = path
+        self.cors = CORSPolicy(enableCORS, ['POST', 'OPTIONS'], corsMaxAge)
+        self.maxEntries = maxEntries
+        self.maxBodySize = maxBodySize
+        self.executor = None
+        if threads:
+            self.executor = threadPool(threads, 'webapp-batch')
 
-@expose(contentType='text/html; charset=utf-8')
-def global_default():
-    return 'Missing Page: %s' % web.ctx.path
+    def respond(self, application, method):
+        ctx = web.ctx
+        cors = self.cors
+        if cors.enabled:
+            ctx.headers.extend(cors.headers(ctx.env.get('HTTP_ORIGIN'), method == 'OPTIONS'))
+        if method == 'OPTIONS':
+            ctx.headers.append(cors.allow)
+            return ''
+        if method != 'POST':
+            raise web.HTTPError('405 Method Not Allowed', {'Content-Type': 'text/plain', 'Allow': cors.methods}, 
+                                'Method Not Allowed')
+        try:
+            entries = json.loads(RequestBody(ctx.env, self.maxBodySize).read().decode('utf-8'))
+        except ValueError:
+            raise web.badrequest('Invalid batch request')
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) and isinstance(entry.get('path'), str)
+                                                    for entry in entries):
+            raise web.badrequest('Batch request is not a list of entries with paths')
+        if len(entries) > self.maxEntries:
+            raise web.badrequest('Batch request has more than %d entries' % self.maxEntries)
 
-def get_default_handler(nodeHandlers):
-    for nodeHandler in reversed(nodeHandlers):
+        environ = dict((key, value) for key, value in ctx.env.items() if key not in BATCH_DROPPED_HEADERS)
+        if self.executor is None or len(entries) < 2:
+            #Entries are handled on this thread, so web.ctx of the batch request is restored afterwards
+            state = dict(ctx.__dict__)
+            try:
+                results = [self.call(application, environ, entry) for entry in entries]
+            finally:
+                ctx.__dict__.clear()
+                ctx.__dict__.update(state)
+        else:
+            results = list(self.executor.map(lambda entry: self.call(application, environ, entry), entries))
+
+        web.header('Content-Type', 'application/json')
+        body = json.dumps(results).encode('utf-8')
+        compression = application.Index.compression
+        if compression is not None and len(body) >= compression.minSize:
+            web.header('Vary', 'Accept-Encoding')
+            encoding = compression.negotiate(ctx.env.get('HTTP_ACCEPT_ENCODING', ''))
+            if encoding is not None:
+                web.header('Content-Encoding', encoding)
+                body = b''.join(compressChunks((body,), encoding, compression.compresslevel))
+        return body
+
+    def call(self, application, baseEnviron, entry):
+        '''Handles an entry with the native WSGI function and returns its result'''
+        path = entry['path']
+        if not path.startswith('/') or path in application.Index.endpoints:
+            return {'path': path, 'status': 400, 'headers': {}, 'body': 'Invalid path'}
+        query = entry.get('query') or ''
+        if isinstance(query, dict):
+            query = urlencode(query, doseq=True)
+
+        environ = dict(baseEnviron)
+        environ['REQUEST_METHOD'] = str(entry.get('method') or 'GET').upper()
+        environ['PATH_INFO'] = path.encode('utf-8').decode('latin1')
+        environ['QUERY_STRING'] = str(query).lstrip('?')
+        environ['wsgi.input'] = BytesIO()
+
+        response = []
+        chunks = application.nativeWSGI(environ, lambda status, headers, exc_info=None: response.extend((status, headers)))
         try:
-            return getattr(nodeHandler, 'default')
-        except AttributeError:
-            pass 
-                
-    return global_default 
+            body = b''.join(map(encodeBody, chunks))
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
 
-def get_index_handler(nodeHandlers):
-    try:
-        nodeHandler = nodeHandlers[-1]
-        return getattr(nodeHandler, 'index')
-    except AttributeError:
-        return None
+        status, headers = response
+        result = {'path': path, 
+                  'status': int(status.split(' ', 1)[0]), 
+                  'headers': dict((header, value) for header, value in headers if header != 'Content-Length')}
+        try:
+            result['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            result['body'] = base64.b64encode(body).decode('ascii')
+            result['bodyEncoding'] = 'base64'
+        return result
 
 
-class Site:
-    pass
+class RootInstance:
+    '''A root of the Site tree together with its compiled routes'''
+    __slots__ = ('root', 'routes', '__weakref__')
 
+    def __init__(self, root, routes=None):
+        self.root = root
+        self.routes = routes
 
-def zipIt(content, compresslevel=5):
-    out = BytesIO()
-    f = gzip.GzipFile(fileobj=out, mode='w', compresslevel=compresslevel)
-    f.write(bytes(content, 'utf-8'))
-    f.close()
-    return out.getvalue()
-
-def unzipIt(content, compresslevel=5):
-    out = BytesIO(content)
-    f = gzip.GzipFile(fileobj=out, mode='r', compresslevel=compresslevel)
-    return f.read()
-
-def parseQuery(query):
-    storage = web.Storage()
-    query = query.strip()
-    if query.startswith('?'):
-        query = query[1:]
-    
-    for parameter in query.split('&'):
-        key, *val = parameter.split('=')
-        if not key:
-            continue 
-        if val == []:
-            val = True 
-        else:
-            val = '='.join(val)
-            val = unquote(val)
 
-    
+class RootPolicy(ABC):
+    '''Decides which root instance serves a request, see Application(rootPolicy=...)
+
+    A callable root (e.g. a Site class) is called once for every instance the policy creates, other 
+    roots are shared by all the instances. Routes of every instance are compiled if compileRoutes is set.
+    '''
+    #True if an instance is taken for each request, see call()
+    scoped = False
+
+    def __init__(self, root, compileRoutes=False):
+        self.root = root
+        self.compileRoutes = compileRoutes
+        self.instances = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def create(self):
+        root = self.root
+        if callable(root):
+            root = root()
+        instance = RootInstance(root, RouteTable(root) if self.compileRoutes else None)
+        with self._lock:
+            self.instances.add(instance)
+        return instance
+
+    @abstractmethod
+    def current(self):
+        '''Returns the root instance of the calling thread or request'''
+
+    def invalidate(self):
+        with self._lock:
+            instances = list(self.instances)
+        for instance in instances:
+            if instance.routes is not None:
+                instance.routes.invalidate()
+
+
+class SingletonRoot(RootPolicy):
+    '''One root instance shared by all the requests, the handlers need to be thread safe'''
+    def __init__(self, root, compileRoutes=False):
+        RootPolicy.__init__(self, root, compileRoutes)
+        self._instance = self.create()
+
+    def current(self):
+        return self._instance
+
+
+class ThreadRoots(RootPolicy):
+    '''One root instance per thread, created by the first request the thread serves'''
+    def __init__(self, root, compileRoutes=False):
+        RootPolicy.__init__(self, root, compileRoutes)
+        self._local = threading.local()
+
+    def current(self):
+        instance = getattr(self._local, 'instance', None)
+        if instance is None:
+            instance = self._local.instance = self.create()
+        return instance
+
+
+class PooledRoots(RootPolicy):
+    '''At most size root instances, each used by a single request at a time
+
+    Instances are created when all the existing ones are busy and reused afterwards. A request waits up 
+    to timeout seconds (forever if None) for an idle instance and gets 503 Service Unavailable after it. 
+    A streamed response keeps its instance until it is closed. Preflight (OPTIONS) requests and the code 
+    running outside of the requests (warm up, sitemap) use the first instance.
+    '''
+    scoped = True
+
+    def __init__(self, root, compileRoutes=False, size: int=8, timeout: float=None, retryAfter: int=1):
+        RootPolicy.__init__(self, root, compileRoutes)
+        self.size = size
+        self.timeout = timeout
+        self.retryAfter = retryAfter
+        self.created = 0
+        self.rejected = 0
+        self._idle = []
+        self._condition = threading.Condition()
+        self._first = self.acquire()
+        self.release(self._first)
+
+    def acquire(self):
+        '''Returns an idle instance, or None if none became idle within the timeout'''
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._condition:
+            while not self._idle and self.created >= self.size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.rejected += 1
+                    return None
+                self._condition.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
         try:
-            oldValue = storage[key]
-            if isinstance(oldValue, list):
-                oldValue.append(val)
-            else:
-                storage[key] = [oldValue, val]
-        except KeyError:
-            storage[key] = val
-        
-    return storage
+            return self.create()
+        except BaseException:
+            with self._condition:
+                self.created -= 1
+                self._condition.notify()
+            raise
+
+    async def acquireAsync(self):
+        '''Same as acquire for the requests handled on an event loop, waits on a thread of the loop'''
+        with self._condition:
+            if self._idle:
+                return self._idle.pop()
+        taken = asyncio.get_event_loop().run_in_executor(None, self.acquire)
+        try:
+            return await asyncio.shield(taken)
+        except asyncio.CancelledError:
+            #The instance taken after the request is gone goes back to the pool
+            taken.add_done_callback(lambda taken: taken.cancelled() or taken.exception() is not None 
+                                    or taken.result() is None or self.release(taken.result()))
+            raise
+
+    def release(self, instance):
+        with self._condition:
+            self._idle.append(instance)
+            self._condition.notify()
+
+    def call(self, func, *args):
+        '''Calls func with an instance of the pool taken for the request'''
+        instance = self.acquire()
+        if instance is None:
+            raise serviceUnavailable(self.retryAfter)
+        web.ctx.rootInstance = instance
+        return callReleasing(lambda: self.release(instance), func, *args)
+
+    def current(self):
+        instance = web.ctx.get('rootInstance')
+        if instance is None:
+            return self._first
+        return instance
+
+    def stats(self):
+        return {'size': self.size, 
+                'created': self.created, 
+                'idle': len(self._idle), 
+                'rejected': self.rejected}
+
+
+ROOT_POLICIES = {'singleton': SingletonRoot, 'thread': ThreadRoots, 'pool': PooledRoots}
+
 
 class Index:
-    root = None 
+    #Every Application serves its requests with its own subclass setting these
+    rootPolicy = SingletonRoot(None)
+    compression = None
+    metrics = None
+    profiler = None
+    #Paths of the built-in endpoints (metrics, profiler, sitemap) mapped to their functions
+    endpoints = {}
+
+    def enter(self, method, respond):
+        '''Entry step of the requests: serves the built-in endpoints, takes a root instance for the request 
+        if the root policy needs it and calls respond, the Index method handling the request, measured'''
+        if self.endpoints:
+            endpoint = self.endpoints.get(web.ctx.path)
+            if endpoint is not None:
+                return endpoint(method)
+        #Preflight requests do not call a handler, they are answered without waiting for an instance
+        if self.rootPolicy.scoped and method != 'OPTIONS':
+            return self.rootPolicy.call(self.measure, method, respond)
+        return self.measure(method, respond)
+
+    def measure(self, method, respond):
+        '''Records the metrics and the profile of the request if they are enabled'''
+        func, args = respond, ()
+        if self.metrics is not None:
+            func, args = self.metrics.measure, (method, respond)
+        if self.profiler is not None and self.profiler.sample(web.ctx.path):
+            func, args = self.profiler.profile, (func,) + args
+        return func(*args)
+
+    async def enterAsync(self, method, path):
+        '''enter() for the async handlers served by the ASGI adapter, the built-in endpoints are not async'''
+        policy = self.rootPolicy
+        if not policy.scoped or method == 'OPTIONS':
+            return await self.measureAsync(method, path)
+
+        #The event loop is not blocked while the request waits for an idle instance
+        instance = await policy.acquireAsync()
+        if instance is None:
+            raise serviceUnavailable(policy.retryAfter)
+        web.ctx.rootInstance = instance
+        release = lambda: policy.release(instance)
+        try:
+            result = await self.measureAsync(method, path)
+        except BaseException:
+            release()
+            raise
+        if hasattr(result, '__next__'):
+            return releasingChunks(result, release)
+        release()
+        return result
+
+    async def measureAsync(self, method, path):
+        nodeHandler, limit = self.getRoute(path)
+        if self.metrics is None:
+            return await self.handleAsync(method, nodeHandler, limit)
+        return await self.metrics.measureAsync(method, nodeHandler, self.handleAsync(method, nodeHandler, limit))
 
     def getNodeHandler(self, path):
-        if callable(self.root):
-            nodeHandler = self.root()
-        else:
-            nodeHandler = self.root 
+        return self.getRoute(path)[0]
+
+    def getRoute(self, path):
+        '''Returns the handler of the path and the concurrency limit of the Site subtree it is in'''
+        instance = self.rootPolicy.current()
+        if instance.routes is not None:
+            return instance.routes.resolveRoute(path)
+
+        nodeHandler = instance.root
         nodeHandlers = [nodeHandler]
+        limit = None
         if nodeHandler is None:
             nodeHandler = get_default_handler([nodeHandlers])
         else:
+            limit = siteLimit(nodeHandler)
             for node in path:
                 if not node:
                     break 
                 try:
                     nodeHandler = getattr(nodeHandler, node)
+                    if isinstance(nodeHandler, LazySite):
+                        nodeHandler = nodeHandler.resolve()
                     nodeHandlers.append(nodeHandler)
                     if callable(nodeHandler):
                         exposed = nodeHandler.exposed
+                    elif isinstance(nodeHandler, Site):
+                        limit = siteLimit(nodeHandler, limit)
+                        if isinstance(nodeHandler, StaticDirectory):
+                            #Rest of the path is a file served by the default handler of the directory
+                            break
 
                 except AttributeError:
                     nodeHandler = get_default_handler(nodeHandlers) 
@@ -170,14 +2119,13 @@ class Index:
                 nodeHandler = get_index_handler(nodeHandlers)
                 if not nodeHandler:
                     nodeHandler = get_default_handler(nodeHandlers)
-        return nodeHandler 
+        return nodeHandler, limit
 
     def addDefaultHeaders(self, method, nodeHandler):
-        methods = ", ".join(nodeHandler.supportMethods)
-        if nodeHandler.enableCORS is not None:
-            web.header('Access-Control-Allow-Origin', nodeHandler.enableCORS, unique=True)
-            web.header('Access-Control-Allow-Methods', methods, unique=True),
-            web.header('Access-Control-Allow-Headers', 'Authorization, Content-Type', unique=True)    
+        cors = nodeHandler.cors
+        ctx = web.ctx
+        if cors.enabled:
+            ctx.headers.extend(cors.headers(ctx.env.get('HTTP_ORIGIN'), method == 'OPTIONS'))
         
         if method not in nodeHandler.supportMethods:
             class MethodCheckObject:
@@ -187,40 +2135,126 @@ class Index:
                     return None
             raise web.nomethod(cls=MethodCheckObject())
         else:
-            web.header('Allow', methods)
+            ctx.headers.append(cors.allow)
+
+    def parseRequestQuery(self):
+        try:
+            return parseQuery(web.ctx.query, lazy=True)
+        except QueryLimitError as err:
+            raise web.badrequest(str(err))
 
     def GET(self):
+        return self.enter('GET', self.respondGET)
+
+    def POST(self):
+        return self.enter('POST', self.respondPOST)
+
+    def OPTIONS(self):
+        return self.enter('OPTIONS', self.respondOPTIONS)
+
+    def respondGET(self):
         path = web.ctx.path.split('/')[1:]
-        nodeHandler = self.getNodeHandler(path)
+        nodeHandler, limit = self.getRoute(path)
+        if self.metrics is not None:
+            web.ctx.requestMetrics.routed(nodeHandler)
 
         self.addDefaultHeaders("GET", nodeHandler)
-        
+
+        limit = nodeHandler.concurrency or limit
+        if limit is not None:
+            return limit.call(self.handleGET, nodeHandler)
+        return self.handleGET(nodeHandler)
+
+    def handleGET(self, nodeHandler):
         web.header('Content-Type', nodeHandler.contentType)
         if nodeHandler.contentEncoding:
             web.header('Content-Encoding', nodeHandler.contentEncoding)
                 
-        query = parseQuery(web.ctx.query)
-        try:
-            result = nodeHandler(**query)
-        except TypeError as err:
-            #If this is global handler it might have 0 parameters as input
-            #If this is a method handler, than it would have one parameter by default as self but we can't 
-            #rely on the parameter name. So, a simple short cut is, if there are more than one parameters
-            #then we raise the exception further
-            functionSignature = signature(nodeHandler.originalFunction)
-            if len(functionSignature.parameters) > 1:
-                raise (err)
-            result = nodeHandler()
-        return result 
+        if nodeHandler.responseCache is not None:
+            result = nodeHandler.responseCache.respond(self, nodeHandler)
+        elif nodeHandler.coalescing is not None:
+            result = nodeHandler.coalescing.respond(self, nodeHandler)
+        else:
+            result = self.callHandler(nodeHandler)
 
-    def POST(self):
-        
+        if nodeHandler.etag:
+            #Cached responses carry the ETag of the handler call which created them
+            checkConditionalRequest(headerValue('ETag'), None)
+        return result
+
+    def callHandler(self, nodeHandler, post=False):
+        if self.metrics is not None:
+            return self.callMeasured(nodeHandler, post)
+        result = nodeHandler(**self.handlerArguments(nodeHandler, post))
+        if nodeHandler.isAsync:
+            result = runCoroutine(result)
+        return self.finishResult(nodeHandler, result, post)
+
+    def callMeasured(self, nodeHandler, post=False):
+        requestMetrics = web.ctx.requestMetrics
+        arguments = requestMetrics.timed('query', self.handlerArguments, nodeHandler, post)
+        started = perf_counter()
+        result = nodeHandler(**arguments)
+        if nodeHandler.isAsync:
+            result = runCoroutine(result)
+        requestMetrics.add('handler', started)
+        return requestMetrics.finish(self, nodeHandler, result, post)
+
+    def handlerArguments(self, nodeHandler, post=False):
+        query = self.parseRequestQuery()
+        for name in RESERVED_PARAMETERS:
+            if name in query:
+                raise web.badrequest('%s is a reserved parameter' % name)
+        body = None
+        if post:
+            if nodeHandler.callPlan.wantsBody:
+                body = RequestBody(web.ctx.env, nodeHandler.maxBodySize)
+        elif nodeHandler.version is not None:
+            self.checkVersion(nodeHandler, query)
+        return nodeHandler.callPlan.arguments(nodeHandler, query, post, body)
+
+    def checkBodySize(self, nodeHandler):
+        '''Rejects a request before its body is read if the Content-Length is over the limit of the handler'''
+        maxSize = nodeHandler.maxBodySize
+        if maxSize is not None and requestLength(web.ctx.env) > maxSize:
+            raise payloadTooLarge(maxSize)
+
+    def finishResult(self, nodeHandler, result, post=False):
+        if self.compression is not None:
+            result = self.compression.compress(nodeHandler, result)
+
+        if nodeHandler.etag and not post and nodeHandler.version is None and not hasattr(result, '__next__'):
+            result = encodeBody(result)
+            web.header('ETag', bodyETag(result))
+        return result
+
+    def checkVersion(self, nodeHandler, query):
+        '''Answers with 304 before the handler is called if the version token is known by the client'''
+        args = (nodeHandler.__self__,) if hasattr(nodeHandler, '__self__') else ()
+        version = nodeHandler.version(*args, **nodeHandler.versionPlan.arguments(nodeHandler, query))
+        token, lastModified = version if isinstance(version, tuple) else (version, None)
+
+        encoding = None
+        if (self.compression is not None and not nodeHandler.contentEncoding 
+                and self.compression.compressible(nodeHandler.contentType)):
+            encoding = self.compression.negotiate(web.ctx.env.get('HTTP_ACCEPT_ENCODING', ''))
+
+        etag = versionETag(token, encoding)
+        web.header('ETag', etag)
+        if lastModified is not None:
+            lastModified = httpTimestamp(lastModified)
+            web.header('Last-Modified', formatdate(lastModified, usegmt=True))
+        checkConditionalRequest(etag, lastModified)
+
+    def respondPOST(self):
         path = web.ctx.path.split('/')[1:]
-        nodeHandler = self.getNodeHandler(path)
+        nodeHandler, limit = self.getRoute(path)
+        if self.metrics is not None:
+            web.ctx.requestMetrics.routed(nodeHandler)
         
         self.addDefaultHeaders("POST", nodeHandler)
+        self.checkBodySize(nodeHandler)
 
-        query = parseQuery(web.ctx.query)
         #
         #TODO: Current method finds the same URL handler as in the GET case, but we do not have a way
         #      to thell the handler that this is a POST request so we pass a keyword argument. It
@@ -232,89 +2266,856 @@ class Index:
         #      instead of handler. But this might create trouble for default handling etc. So perhaps _post 
         #      keyword is the simplest approach
         #
-        assert '_post' not in query, '_post is a reserved keyword'
-        query['_post'] = True 
-        try:
-            result = nodeHandler(**query)
-        except TypeError as err:
-            #If this is global handler it might have 0 parameters as input
-            #If this is a method handler, than it would have one parameter by default as self but we can't 
-            #rely on the parameter name. So, a simple short cut is, if there are more than one parameters
-            #then we raise the exception further
-            functionSignature = signature(nodeHandler.originalFunction)
-            if len(functionSignature.parameters) > 1:
-                raise (err)
-            result = nodeHandler()
-        return result 
+        limit = nodeHandler.concurrency or limit
+        if limit is not None:
+            return limit.call(self.callHandler, nodeHandler, True)
+        return self.callHandler(nodeHandler, post=True)
 
-    def OPTIONS(self):
+    def respondOPTIONS(self):
         path = web.ctx.path.split('/')[1:]
         nodeHandler = self.getNodeHandler(path)
+        if self.metrics is not None:
+            web.ctx.requestMetrics.routed(nodeHandler)
 
         self.addDefaultHeaders("OPTIONS", nodeHandler)
         return ""
 
+    async def handleAsync(self, method, nodeHandler, limit=None):
+        '''GET, POST and OPTIONS for the async handlers, the handler is awaited instead of being run'''
+        self.addDefaultHeaders(method, nodeHandler)
+        if method == 'OPTIONS':
+            return ""
+        if method == 'POST':
+            self.checkBodySize(nodeHandler)
+
+        limit = nodeHandler.concurrency or limit
+        if limit is None:
+            return await self.awaitHandler(method, nodeHandler)
+        if not await limit.acquireAsync():
+            raise limit.rejection()
+        try:
+            return await self.awaitHandler(method, nodeHandler)
+        finally:
+            limit.release()
+
+    async def awaitHandler(self, method, nodeHandler):
+        post = method == 'POST'
+        cache = entry = None
+        if not post:
+            web.header('Content-Type', nodeHandler.contentType)
+            if nodeHandler.contentEncoding:
+                web.header('Content-Encoding', nodeHandler.contentEncoding)
+            cache = nodeHandler.responseCache
+
+        if cache is not None:
+            key = cache.key(self)
+            entry = cache.get(key)
+        if entry is not None:
+            web.ctx.headers.extend(entry.headers)
+            result = entry.body
+        else:
+            start = len(web.ctx.headers)
+            requestMetrics = web.ctx.requestMetrics if self.metrics is not None else None
+            if requestMetrics is None:
+                result = await nodeHandler(**self.handlerArguments(nodeHandler, post))
+                result = self.finishResult(nodeHandler, result, post)
+            else:
+                arguments = requestMetrics.timed('query', self.handlerArguments, nodeHandler, post)
+                started = perf_counter()
+                result = await nodeHandler(**arguments)
+                requestMetrics.add('handler', started)
+                result = requestMetrics.finish(self, nodeHandler, result, post)
+            if cache is not None:
+                result = cache.store(key, web.ctx.headers[start:], result)[0]
+
+        if nodeHandler.etag and not post:
+            checkConditionalRequest(headerValue('ETag'), None)
+        return result
+
+
+NATIVE_METHODS = frozenset(('GET', 'POST', 'OPTIONS'))
+
+
+def loadContext(ctx, environ):
+    '''Lightweight version of web.application.load() used by the native WSGI function'''
+    ctx.clear()
+    ctx.status = '200 OK'
+    ctx.headers = []
+    ctx.output = ''
+    ctx.environ = ctx.env = environ
+    ctx.method = environ.get('REQUEST_METHOD')
+    ctx.host = environ.get('HTTP_HOST')
+    ctx.ip = environ.get('REMOTE_ADDR')
+    ctx.protocol = environ.get('wsgi.url_scheme', 'http')
+    ctx.homedomain = ctx.protocol + '://' + environ.get('HTTP_HOST', '[unknown]')
+    ctx.homepath = environ.get('SCRIPT_NAME', '')
+    ctx.home = ctx.realhome = ctx.homedomain + ctx.homepath
+
+    path = environ.get('PATH_INFO', '')
+    try:
+        path = path.encode('latin1').decode('utf8')
+    except UnicodeError:
+        pass
+    ctx.path = path
+
+    query = environ.get('QUERY_STRING')
+    ctx.query = '?' + query if query else ''
+    ctx.fullpath = path + ctx.query
+
+
+#Block size used when a file is sent without the file wrapper of the server
+FILE_BLOCK_SIZE = 256 * 1024
+
+
+class FileResponse:
+    '''Part of a file returned by a handler, the Content-Length header is set by the handler
+
+    The native WSGI function passes whole files to the wsgi.file_wrapper of the server, which can send 
+    them with sendfile. Otherwise the file is iterated in blocks of blockSize.
+    '''
+    def __init__(self, path, offset: int=0, length: int=None, blockSize: int=FILE_BLOCK_SIZE):
+        self.file = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.blockSize = blockSize
+        if length is None:
+            length = os.fstat(self.file.fileno()).st_size - offset
+        self.remaining = length
+        if offset:
+            self.file.seek(offset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            raise StopIteration()
+        data = self.file.read(min(self.blockSize, self.remaining))
+        if not data:
+            raise StopIteration()
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def wsgi(self, environ):
+        '''Returns the WSGI response body'''
+        fileWrapper = environ.get('wsgi.file_wrapper')
+        if fileWrapper is not None and self.offset == 0 and self.length is None:
+            return fileWrapper(self.file, self.blockSize)
+        return self
+
+
+class StaticFile:
+    #Cached metadata of a file served by StaticDirectory
+    __slots__ = ('path', 'key', 'size', 'mtime', 'etag', 'lastModified', 'contentType', 'gzip', 'checked')
+
+    def __init__(self, path, stat, contentType, checked):
+        self.path = path
+        self.key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        self.lastModified = formatdate(stat.st_mtime, usegmt=True)
+        self.contentType = contentType
+        self.gzip = None
+        self.checked = checked
+
+
+def parseRange(header, size):
+    '''Returns the first and last byte of a single byte range, or None if the header is ignored'''
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        #Multiple ranges are answered with the whole content
+        return None
+    first, separator, last = spec.strip().partition('-')
+    if not separator:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise rangeNotSatisfiable(size)
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise rangeNotSatisfiable(size)
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def rangeNotSatisfiable(size):
+    return web.HTTPError('416 Range Not Satisfiable', 
+                         {'Content-Type': 'text/plain', 'Content-Range': 'bytes */%d' % size}, 
+                         'Range Not Satisfiable')
+
+
+class StaticDirectory(Site):
+    '''Serves the files of a directory on the paths below the node, it can be mounted anywhere in the 
+    Site tree
+
+        class Root(Site):
+            assets = StaticDirectory('/srv/assets', maxAge=3600)
+
+    Single byte ranges are answered with 206 Partial Content. If the client accepts gzip and the file has
+    an up to date .gz sibling, the sibling is sent with Content-Encoding: gzip. The stat results, content 
+    types and ETags are cached, a file is stat'ed again at most every revalidate seconds to see if it 
+    changed. Hidden files and paths leaving the directory are not served.
+    '''
+    def __init__(self, directory: str, 
+                 maxAge: int=None, 
+                 indexFile: str='index.html', 
+                 revalidate: float=1.0,
+                 precompressed: bool=True,
+                 maxEntries: int=4096):
+        self.directory = os.path.realpath(directory)
+        self.maxAge = maxAge
+        self.indexFile = indexFile
+        self.revalidate = revalidate
+        self.precompressed = precompressed
+        self.maxEntries = maxEntries
+        self._files = {}
+        self._encodings = ResponseCompression(encodings=['gzip'])
+
+    @expose(contentType='application/octet-stream', methods=['GET'])
+    def default(self):
+        '''Static files'''
+        segments = self.relativePath()
+        entry = self.lookup('/'.join(segments)) if segments is not None else None
+        if entry is None:
+            raise web.notfound()
+        return self.respond(entry)
+
+    def relativePath(self):
+        '''Returns the segments of the request path below this node, found by walking the Site tree'''
+        segments = web.ctx.path.split('/')[1:]
+        node = web.ctx.app_stack[-1].root if web.ctx.get('app_stack') else None
+        for i, segment in enumerate(segments):
+            if node is self:
+                return segments[i:]
+            node = getattr(node, segment, None)
+            if isinstance(node, LazySite):
+                node = node.resolve()
+        return [] if node is self else None
+
+    def filePath(self, name):
+        parts = [part for part in name.split('/') if part]
+        if any(part.startswith('.') or '\\' in part or '\0' in part for part in parts):
+            return None
+        path = os.path.join(self.directory, *parts)
+        return path if self.contains(path) else None
+
+    def contains(self, path):
+        '''Returns True if the path resolves to a file in the directory, drive letters, absolute segments and 
+        symbolic links might lead out of it'''
+        try:
+            return os.path.commonpath([os.path.realpath(path), self.directory]) == self.directory
+        except ValueError:
+            #Paths on different drives
+            return False
+
+    def lookup(self, name):
+        '''Returns the cached metadata of the file, None if it can not be served'''
+        now = time.monotonic()
+        entry = self._files.get(name)
+        if entry is not None and now - entry.checked < self.revalidate:
+            return entry
+
+        path = self.filePath(name)
+        entry = self.statFile(path, entry, now) if path is not None else None
+        if entry is None:
+            self._files.pop(name, None)
+            return None
+        if len(self._files) >= self.maxEntries:
+            self._files.clear()
+        self._files[name] = entry
+        return entry
+
+    def statFile(self, path, entry, now):
+        try:
+            stat = os.stat(path)
+            if statModule.S_ISDIR(stat.st_mode) and self.indexFile:
+                path = os.path.join(path, self.indexFile)
+                if not self.contains(path):
+                    return None
+                stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not statModule.S_ISREG(stat.st_mode):
+            return None
+
+        if entry is None or entry.path != path or entry.key != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if contentType.startswith('text/') or contentType in ('application/javascript', 'application/json'):
+                contentType += '; charset=utf-8'
+            entry = StaticFile(path, stat, contentType, now)
+        entry.checked = now
+
+        entry.gzip = None
+        if self.precompressed:
+            try:
+                gzipStat = os.stat(path + '.gz') if self.contains(path + '.gz') else None
+            except OSError:
+                gzipStat = None
+            #A sibling older than the file is not up to date
+            if gzipStat is not None and statModule.S_ISREG(gzipStat.st_mode) and gzipStat.st_mtime >= stat.st_mtime:
+                entry.gzip = StaticFile(path + '.gz', gzipStat, entry.contentType, now)
+        return entry
+
+    def respond(self, entry):
+        ctx = web.ctx
+        environ = ctx.env
+        #Content type set for the handler is replaced by the one of the file
+        ctx.headers = [(header, value) for header, value in ctx.headers if header.lower() != 'content-type']
+
+        variant = entry
+        if entry.gzip is not None:
+            web.header('Vary', 'Accept-Encoding')
+            if self._encodings.negotiate(environ.get('HTTP_ACCEPT_ENCODING', '')) == 'gzip':
+                variant = entry.gzip
+        web.header('ETag', variant.etag)
+        web.header('Last-Modified', entry.lastModified)
+        if self.maxAge is not None:
+            web.header('Cache-Control', 'public, max-age=%d' % self.maxAge)
+        checkConditionalRequest(variant.etag, entry.mtime)
+
+        web.header('Accept-Ranges', 'bytes')
+        offset, length = 0, None
+        rangeHeader = environ.get('HTTP_RANGE')
+        ifRange = environ.get('HTTP_IF_RANGE')
+        if rangeHeader and (ifRange is None or ifRange.strip() in (variant.etag, entry.lastModified)):
+            byteRange = parseRange(rangeHeader, variant.size)
+            if byteRange is not None:
+                offset, length = byteRange[0], byteRange[1] - byteRange[0] + 1
+                web.ctx.status = '206 Partial Content'
+                web.header('Content-Range', 'bytes %d-%d/%d' % (byteRange[0], byteRange[1], variant.size))
+
+        web.header('Content-Type', entry.contentType)
+        if variant is not entry:
+            web.header('Content-Encoding', 'gzip')
+        web.header('Content-Length', str(variant.size if length is None else length))
+        return FileResponse(variant.path, offset, length)
+
+
+class StreamingResponse:
+    '''WSGI response for handlers returning iterators
+
+    The first chunk is produced immediately since the handler can still set headers until then. 
+    Closing the response closes the handler's iterator so it can release its resources.
+    '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.firstChunk = next(chunks, b'')
+
+    def __iter__(self):
+        chunk = self.firstChunk
+        self.firstChunk = None
+        yield encodeBody(chunk)
+        for chunk in self.chunks:
+            yield encodeBody(chunk)
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def threadPool(threads, name):
+    '''Returns a ThreadPoolExecutor naming its threads after name, the names need Python 3.6'''
+    try:
+        return ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+    except TypeError:
+        return ThreadPoolExecutor(max_workers=threads)
+
+
+_eventLoops = threading.local()
+
+def runCoroutine(coroutine):
+    '''Runs the coroutine of an async handler called from a WSGI thread on the loop of that thread'''
+    loop = getattr(_eventLoops, 'loop', None)
+    if loop is None:
+        loop = _eventLoops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
+
+
+class RequestContext:
+    '''Awaitable running a coroutine with its own web.ctx on the event loop thread
+
+    web.ctx is thread local, so the requests handled concurrently on the event loop would share it.
+    Content of web.ctx is swapped in before and out after every step of the coroutine.
+    '''
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.state = {}
+
+    def __await__(self):
+        ctx = web.ctx.__dict__
+        value, error = None, None
+        while True:
+            ctx.clear()
+            ctx.update(self.state)
+            try:
+                if error is None:
+                    future = self.coroutine.send(value)
+                else:
+                    future = self.coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.state = dict(ctx)
+                ctx.clear()
+
+            try:
+                value, error = (yield future), None
+            except BaseException as err:
+                value, error = None, err
+
+
+def asgiEnviron(scope, body, length=None):
+    '''Builds a WSGI like environment from an ASGI scope so web.ctx is filled as for WSGI requests'''
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'asgi.scope': scope,
+    }
+    server = scope.get('server')
+    if server:
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    #The body is already read, chunked requests have a length as well
+    environ['CONTENT_LENGTH'] = str(len(body.getbuffer()) if length is None else length)
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+    return environ
+
+
+def asgiResponseStart(status, headers):
+    return {'type': 'http.response.start', 
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(header.lower().encode('latin1'), value.encode('latin1')) for header, value in headers]}
+
+
+SITEMAP_XML_PATH = '/sitemap.xml'
+SITEMAP_LINES_PATH = '/sitemap.jsonl'
+
 
 class Application(web.application):
-    def __init__(self, root=None, urls=None, globals=globals()):
+    def __init__(self, root=None, urls=None, globals=globals(), compileRoutes=False, compression=None,
+                 metrics=None, profiler=None, serveSitemap=False, rootPolicy: str='singleton', 
+                 rootPoolSize: int=8, rootPoolTimeout: float=None, batch=None):
+        '''rootPolicy decides how the root instances are shared by the requests: 'singleton' (one 
+        instance), 'thread' (one instance per thread) or 'pool' (at most rootPoolSize instances, each 
+        serving one request at a time). A callable root, e.g. a Site class, is called once per instance.
+        '''
         if urls is None:
             urls = URLS
 
-        Index.root = root 
+        if compression is True:
+            compression = ResponseCompression()
+        if metrics is True:
+            metrics = Metrics()
+        if profiler is True:
+            profiler = Profiler()
+        if batch is True:
+            batch = BatchEndpoint()
+
+        if rootPolicy not in ROOT_POLICIES:
+            raise ValueError('Unknown root policy: %s' % rootPolicy)
+        if rootPolicy == 'pool':
+            policy = PooledRoots(root, compileRoutes, rootPoolSize, rootPoolTimeout)
+        else:
+            policy = ROOT_POLICIES[rootPolicy](root, compileRoutes)
+
+        endpoints = {}
+        if metrics is not None:
+            endpoints[metrics.path] = endpointResponder(lambda method: metrics.respond(), ['GET'])
+        if profiler is not None:
+            endpoints[profiler.path] = endpointResponder(profiler.respond, ['GET', 'POST'])
+        if batch is not None:
+            endpoints[batch.path] = lambda method: batch.respond(self, method)
+        if serveSitemap:
+            endpoints[SITEMAP_XML_PATH] = endpointResponder(lambda method: self.respondSitemapXML(), ['GET'])
+            endpoints[SITEMAP_LINES_PATH] = endpointResponder(lambda method: self.respondSitemapLines(), ['GET'])
+
+        #State of the application is kept on its own Index subclass, so applications can run side by side
+        self.Index = type('Index', (Index,), {'rootPolicy': policy,
+                                              'compression': compression,
+                                              'metrics': metrics,
+                                              'profiler': profiler,
+                                              'endpoints': endpoints})
+        urls = tuple(self.Index if url == 'webapp.Index' or url is Index else url for url in urls)
+        self.index = self.Index()
+        self._sitemap = None
+        self._sitemapLock = threading.Lock()
 
         web.application.__init__(self, urls, globals)
 
-    def run(self, address, port, *middleware):
-        func = self.wsgifunc(*middleware)
-        return web.httpserver.runsimple(func, (address, port))
+    @property
+    def rootPolicy(self):
+        return self.Index.rootPolicy
 
-    def __get_sitemap(self):
-        
-        sitemap = []
-        def traverse(node, path='/'):
-            if not isinstance(node, Site):
+    @property
+    def root(self):
+        '''Root instance of the calling thread or request'''
+        return self.Index.rootPolicy.current().root
+
+    def invalidateRoutes(self):
+        '''Needs to be called after the Site tree is modified, compiled routes and the cached sitemap 
+        are rebuilt on the next use'''
+        self.Index.rootPolicy.invalidate()
+        self.invalidateSitemap()
+
+    def invalidateSitemap(self):
+        self._sitemap = None
+
+    def wsgifunc(self, *middleware, native=False):
+        '''Returns the WSGI function of the application
+
+        If native is True, requests are passed directly to Index without going through the URL
+        mapping and processors of web.py. Only the parts of web.ctx used by the handlers are set.
+        '''
+        if not native:
+            return web.application.wsgifunc(self, *middleware)
+
+        wsgi = self.nativeWSGI
+        for m in middleware:
+            wsgi = m(wsgi)
+        return wsgi
+
+    def nativeWSGI(self, environ, start_response):
+        ctx = web.ctx
+        loadContext(ctx, environ)
+        ctx.app_stack = [self]
+
+        method = ctx.method
+        if method == 'HEAD':
+            method = 'GET'
+        try:
+            if method not in NATIVE_METHODS:
+                raise web.nomethod(Index)
+            result = getattr(self.index, method)()
+            if result.__class__ is FileResponse:
+                pass
+            elif result and hasattr(result, '__next__'):
+                result = StreamingResponse(result)
+        except web.HTTPError as err:
+            result = err.data
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            print(traceback.format_exc(), file=environ.get('wsgi.errors', sys.stderr))
+            ctx.headers = []
+            result = web.internalerror().data
+
+        if result.__class__ is FileResponse:
+            start_response(ctx.status, ctx.headers)
+            if ctx.method == 'HEAD':
+                result.close()
+                return [b'']
+            return result.wsgi(environ)
+
+        if isinstance(result, StreamingResponse):
+            #No Content-Length is given so the server sends the chunks as they are produced
+            start_response(ctx.status, ctx.headers)
+            if ctx.method == 'HEAD':
+                result.close()
+                return [b'']
+            return result
+
+        result = encodeBody(result)
+        ctx.headers.append(('Content-Length', str(len(result))))
+        start_response(ctx.status, ctx.headers)
+        if ctx.method == 'HEAD':
+            return [b'']
+        return [result]
+
+    def asgifunc(self, threads: int=32):
+        '''Returns an ASGI callable for the application
+
+        Async handlers are awaited on the event loop, each with its own web.ctx. Other handlers run 
+        through the native WSGI function on a thread pool limited to the given number of threads.
+        '''
+        executor = threadPool(threads, 'webapp')
+
+        async def asgi(scope, receive, send):
+            if scope['type'] == 'lifespan':
+                while True:
+                    message = await receive()
+                    if message['type'] == 'lifespan.startup':
+                        await send({'type': 'lifespan.startup.complete'})
+                    elif message['type'] == 'lifespan.shutdown':
+                        executor.shutdown(wait=False)
+                        await send({'type': 'lifespan.shutdown.complete'})
+                        return
+
+            if scope['type'] != 'http':
+                raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+
+            nodeHandler, limit = self.index.getRoute(scope['path'].split('/')[1:])
+            #Large bodies are spooled to disk, reading stops once the limit of the handler is exceeded 
+            #and the handler rejects the request with 413
+            maxSize = nodeHandler.maxBodySize
+            body = SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+            length = 0
+            more = True
+            while more and (maxSize is None or length <= maxSize):
+                message = await receive()
+                data = message.get('body', b'')
+                length += len(data)
+                body.write(data)
+                more = message.get('more_body', False)
+            body.seek(0)
+
+            environ = asgiEnviron(scope, body, length)
+            #The built-in endpoints are served by Index.enter() on the thread pool
+            if (nodeHandler.isAsync and environ['REQUEST_METHOD'] in ('GET', 'HEAD', 'POST', 'OPTIONS')
+                    and scope['path'] not in self.Index.endpoints):
+                status, headers, body = await RequestContext(self.respondAsync(environ))
+                await send(asgiResponseStart(status, headers))
+                await send({'type': 'http.response.body', 'body': body})
                 return
-            
-            nodeHandler = get_index_handler([node])
-            if nodeHandler:
-                sitemap.append({'url': path, 
-                                'handler': node.__class__.__name__, 
-                                'description': nodeHandler.__doc__ if nodeHandler.__doc__ else ''})
-            if not path.endswith('/'):
-                path = path + '/'
 
-            for attr in dir(node):
-                nodeHandler = getattr(node, attr)
-                
-                if callable(nodeHandler):
+            loop = asyncio.get_event_loop()
+            chunks = asyncio.Queue(maxsize=8)
+            started = loop.create_future()
+            cancelled = threading.Event()
+            limit = nodeHandler.concurrency or limit
+            handlerExecutor = limit.executor if limit is not None and limit.executor is not None else executor
+            loop.run_in_executor(handlerExecutor, self.respondSync, environ, loop, started, chunks, cancelled)
+            status, headers = await started
+            await send(asgiResponseStart(status, headers))
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                #Unblocks the handler thread if the client is gone
+                cancelled.set()
+                while not chunks.empty():
+                    chunks.get_nowait()
+
+        asgi.executor = executor
+        return asgi
+
+    def respondSync(self, environ, loop, started, chunks, cancelled):
+        '''Handles an ASGI request with the native WSGI function on a thread of the pool
+
+        Streamed chunks are produced on the same thread since the handler might be using web.ctx. The 
+        queue is bounded, so a slow client holds the handler back instead of filling the memory.
+        '''
+        def put(chunk):
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+        response = []
+        try:
+            result = self.nativeWSGI(environ, lambda status, headers, exc_info=None: response.extend((status, headers)))
+        except BaseException as err:
+            loop.call_soon_threadsafe(started.set_exception, err)
+            return
+        loop.call_soon_threadsafe(started.set_result, response)
+
+        try:
+            for chunk in result:
+                if cancelled.is_set():
+                    break
+                if chunk:
+                    put(chunk)
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+            if not cancelled.is_set():
+                put(None)
+
+    async def respondAsync(self, environ):
+        ctx = web.ctx
+        loadContext(ctx, environ)
+        ctx.app_stack = [self]
+
+        method = ctx.method
+        if method == 'HEAD':
+            method = 'GET'
+        try:
+            result = await self.index.enterAsync(method, ctx.path.split('/')[1:])
+        except web.HTTPError as err:
+            result = err.data
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            print(traceback.format_exc(), file=environ.get('wsgi.errors', sys.stderr))
+            ctx.headers = []
+            result = web.internalerror().data
+
+        if hasattr(result, '__next__'):
+            result = b''.join(map(encodeBody, result))
+        else:
+            result = encodeBody(result)
+        ctx.headers.append(('Content-Length', str(len(result))))
+        if ctx.method == 'HEAD':
+            result = b''
+        return ctx.status, list(ctx.headers), result
+
+    def run(self, address, port, *middleware, native=False, workers=None, warmUp=None, **serverOptions):
+        '''Serves the application
+
+        By default the single process server of web.py is used. If workers is given, the pre-fork 
+        server in webapp.server is started with that many worker processes (0 means one per CPU). 
+        serverOptions are passed to webapp.server.PreforkServer (threads, maxRequests, reusePort...).
+        warmUp is True or a list of paths, see warmUp(). The subtrees are loaded once the server (or 
+        each worker) is listening. Both servers serve the static/ directory and log the requests like 
+        web.py's runsimple.
+        '''
+        paths = None if warmUp is True else warmUp
+        func = self.wsgifunc(*middleware, native=native)
+        if workers is None:
+            if warmUp:
+                def listening():
+                    server = getattr(web.httpserver, 'server', None)
+                    return server is not None and server.ready
+                self.warmUp(paths, after=listening)
+            return web.httpserver.runsimple(func, (address, port))
+
+        if warmUp:
+            serverOptions['onStart'] = lambda: self.warmUp(paths)
+        from webapp.server import PreforkServer
+        #Same middleware as web.httpserver.runsimple
+        func = web.httpserver.LogMiddleware(web.httpserver.StaticMiddleware(func))
+        return PreforkServer(func, address, port, workers=workers, **serverOptions).serve()
+
+    def warmUp(self, paths: List[str]=None, background: bool=True, after=None):
+        '''Loads the LazySite subtrees on the given paths, or all of them, and compiles their routes
+
+        With background=True the subtrees are loaded on a daemon thread, which is returned. If after is
+        given, the thread waits until it returns True.
+        '''
+        def load():
+            while after is not None and not after():
+                time.sleep(0.05)
+            for path in paths if paths is not None else [entry['url'] for entry in self.sitemap]:
+                self.index.getRoute(path.split('/')[1:])
+
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name='webapp-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def __get_sitemap(self):
+        sitemap = self._sitemap
+        if sitemap is None:
+            with self._sitemapLock:
+                if self._sitemap is None:
+                    self._sitemap = list(self.walkSitemap())
+                sitemap = self._sitemap
+        return list(sitemap)
+
+    sitemap = property(__get_sitemap) 
+
+    def iterSitemap(self):
+        '''Returns an iterator of the sitemap entries, the tree is walked lazily if it is not cached'''
+        sitemap = self._sitemap
+        if sitemap is not None:
+            return iter(sitemap)
+        return self.walkSitemap()
+
+    def walkSitemap(self):
+        '''Yields the sitemap entries while walking the Site tree
+
+        Child sites which are already on the path are skipped so cycles end. Shared subtrees are listed 
+        under each of their paths, but every node is scanned once. LazySite subtrees are loaded.
+        '''
+        scans = {}
+        def scan(node):
+            key = id(node)
+            if key not in scans:
+                children = []
+                for attr in dir(node):
                     try:
-                        exposed = nodeHandler.exposed
-                        sitemap.append({'url': path + attr, 
-                                        'handler': node.__class__.__name__, 
-                                        'description': nodeHandler.__doc__ if nodeHandler.__doc__ else ''})
+                        child = getattr(node, attr)
                     except AttributeError:
-                        continue 
+                        continue
+                    if callable(child):
+                        if hasattr(child, 'exposed'):
+                            children.append((attr, child))
+                    elif isinstance(child, Site):
+                        children.append((attr, child))
+                    elif isinstance(child, LazySite):
+                        children.append((attr, child.resolve()))
+                scans[key] = (get_index_handler([node]), children)
+            return scans[key]
 
-                else:
-                    traverse(nodeHandler, path + attr)
-                
+        def entry(url, node, nodeHandler):
+            return {'url': url, 
+                    'handler': node.__class__.__name__, 
+                    'description': nodeHandler.__doc__ if nodeHandler.__doc__ else ''}
+
+        def traverse(node, path, ancestors):
+            indexHandler, children = scan(node)
+            if indexHandler:
+                yield entry(path, node, indexHandler)
+            if not path.endswith('/'):
+                path = path + '/'
 
+            ancestors.add(id(node))
+            for attr, child in children:
+                if not isinstance(child, Site):
+                    yield entry(path + attr, node, child)
+                elif id(child) not in ancestors:
+                    yield from traverse(child, path + attr, ancestors)
+            ancestors.discard(id(node))
 
-        if Index.root:
-            traverse(Index.root)
+        root = self.root
+        if isinstance(root, Site):
+            yield from traverse(root, '/', set())
 
-        return sitemap 
+    def respondSitemapLines(self):
+        web.header('Content-Type', 'application/jsonl; charset=utf-8')
+        return (json.dumps(entry) + '\n' for entry in self.iterSitemap())
 
-    sitemap = property(__get_sitemap) 
+    def respondSitemapXML(self):
+        web.header('Content-Type', 'application/xml; charset=utf-8')
+        return self.sitemapXML(web.ctx.homedomain + web.ctx.homepath)
+
+    def sitemapXML(self, base):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for entry in self.iterSitemap():
+            yield '<url><loc>%s</loc></url>\n' % xmlEscape(base + entry['url'])
+        yield '</urlset>\n'
 
 URLS = (
     '/.*', 'webapp.Index'
 )
 
 
-def start(address='0.0.0.0', port=8080):
+def start(address='0.0.0.0', port=8080, workers=None, **serverOptions):
     ''' '''
     APP = Application(URLS, globals())
 
-    APP.run(address, port)
+    APP.run(address, port, workers=workers, **serverOptions)
     
@@ -0,0 +1,212 @@
+# -*- coding: iso-8859-15 -*-
+
+__doc__ = '''Pre-fork production server used by Application.run(workers=...)
+
+A supervisor process opens the listening socket and forks worker processes sharing it (or each worker
+binds its own socket with SO_REUSEPORT). Every worker runs a threaded cheroot server. The supervisor
+replaces the workers which exit, so workers can be recycled after a number of requests to keep their
+memory in check.
+
+Signals handled by the supervisor:
+    SIGTERM, SIGINT: stop accepting connections, let the workers drain and exit
+    SIGHUP: graceful restart, new workers are started and the old ones drain and exit
+'''
+
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import itertools
+import threading
+
+from cheroot import wsgi
+
+
+def listenSocket(address, port, reusePort=False, backlog=1024):
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(address, port, socket.AF_UNSPEC,
+                                                              socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    sock.listen(backlog)
+    return sock
+
+
+class WorkerServer(wsgi.Server):
+    '''cheroot server accepting connections from an already listening socket'''
+    def __init__(self, sock, wsgi_app, numthreads=10, **options):
+        self.listenSocket = sock
+        wsgi.Server.__init__(self, sock.getsockname()[:2], wsgi_app, numthreads=numthreads, **options)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listenSocket
+        return self.socket
+
+
+class PreforkServer:
+    def __init__(self, wsgiFunc, address='0.0.0.0', port=8080,
+                 workers: int=None,
+                 threads: int=10,
+                 maxRequests: int=0,
+                 maxRequestsJitter: int=0,
+                 reusePort: bool=False,
+                 graceTimeout: float=30,
+                 onStart=None):
+        self.wsgiFunc = wsgiFunc
+        self.address = address
+        self.port = port
+        self.workerCount = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.maxRequests = maxRequests
+        self.maxRequestsJitter = maxRequestsJitter
+        self.reusePort = reusePort
+        self.graceTimeout = graceTimeout
+        self.onStart = onStart
+
+        self.socket = None
+        self.workers = {}
+        self.running = False
+        self.restartRequested = False
+
+    def serve(self):
+        '''Runs the supervisor until it is stopped by a signal'''
+        if not self.reusePort:
+            self.socket = listenSocket(self.address, self.port)
+            self.port = self.socket.getsockname()[1]
+        print('http://%s:%d/ (%d workers, %d threads each)' % (self.address, self.port, self.workerCount,
+                                                               self.threads))
+        sys.stdout.flush()
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handleStop)
+        signal.signal(signal.SIGINT, self.handleStop)
+        signal.signal(signal.SIGHUP, self.handleRestart)
+        try:
+            while self.running:
+                self.reapWorkers()
+                if self.restartRequested:
+                    self.restartRequested = False
+                    self.restartWorkers()
+                while self.running and len(self.workers) < self.workerCount:
+                    self.spawnWorker()
+                time.sleep(0.1)
+        finally:
+            self.stopWorkers()
+            if self.socket is not None:
+                self.socket.close()
+
+    def handleStop(self, signum, frame):
+        self.running = False
+
+    def handleRestart(self, signum, frame):
+        self.restartRequested = True
+
+    def spawnWorker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+
+        exitCode = 0
+        try:
+            self.runWorker()
+        except BaseException:
+            exitCode = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exitCode)
+
+    def runWorker(self):
+        #The handler of the supervisor would only set its flag, the worker sets its own once it serves
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        sock = self.socket
+        if sock is None:
+            sock = listenSocket(self.address, self.port, reusePort=True)
+
+        wsgiFunc = self.wsgiFunc
+        if self.maxRequests:
+            wsgiFunc = self.recycling(wsgiFunc, self.maxRequests + random.randint(0, self.maxRequestsJitter))
+
+        self.server = WorkerServer(sock, wsgiFunc, numthreads=self.threads, shutdown_timeout=self.graceTimeout)
+        self.stopping = None
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopWorker())
+        self.server.prepare()
+        if self.onStart is not None:
+            #Called in every worker once it is listening, e.g. to load the lazy subtrees
+            self.onStart()
+        self.server.serve()
+        #serve returns once the server stops accepting, the requests in progress are drained by stop
+        if self.stopping is not None:
+            self.stopping.join()
+
+    def stopWorker(self):
+        #cheroot waits for its threads while stopping, so it can not be stopped from a signal handler
+        if self.stopping is None:
+            self.stopping = threading.Thread(target=self.server.stop, daemon=True)
+            self.stopping.start()
+
+    def recycling(self, wsgiFunc, maxRequests):
+        '''Stops the worker after maxRequests requests, the supervisor starts a new one
+
+        The worker drains like on SIGTERM, a connection accepted while it stops is still served.
+        '''
+        counter = itertools.count(1)
+
+        def wsgi(environ, start_response):
+            if next(counter) == maxRequests:
+                self.stopWorker()
+            return wsgiFunc(environ, start_response)
+        return wsgi
+
+    def reapWorkers(self):
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if not pid:
+                return
+            startTime = self.workers.pop(pid, None)
+            if startTime is not None and time.monotonic() - startTime < 1 and self.running:
+                #Do not spin if the workers fail at start
+                time.sleep(1)
+
+    def restartWorkers(self):
+        oldWorkers = list(self.workers)
+        for pid in oldWorkers:
+            self.spawnWorker()
+            self.signalWorker(pid, signal.SIGTERM)
+
+    def signalWorker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def stopWorkers(self):
+        for pid in list(self.workers):
+            self.signalWorker(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceTimeout
+        while self.workers and time.monotonic() < deadline:
+            self.reapWorkers()
+            time.sleep(0.1)
+
+        for pid in list(self.workers):
+            self.signalWorker(pid, signal.SIGKILL)
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.workers.pop(pid, None)
@@ -0,0 +1,311 @@
+# -*- coding: iso-8859-15 -*-
+
+__doc__ = '''Response cache shared by the processes of a host, e.g. the workers of webapp.server
+
+    from webapp.sharedcache import SharedResponseCache
+
+    reports = SharedResponseCache(ttl=60, size=256 * 1024 * 1024)
+
+    class Root(Site):
+        @expose(contentType='application/json', cache=reports)
+        def summary(self, year: int):
+            ...
+
+The cache lives in a memory mapped file, so a cache created before the workers are forked (e.g. at import
+time) is shared by all of them. Processes started separately share it if they give the same path.
+
+Layout of the file:
+    header: counters and the allocator state
+    slots: open addressing hash table (linear probing) of the entries keyed by a hash of path plus query
+    next: one link per data block, chains the blocks of an entry or the free blocks
+    data: fixed size blocks holding the encoded entries
+
+Entries are evicted with the clock algorithm when there are not enough free blocks or slots. The file is
+locked with lockf for the other processes and with a thread lock for the threads of a process.
+'''
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+from hashlib import sha1
+from contextlib import contextmanager
+
+from webapp import ResponseCache, CachedResponse, privateResponse
+
+
+MAGIC = b'WEBAPPC1'
+
+#magic, slots, block size, blocks, free head, free blocks, clock hand, entries, hits, misses, evictions, stores
+HEADER = struct.Struct('<8sIIIIIIIQQQQ')
+HEADER_SIZE = 128
+
+#key hash, first block, length, expiry time (time.time()), flags
+SLOT = struct.Struct('<16sIIdB7x')
+USED = 1
+REFERENCED = 2
+
+LINK = struct.Struct('<I')
+END = 0xFFFFFFFF
+
+#Length of the JSON encoded headers in front of the body
+VALUE_HEADER = struct.Struct('<I')
+
+
+def keyDigest(key):
+    return sha1(repr(key).encode('utf-8')).digest()[:16]
+
+
+class SharedResponseCache(ResponseCache):
+    '''ResponseCache keeping its entries in shared memory, see the module documentation
+
+    size is the memory of the entry blocks, entries use ceil(length / blockSize) blocks. The hash table
+    has slots entries (one per block by default) and is filled up to 75%. Stampede protection works within
+    a process, the processes might compute the same response once each.
+    '''
+    def __init__(self, ttl: float=60,
+                 size: int=64 * 1024 * 1024,
+                 blockSize: int=4096,
+                 slots: int=None,
+                 path: str=None,
+                 headers=[],
+                 stampede: bool=True,
+                 stampedeTimeout: float=10):
+        ResponseCache.__init__(self, ttl, size, headers, stampede, stampedeTimeout)
+        self.blockSize = blockSize
+        self.blockCount = max(1, size // blockSize)
+        self.slotCount = slots or max(16, self.blockCount)
+        self.maxEntries = self.slotCount * 3 // 4
+        self.slotsOffset = HEADER_SIZE
+        self.linksOffset = self.slotsOffset + self.slotCount * SLOT.size
+        self.dataOffset = self.linksOffset + self.blockCount * LINK.size
+        self.fileSize = self.dataOffset + self.blockCount * blockSize
+
+        if path is None:
+            #Nothing else opens the file, it is removed and only shared through the forked processes
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            self.fd, tempPath = tempfile.mkstemp(prefix='webapp-cache-', dir=directory)
+            os.unlink(tempPath)
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.path = path
+        self._threadLock = threading.Lock()
+        self._pid = os.getpid()
+
+        with self.locked():
+            if os.fstat(self.fd).st_size < self.fileSize:
+                os.ftruncate(self.fd, self.fileSize)
+            self.memory = mmap.mmap(self.fd, self.fileSize)
+            header = HEADER.unpack_from(self.memory, 0)
+            if header[0] != MAGIC or header[1:4] != (self.slotCount, blockSize, self.blockCount):
+                self._format()
+
+    @contextmanager
+    def locked(self):
+        if self._pid != os.getpid():
+            #A lock held by another thread while forking would never be released in the child
+            self._threadLock = threading.Lock()
+            self._pid = os.getpid()
+        with self._threadLock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _format(self):
+        memory = self.memory
+        memory[self.slotsOffset:self.linksOffset] = bytes(self.linksOffset - self.slotsOffset)
+        for block in range(self.blockCount):
+            LINK.pack_into(memory, self.linksOffset + block * LINK.size, block + 1 if block + 1 < self.blockCount else END)
+        HEADER.pack_into(memory, 0, MAGIC, self.slotCount, self.blockSize, self.blockCount, 0, self.blockCount,
+                         0, 0, 0, 0, 0, 0)
+
+    def _header(self):
+        return list(HEADER.unpack_from(self.memory, 0))
+
+    def _setHeader(self, header):
+        HEADER.pack_into(self.memory, 0, *header)
+
+    def _slot(self, index):
+        return SLOT.unpack_from(self.memory, self.slotsOffset + index * SLOT.size)
+
+    def _setSlot(self, index, *slot):
+        SLOT.pack_into(self.memory, self.slotsOffset + index * SLOT.size, *slot)
+
+    def _clearSlot(self, index):
+        offset = self.slotsOffset + index * SLOT.size
+        self.memory[offset:offset + SLOT.size] = bytes(SLOT.size)
+
+    def _home(self, digest):
+        return int.from_bytes(digest[:8], 'little') % self.slotCount
+
+    def _find(self, digest):
+        index = self._home(digest)
+        for _ in range(self.slotCount):
+            slot = self._slot(index)
+            if not slot[4] & USED:
+                return None
+            if slot[0] == digest:
+                return index
+            index = (index + 1) % self.slotCount
+        return None
+
+    def _link(self, block):
+        return LINK.unpack_from(self.memory, self.linksOffset + block * LINK.size)[0]
+
+    def _setLink(self, block, nextBlock):
+        LINK.pack_into(self.memory, self.linksOffset + block * LINK.size, nextBlock)
+
+    def _allocate(self, header, count):
+        '''Takes count blocks from the free list, returns the first one of the chain'''
+        first = block = header[4]
+        for _ in range(count - 1):
+            block = self._link(block)
+        header[4] = self._link(block)
+        header[5] -= count
+        self._setLink(block, END)
+        return first
+
+    def _free(self, header, first):
+        block, count = first, 1
+        while self._link(block) != END:
+            block = self._link(block)
+            count += 1
+        self._setLink(block, header[4])
+        header[4] = first
+        header[5] += count
+
+    def _write(self, first, value):
+        block, memory, blockSize = first, self.memory, self.blockSize
+        for start in range(0, len(value), blockSize):
+            offset = self.dataOffset + block * blockSize
+            piece = value[start:start + blockSize]
+            memory[offset:offset + len(piece)] = piece
+            block = self._link(block)
+
+    def _read(self, first, length):
+        pieces = []
+        block, memory, blockSize = first, self.memory, self.blockSize
+        while length > 0:
+            offset = self.dataOffset + block * blockSize
+            size = min(length, blockSize)
+            pieces.append(memory[offset:offset + size])
+            length -= size
+            block = self._link(block)
+        return b''.join(pieces)
+
+    def _delete(self, header, index):
+        '''Frees the blocks of the entry and closes the gap in the probe sequence (backward shift)'''
+        self._free(header, self._slot(index)[1])
+        header[7] -= 1
+        hole = index
+        index = (index + 1) % self.slotCount
+        while True:
+            slot = self._slot(index)
+            if not slot[4] & USED:
+                break
+            home = self._home(slot[0])
+            #The entry can move to the hole if its home is not between the hole and its position
+            if (hole < index and (home <= hole or home > index)) or (hole > index and home <= hole and home > index):
+                self._setSlot(hole, *slot)
+                hole = index
+            index = (index + 1) % self.slotCount
+        self._clearSlot(hole)
+
+    def _evict(self, header):
+        '''Evicts an entry which is not referenced since the clock hand passed over it'''
+        for _ in range(2 * self.slotCount):
+            hand = header[6]
+            slot = self._slot(hand)
+            if slot[4] & USED:
+                if slot[4] & REFERENCED:
+                    self._setSlot(hand, slot[0], slot[1], slot[2], slot[3], USED)
+                else:
+                    self._delete(header, hand)
+                    header[10] += 1
+                    return True
+            header[6] = (hand + 1) % self.slotCount
+        return False
+
+    def get(self, key):
+        digest = keyDigest(key)
+        with self.locked():
+            header = self._header()
+            index = self._find(digest)
+            value = None
+            if index is not None:
+                slot = self._slot(index)
+                if slot[3] > time.time():
+                    self._setSlot(index, slot[0], slot[1], slot[2], slot[3], USED | REFERENCED)
+                    value = self._read(slot[1], slot[2])
+                else:
+                    self._delete(header, index)
+            if value is None:
+                header[9] += 1
+            else:
+                header[8] += 1
+            self._setHeader(header)
+
+        if value is None:
+            return None
+        headersLength = VALUE_HEADER.unpack_from(value, 0)[0]
+        start = VALUE_HEADER.size
+        headers = [tuple(header) for header in json.loads(value[start:start + headersLength].decode('utf-8'))]
+        #Expiry is not needed by ResponseCache.respond once the entry is returned
+        return CachedResponse(value[start + headersLength:], headers, time.monotonic() + self.ttl)
+
+    def set(self, key, entry):
+        #Entries are shared by all the processes, never store the cookies or private responses of a client
+        if privateResponse(entry.headers):
+            return
+        encodedHeaders = json.dumps(entry.headers).encode('utf-8')
+        value = VALUE_HEADER.pack(len(encodedHeaders)) + encodedHeaders + entry.body
+        count = max(1, -(-len(value) // self.blockSize))
+        if count > self.blockCount:
+            return
+        digest = keyDigest(key)
+        expires = time.time() + self.ttl
+
+        with self.locked():
+            header = self._header()
+            index = self._find(digest)
+            if index is not None:
+                self._delete(header, index)
+            while header[5] < count or header[7] >= self.maxEntries:
+                if not self._evict(header):
+                    self._setHeader(header)
+                    return
+
+            first = self._allocate(header, count)
+            self._write(first, value)
+            index = self._home(digest)
+            while self._slot(index)[4] & USED:
+                index = (index + 1) % self.slotCount
+            self._setSlot(index, digest, first, len(value), expires, USED)
+            header[7] += 1
+            header[11] += 1
+            self._setHeader(header)
+
+    def clear(self):
+        with self.locked():
+            self._format()
+
+    def stats(self):
+        with self.locked():
+            header = self._header()
+        return {'hits': header[8],
+                'misses': header[9],
+                'evictions': header[10],
+                'stores': header[11],
+                'shared': self.flights.shared if self.flights is not None else 0,
+                'entries': header[7],
+                'bytes': (self.blockCount - header[5]) * self.blockSize}
+
+    def close(self):
+        self.memory.close()
+        os.close(self.fd)